@@ -28,7 +28,8 @@ from openquake.hazardlib.geo import geodetic
 from openquake.hazardlib.geo.mesh import Mesh
 from openquake.baselib import general
 from openquake.baselib.performance import DummyMonitor
-from openquake.commonlib import readinput, datastore, logictree, export, source
+from openquake.commonlib import (
+    readinput, datastore, logictree, export, source, parallel)
 from openquake.commonlib.parallel import apply_reduce
 from openquake.risklib import riskinput
 
@@ -93,6 +94,9 @@ class BaseCalculator(object):
         if concurrent_tasks is not None:
             self.oqparam.concurrent_tasks = concurrent_tasks
         vars(self.oqparam).update(kw)
+        # the big arguments sent to many tasks are shared via the calc_dir
+        parallel.TaskManager.shared_dir = getattr(
+            self.datastore, 'calc_dir', None)
         try:
             if pre_execute:
                 with self.monitor('pre_execute', autoflush=True):
@@ -104,6 +108,7 @@ class BaseCalculator(object):
             with self.monitor('export', autoflush=True):
                 exported = self.export()
         finally:
+            parallel.TaskManager.shared_dir = None
             if clean_up:
                 try:
                     self.clean_up()
@@ -171,6 +176,9 @@ class BaseCalculator(object):
         performance = self.monitor.collect_performance()
         if performance is not None:
             self.performance = performance
+        # timing information about the tasks run in adaptive mode
+        for name, task_info in parallel.TaskManager.pop_task_info():
+            self.datastore['task_info/' + name] = task_info
         self.datastore.close()
         self.datastore.symlink(os.path.dirname(self.oqparam.inputs['job_ini']))
 
@@ -396,9 +404,11 @@ class RiskCalculator(HazardCalculator):
                         for i, haz in enumerate(hazards_by_site[indices]):
                             hdata[imt][i][key] = haz
                 # build the riskinputs
+                assetcol = riskinput.AssetCollection(
+                    reduced_assets, self.oqparam.time_event)
                 for imt in hdata:
                     ri = self.riskmodel.build_input(
-                        imt, hdata[imt], reduced_assets, reduced_eps)
+                        imt, hdata[imt], assetcol, reduced_eps)
                     if ri.weight > 0:
                         riskinputs.append(ri)
             logging.info('Built %d risk inputs', len(riskinputs))
@@ -430,20 +440,31 @@ class RiskCalculator(HazardCalculator):
         Require a `.core_func` to be defined with signature
         (riskinputs, riskmodel, rlzs_assoc, monitor).
         """
-        # add fatalities as side effect
-        riskinput.build_asset_collection(
-            self.assets_by_site, self.oqparam.time_event)
         self.monitor.oqparam = self.oqparam
         if self.pre_calculator == 'event_based_rupture':
-            self.monitor.assets_by_site = self.assets_by_site
+            self.monitor.assetcol = riskinput.AssetCollection(
+                self.assets_by_site, self.oqparam.time_event)
             self.monitor.num_assets = self.count_assets()
         res = apply_reduce(
             self.core_func.__func__,
             (self.riskinputs, self.riskmodel, self.rlzs_assoc, self.monitor),
             concurrent_tasks=self.oqparam.concurrent_tasks,
-            weight=get_weight, key=self.riskinput_key)
+            agg=self.agg_result,
+            weight=get_weight, key=self.riskinput_key,
+            task_duration=self.oqparam.task_duration)
         return res
 
+    def agg_result(self, acc, result):
+        """
+        Aggregation function used in .execute, called each time a task
+        returns; by default it simply sums the results.
+
+        :param acc: the accumulator
+        :param result: the result of a task
+        :returns: the updated accumulator
+        """
+        return acc + result
+
 
 # functions useful for the calculators ScenarioDamage and ScenarioRisk
 
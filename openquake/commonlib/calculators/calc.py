@@ -25,8 +25,11 @@ import numpy
 from openquake.hazardlib.imt import from_string
 from openquake.hazardlib.calc import gmf, filters
 from openquake.hazardlib.site import SiteCollection
+from openquake.hazardlib.calc.hazard_curve import zero_curves
+from openquake.risklib import scientific
 from openquake.commonlib.readinput import \
     get_gsims, get_rupture, get_correl_model, get_imts
+from openquake.commonlib.siteindex import SiteIndex
 
 
 MAX_INT = 2 ** 31 - 1  # this is used in the random number generator
@@ -53,10 +56,11 @@ def gen_ruptures(sources, site_coll, maximum_distance, monitor):
     filtsources_mon = monitor('filtering sources')
     genruptures_mon = monitor('generating ruptures')
     filtruptures_mon = monitor('filtering ruptures')
+    index = SiteIndex(site_coll)
     for src in sources:
         with filtsources_mon:
-            s_sites = src.filter_sites_by_distance_to_source(
-                maximum_distance, site_coll)
+            s_sites = index.filter_sites_by_distance_to_source(
+                src, maximum_distance)
             if s_sites is None:
                 continue
 
@@ -67,7 +71,7 @@ def gen_ruptures(sources, site_coll, maximum_distance, monitor):
 
         for rupture in ruptures:
             with filtruptures_mon:
-                r_sites = filters.filter_sites_by_distance_to_rupture(
+                r_sites = index.filter_sites_by_distance_to_rupture(
                     rupture, maximum_distance, s_sites)
                 if r_sites is None:
                     continue
@@ -118,6 +122,12 @@ def calc_gmfs_fast(oqparam, sitecol):
 # cutoff value for the poe
 EPSILON = 1E-30
 
+# number of sites processed at the time by compute_hazard_maps_by_block
+HMAPS_BLOCK_SIZE = 100000
+
+# default number of sites processed at the time by compute_stats
+STATS_BLOCK_SIZE = 10000
+
 
 def compute_hazard_maps(curves, imls, poes):
     """
@@ -135,10 +145,10 @@ def compute_hazard_maps(curves, imls, poes):
         Value(s) on which to interpolate a hazard map from the input
         ``curves``. Can be an array-like or scalar value (for a single PoE).
     :returns:
-        An array of shape P x N, where N is the number of curves and P the
+        An array of shape N x P, where N is the number of curves and P the
         number of poes.
     """
-    curves = numpy.array(curves)
+    curves = numpy.array(curves, float)
     poes = numpy.array(poes)
 
     if len(poes.shape) == 0:
@@ -150,32 +160,60 @@ def compute_hazard_maps(curves, imls, poes):
         # `curves` was passed as 1 dimensional array, there is a single site
         curves = curves.reshape((1,) + curves.shape)  # 1 x L
 
-    result = []
+    num_curves, num_levels = curves.shape
+    result = numpy.zeros((num_curves, len(poes)))
     imls = numpy.log(numpy.array(imls[::-1]))
-
-    for curve in curves:
-        # the hazard curve, having replaced the too small poes with EPSILON
-        curve_cutoff = [max(poe, EPSILON) for poe in curve[::-1]]
-        hmap_val = []
-        for poe in poes:
-            # special case when the interpolation poe is bigger than the
-            # maximum, i.e the iml must be smaller than the minumum
-            if poe > curve_cutoff[-1]:  # the greatest poes in the curve
-                # extrapolate the iml to zero as per
-                # https://bugs.launchpad.net/oq-engine/+bug/1292093
-                # a consequence is that if all poes are zero any poe > 0
-                # is big and the hmap goes automatically to zero
-                hmap_val.append(0)
-            else:
-                # exp-log interpolation, to reduce numerical errors
-                # see https://bugs.launchpad.net/oq-engine/+bug/1252770
-                val = numpy.exp(
-                    numpy.interp(
-                        numpy.log(poe), numpy.log(curve_cutoff), imls))
-                hmap_val.append(val)
-
-        result.append(hmap_val)
-    return numpy.array(result)
+    # the hazard curves, having replaced the too small poes with EPSILON
+    # and taken the logarithm; the rows are in increasing order
+    log_curves = numpy.log(numpy.maximum(curves[:, ::-1], EPSILON))
+    rows = numpy.arange(num_curves)
+    for p, poe in enumerate(poes):
+        # special case when the interpolation poe is bigger than the
+        # maximum, i.e the iml must be smaller than the minumum: the iml
+        # is extrapolated to zero as per
+        # https://bugs.launchpad.net/oq-engine/+bug/1292093
+        # a consequence is that if all poes are zero any poe > 0
+        # is big and the hmap goes automatically to zero
+        ok = poe <= numpy.maximum(curves[:, 0], EPSILON)
+        # exp-log interpolation, to reduce numerical errors
+        # see https://bugs.launchpad.net/oq-engine/+bug/1252770;
+        # this is what numpy.interp does, for all the curves at once
+        log_poe = numpy.log(poe)
+        idx = (log_curves <= log_poe).sum(axis=1) - 1  # left point
+        left = numpy.clip(idx, 0, max(num_levels - 2, 0))
+        right = numpy.minimum(left + 1, num_levels - 1)
+        x0 = log_curves[rows, left]
+        x1 = log_curves[rows, right]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            slope = (imls[right] - imls[left]) / (x1 - x0)
+            vals = slope * (log_poe - x0) + imls[left]
+        vals = numpy.where(idx < 0, imls[0], vals)  # below the first poe
+        vals = numpy.where(idx >= num_levels - 1, imls[-1], vals)
+        result[ok, p] = numpy.exp(vals[ok])
+    return result
+
+
+def compute_hazard_maps_by_block(curves, imtls, poes, hmaps,
+                                 block_size=HMAPS_BLOCK_SIZE):
+    """
+    Compute the hazard maps block by block, without reading all the curves
+    in memory. `curves` and `hmaps` can be in-memory arrays or HDF5
+    datasets: only a block of sites at the time is read and written.
+
+    :param curves: a composite array of N hazard curves
+    :param imtls: ordered dictionary {IMT: intensity measure levels}
+    :param poes: a list of P probabilities of exceedance
+    :param hmaps: a composite array of shape (N, P) to fill
+    :param block_size: the number of sites in each block
+    """
+    num_sites = len(curves)
+    for start in range(0, num_sites, block_size):
+        stop = min(start + block_size, num_sites)
+        block = curves[start:stop]
+        maps = numpy.zeros((stop - start, len(poes)), hmaps.dtype)
+        for imt in imtls:
+            maps[imt] = compute_hazard_maps(block[imt], imtls[imt], poes)
+        hmaps[start:stop] = maps
 
 
 # #########################  GMF->curves #################################### #
@@ -218,6 +256,71 @@ def gmvs_to_haz_curve(gmvs, imls, invest_time, duration):
     return poes
 
 
+def zero_counts(num_sites, imtls):
+    """
+    :param num_sites: the number of sites
+    :param imtls: ordered dictionary {IMT: intensity measure levels}
+    :returns: a composite array of exceedance counts with one uint32
+              field of length L per IMT, all set to zero
+    """
+    counts_dt = numpy.dtype([(imt, (numpy.uint32, (len(imls),)))
+                             for imt, imls in imtls.items()])
+    return numpy.zeros(num_sites, counts_dt)
+
+
+def count_exceedances(counts, sids, gmvs, imls):
+    """
+    Increment in place the exceedance counts of the given sites.
+    A site can appear several times in `sids`, once per rupture,
+    so a full batch of GMFs can be processed with a single call.
+
+    :param counts: an array of shape (N, L) of uint32
+    :param sids: an array of G site indices
+    :param gmvs: an array of G ground motion values
+    :param imls: an ordered sequence of L intensity measure levels
+    """
+    num_sites, num_levels = counts.shape
+    # number of levels exceeded (gmv >= iml) by each ground motion value
+    nexc = numpy.searchsorted(imls, gmvs, side='right')
+    hist = numpy.bincount(
+        numpy.asarray(sids) * (num_levels + 1) + nexc,
+        minlength=num_sites * (num_levels + 1)).reshape(
+        num_sites, num_levels + 1)
+    # the counts for the level l are the values exceeding more than l levels
+    counts += hist[:, :0:-1].cumsum(axis=1)[:, ::-1].astype(numpy.uint32)
+
+
+def agg_counts(acc, counts):
+    """
+    Add the exceedance counts to the accumulator, in place.
+
+    :param acc: a composite array as returned by :func:`zero_counts`
+    :param counts: a composite array of counts with the same dtype
+    :returns: the accumulator
+    """
+    for imt in counts.dtype.names:
+        acc[imt] += counts[imt]
+    return acc
+
+
+def counts_to_curves(counts, invest_time, duration):
+    """
+    Convert the exceedance counts into hazard curves, with the same
+    poissonian formula used in :func:`gmvs_to_haz_curve`.
+
+    :param counts: a composite array as returned by :func:`zero_counts`
+    :param float invest_time: investigation time, in years
+    :param float duration: investigation_time * number of Stochastic Event Sets
+    :returns: a composite array of PoEs with the same shape as `counts`
+    """
+    curves_dt = numpy.dtype([(imt, (float, counts.dtype[imt].shape))
+                             for imt in counts.dtype.names])
+    curves = numpy.zeros(len(counts), curves_dt)
+    for imt in counts.dtype.names:
+        curves[imt] = 1 - numpy.exp(- (invest_time / duration) * counts[imt])
+    return curves
+
+
 # ################## utilities for classical calculators ################ #
 
 def make_uhs(maps):
@@ -239,3 +342,49 @@ def make_uhs(maps):
         if imt.startswith('SA') or imt == 'PGA'))
     hmaps = numpy.array([maps[imt] for imt in sorted_imts])  # I * N * P
     return hmaps.transpose(1, 0, 2)  # N * I * P
+
+
+def compute_stats(gen_curves, num_rlzs, num_sites, imtls, weights,
+                  quantiles, mean=True, block_size=STATS_BLOCK_SIZE):
+    """
+    Compute the mean and quantile curves of R realizations, without
+    keeping all the realizations in memory. The means are updated
+    incrementally, one realization at the time; the quantiles need all
+    the realizations of a site, so they are computed on blocks of sites,
+    sorting along the realization axis; at most R x block_size curves
+    are in memory at the same time.
+
+    :param gen_curves:
+        a function (start, stop) returning an iterator over the R
+        composite arrays of curves for the sites in the slice start:stop
+    :param num_rlzs: the number of realizations R
+    :param num_sites: the number of sites N
+    :param imtls: ordered dictionary {IMT: intensity measure levels}
+    :param weights: a list of R weights, or None for sampling
+    :param quantiles: a list of quantiles
+    :param mean: if False, do not compute the mean curves
+    :param block_size: the number of sites in each block
+    :returns: a pair (mean curves or None, dictionary quantile -> curves)
+    """
+    mean_curves = zero_curves(num_sites, imtls) if mean else None
+    quantile_curves = {q: zero_curves(num_sites, imtls) for q in quantiles}
+    if not mean and not quantiles:
+        return mean_curves, quantile_curves
+    mean_weights = weights or [1. / num_rlzs] * num_rlzs
+    if not quantiles:  # the means can be computed on all sites at once
+        block_size = num_sites
+    for start in range(0, num_sites, block_size):
+        stop = min(start + block_size, num_sites)
+        curves_by_rlz = gen_curves(start, stop)
+        if quantiles:  # all the realizations for the current block
+            curves_by_rlz = list(curves_by_rlz)
+        if mean:
+            for weight, curves in zip(mean_weights, curves_by_rlz):
+                for imt in imtls:
+                    mean_curves[imt][start:stop] += weight * curves[imt]
+        for imt in (imtls if quantiles else ()):
+            arr = numpy.array([curves[imt] for curves in curves_by_rlz])
+            for q, qcurves in quantile_curves.iteritems():
+                qcurves[imt][start:stop] = scientific.quantile_curve(
+                    arr, q, weights).reshape((stop - start, -1))
+    return mean_curves, quantile_curves
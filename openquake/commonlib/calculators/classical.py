@@ -16,19 +16,19 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
-import numpy
+import time
 import logging
 import operator
 import collections
 from functools import partial
 
+import numpy
+
 from openquake.hazardlib.site import SiteCollection
 from openquake.hazardlib.calc.hazard_curve import (
     hazard_curves_per_trt, zero_curves, zero_maps, agg_curves)
-from openquake.hazardlib.calc.filters import source_site_distance_filter, \
-    rupture_site_distance_filter
-from openquake.risklib import scientific
 from openquake.commonlib import parallel, datastore, source
+from openquake.commonlib.siteindex import SiteIndex
 from openquake.baselib.general import AccumDict, split_in_blocks
 
 from openquake.commonlib.calculators import base, calc
@@ -37,6 +37,28 @@ from openquake.commonlib.calculators import base, calc
 HazardCurve = collections.namedtuple('HazardCurve', 'location poes')
 
 
+def timed_source_site_filter(source_site_filter, source_data, num_gsims):
+    """
+    Wrap a source-site filter to measure the time spent by hazardlib on
+    each source, i.e. the time between the moment a source is yielded and
+    the moment the next source is requested.
+
+    :param source_site_filter: a source-site filter
+    :param source_data: a list to populate with `source_data_dt` records
+    :param num_gsims: the number of GSIMs used in the computation
+    """
+    def filter_func(sources_sites):
+        for src, s_sites in source_site_filter(sources_sites):
+            t0 = time.time()
+            yield src, s_sites
+            num_ruptures = (getattr(src, 'num_ruptures', None) or
+                            src.count_ruptures())
+            source_data.append(
+                (src.source_id, src.__class__.__name__, num_ruptures,
+                 len(s_sites), num_gsims, time.time() - t0))
+    return filter_func
+
+
 @parallel.litetask
 def classical(sources, sitecol, gsims_assoc, monitor):
     """
@@ -49,28 +71,37 @@ def classical(sources, sitecol, gsims_assoc, monitor):
     :param monitor:
         a monitor instance
     :returns:
-        an AccumDict rlz -> curves
+        an AccumDict (trt_id, gsim) -> curves, with an attribute
+        `.source_data` containing the timings of the sources
     """
     max_dist = monitor.oqparam.maximum_distance
     truncation_level = monitor.oqparam.truncation_level
     imtls = monitor.oqparam.imtls
     trt_model_id = sources[0].trt_model_id
     gsims = gsims_assoc[trt_model_id]
+    index = SiteIndex(sitecol)
+    source_data = []
     curves_by_gsim = hazard_curves_per_trt(
         sources, sitecol, imtls, gsims, truncation_level,
-        source_site_filter=source_site_distance_filter(max_dist),
-        rupture_site_filter=rupture_site_distance_filter(max_dist),
+        source_site_filter=timed_source_site_filter(
+            index.source_site_filter(max_dist), source_data, len(gsims)),
+        rupture_site_filter=index.rupture_site_filter(max_dist),
         monitor=monitor)
-    return {(trt_model_id, str(gsim)): curves
-            for gsim, curves in zip(gsims, curves_by_gsim)}
+    result = AccumDict({(trt_model_id, str(gsim)): curves
+                        for gsim, curves in zip(gsims, curves_by_gsim)})
+    result.source_data = numpy.array(source_data, source.source_data_dt)
+    return result
 
 
 def agg_dicts(acc, val):
     """
-    Aggregate dictionaries of hazard curves by updating the accumulator
+    Aggregate dictionaries of hazard curves by updating the accumulator;
+    the source timings, if any, are collected in `acc.source_data`
     """
     for key in val:
         acc[key] = agg_curves(acc[key], val[key])
+    if hasattr(val, 'source_data'):
+        acc.source_data.append(val.source_data)
     return acc
 
 
@@ -81,6 +112,7 @@ class ClassicalCalculator(base.HazardCalculator):
     """
     core_func = classical
     curves_by_trt_gsim = datastore.persistent_attribute('curves_by_trt_gsim')
+    source_data = datastore.persistent_attribute('source_data')
 
     def execute(self):
         """
@@ -93,6 +125,7 @@ class ClassicalCalculator(base.HazardCalculator):
         sources = self.composite_source_model.get_sources()
         zc = zero_curves(len(self.sitecol.complete), self.oqparam.imtls)
         zerodict = AccumDict((key, zc) for key in self.rlzs_assoc)
+        zerodict.source_data = []
         gsims_assoc = self.rlzs_assoc.get_gsims_by_trt_id()
         curves_by_trt_gsim = parallel.apply_reduce(
             self.core_func.__func__,
@@ -100,7 +133,8 @@ class ClassicalCalculator(base.HazardCalculator):
             agg=agg_dicts, acc=zerodict,
             concurrent_tasks=self.oqparam.concurrent_tasks,
             weight=operator.attrgetter('weight'),
-            key=operator.attrgetter('trt_model_id'))
+            key=operator.attrgetter('trt_model_id'),
+            task_duration=self.oqparam.task_duration)
         return curves_by_trt_gsim
 
     def post_execute(self, curves_by_trt_gsim):
@@ -111,38 +145,40 @@ class ClassicalCalculator(base.HazardCalculator):
             a dictionary (trt_id, gsim) -> hazard curves
         """
         self.curves_by_trt_gsim = curves_by_trt_gsim
+        if getattr(curves_by_trt_gsim, 'source_data', None):
+            self.source_data = numpy.concatenate(
+                curves_by_trt_gsim.source_data)
         oq = self.oqparam
         zc = zero_curves(len(self.sitecol.complete), oq.imtls)
-        curves_by_rlz = self.rlzs_assoc.combine_curves(
-            curves_by_trt_gsim, agg_curves, zc)
         rlzs = self.rlzs_assoc.realizations
-        nsites = len(self.sitecol)
-        if oq.individual_curves:
-            for rlz, curves in curves_by_rlz.iteritems():
-                self.store_curves('rlz-%d' % rlz.ordinal, curves)
+        if oq.individual_curves or len(rlzs) == 1:
+            for rlz, curves in self.rlzs_assoc.gen_curves_by_rlz(
+                    curves_by_trt_gsim, agg_curves, zc):
+                if oq.individual_curves:
+                    self.store_curves('rlz-%d' % rlz.ordinal, curves)
+                if len(rlzs) == 1:
+                    self.mean_curves = curves
 
         if len(rlzs) == 1:  # cannot compute statistics
-            [self.mean_curves] = curves_by_rlz.values()
             return
 
+        def gen_curves(start, stop):
+            # yield the curves of each realization for the sites start:stop
+            results = {key: curves[start:stop]
+                       for key, curves in curves_by_trt_gsim.iteritems()}
+            for rlz, curves in self.rlzs_assoc.gen_curves_by_rlz(
+                    results, agg_curves, zc[start:stop]):
+                yield curves
+
         weights = (None if oq.number_of_logic_tree_samples
                    else [rlz.weight for rlz in rlzs])
-        mean = oq.mean_hazard_curves
-        if mean:
-            self.mean_curves = numpy.array(zc)
-            for imt in oq.imtls:
-                self.mean_curves[imt] = scientific.mean_curve(
-                    [curves_by_rlz[rlz][imt] for rlz in rlzs], weights)
-
-        self.quantile = {}
-        for q in oq.quantile_hazard_curves:
-            self.quantile[q] = qc = numpy.array(zc)
-            for imt in oq.imtls:
-                curves = [curves_by_rlz[rlz][imt] for rlz in rlzs]
-                qc[imt] = scientific.quantile_curve(
-                    curves, q, weights).reshape((nsites, -1))
-
-        if mean:
+        mean_curves, self.quantile = calc.compute_stats(
+            gen_curves, len(rlzs), len(zc), oq.imtls, weights,
+            oq.quantile_hazard_curves, oq.mean_hazard_curves,
+            oq.statistics_block_size)
+
+        if oq.mean_hazard_curves:
+            self.mean_curves = mean_curves
             self.store_curves('mean', self.mean_curves)
         for q in self.quantile:
             self.store_curves('quantile-%s' % q, self.quantile[q])
@@ -169,15 +205,22 @@ class ClassicalCalculator(base.HazardCalculator):
             return
         oq = self.oqparam
         h5 = self.datastore.hdf5
-        h5['hcurves/' + dset] = curves
-        if oq.hazard_maps or oq.uniform_hazard_spectra:
-            # hmaps is a composite array of shape (N, P)
-            hmaps = self.hazard_maps(curves)
-            if oq.hazard_maps:
-                h5['hmaps/' + dset] = hmaps
-            if oq.uniform_hazard_spectra:
-                # uhs is an array of shape (N, I, P)
-                self.datastore.hdf5['uhs/' + dset] = calc.make_uhs(hmaps)
+        self.datastore['hcurves/' + dset] = curves
+        if oq.hazard_maps:
+            # hmaps is a composite dataset of shape (N, P), computed
+            # block by block from the curves stored in the datastore
+            maps_dt = zero_maps((1, len(oq.poes)), oq.imtls).dtype
+            shape = (len(curves), len(oq.poes))
+            hmaps = h5.create_dataset(
+                'hmaps/' + dset, shape, maps_dt, **datastore.storage_options(
+                    self.datastore.get_storage('hmaps'), shape))
+            calc.compute_hazard_maps_by_block(
+                h5['hcurves/' + dset], oq.imtls, oq.poes, hmaps)
+        if oq.uniform_hazard_spectra:
+            hmaps = (h5['hmaps/' + dset][:] if oq.hazard_maps
+                     else self.hazard_maps(curves))
+            # uhs is an array of shape (N, I, P)
+            self.datastore.hdf5['uhs/' + dset] = calc.make_uhs(hmaps)
 
 
 def is_effective_trt_model(result_dict, trt_model):
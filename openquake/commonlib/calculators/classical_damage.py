@@ -38,7 +38,7 @@ def classical_damage(riskinputs, riskmodel, rlzs_assoc, monitor):
     :param monitor:
         :class:`openquake.commonlib.parallel.PerformanceMonitor` instance
     :returns:
-        a nested dictionary rlz_idx -> asset -> <damage array>
+        a nested dictionary rlz_idx -> asset_ref -> <damage array>
     """
     logging.info('Process %d, considering %d risk input(s) of weight %d',
                  os.getpid(), len(riskinputs),
@@ -48,7 +48,9 @@ def classical_damage(riskinputs, riskmodel, rlzs_assoc, monitor):
         for out_by_rlz in riskmodel.gen_outputs(
                 riskinputs, rlzs_assoc, monitor):
             for out in out_by_rlz:
-                result[out.hid] += dict(zip(out.assets, out.damages))
+                result[out.hid] += dict(
+                    (asset.id, damages)
+                    for asset, damages in zip(out.assets, out.damages))
     return result
 
 
@@ -88,6 +90,6 @@ class ClassicalDamageCalculator(base.RiskCalculator):
         Export the result in CSV format.
 
         :param result:
-            a dictionary asset -> fractions per damage state
+            a dictionary asset_ref -> fractions per damage state
         """
         self.damages_by_rlz = result
@@ -16,13 +16,334 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
-from openquake.commonlib.calculators import base
+import logging
+import operator
+
+import numpy
+import scipy.stats
+
+from openquake.hazardlib import const
+from openquake.hazardlib.imt import from_string
+from openquake.hazardlib.calc.hazard_curve import zero_curves, agg_curves
+from openquake.baselib.general import AccumDict, split_in_blocks
+from openquake.commonlib import parallel, datastore
+from openquake.commonlib.calculators import base, calc
+from openquake.commonlib.calculators.classical import ClassicalCalculator
+
+# the marginal disaggregation matrices which are computed, as
+# names built with the labels used by the DisaggXMLWriter
+DISAGG_KINDS = ['Mag', 'Dist', 'TRT', 'Mag_Dist', 'Mag_Dist_Eps',
+                'Lon_Lat', 'Mag_Lon_Lat', 'Lon_Lat_TRT']
+
+# minimum probability of no exceedance, to avoid taking log(0)
+MIN_PNE = 1E-300
+
+KM_PER_DEGREE = 111.2  # kilometers in a degree of latitude
+
+# maximum number of sites per task, since the matrices of each task
+# have shape (num_sites, num_imts, num_poes, ...) for each realization
+SITES_PER_BLOCK = 20
+
+
+class BinEdges(object):
+    """
+    Container for the edges of the disaggregation bins, which are
+    determined before starting the computation, so that the
+    ruptures can be binned while they are generated. The magnitude,
+    distance, epsilon and tectonic region type bins are the same for
+    all sites; the longitude and latitude bins are centered on each
+    site and cover a square of half-side `maximum_distance`;
+    the points outside are assigned to the bins on the border.
+
+    :param mags: magnitude bin edges
+    :param dists: distance bin edges
+    :param eps: epsilon bin edges
+    :param trts: sorted list of tectonic region types
+    :param sitecol: the complete site collection
+    :param maxdist: the maximum distance (in km)
+    :param width: the coordinate bin width (in degrees)
+    """
+    kinds = DISAGG_KINDS
+
+    def __init__(self, mags, dists, eps, trts, sitecol, maxdist, width):
+        self.mags = mags
+        self.dists = dists
+        self.eps = eps
+        self.trts = trts
+        self.width = width
+        dlat = maxdist / KM_PER_DEGREE
+        cos = numpy.maximum(numpy.cos(numpy.radians(sitecol.lats)), 1E-3)
+        dlon = dlat / cos
+        self.n_lats = 2 * int(numpy.ceil(dlat / width))
+        self.n_lons = 2 * int(numpy.ceil(dlon.max() / width))
+        # longitudes and latitudes of the lower left corners of the bins
+        self.lon0 = sitecol.lons - self.n_lons / 2 * width
+        self.lat0 = sitecol.lats - self.n_lats / 2 * width
+
+    @classmethod
+    def build(cls, oqparam, csm, sitecol):
+        """
+        :param oqparam: an OqParam instance
+        :param csm: a CompositeSourceModel instance
+        :param sitecol: the complete site collection
+        :returns: a BinEdges instance
+        """
+        min_mag, max_mag = numpy.inf, -numpy.inf
+        for src in csm.get_sources():
+            mmin, mmax = src.get_min_max_mag()
+            min_mag = min(min_mag, mmin)
+            max_mag = max(max_mag, mmax)
+        mw = oqparam.mag_bin_width
+        mags = mw * numpy.arange(int(numpy.floor(min_mag / mw)),
+                                 int(numpy.ceil(max_mag / mw) + 1))
+        dw = oqparam.distance_bin_width
+        dists = dw * numpy.arange(
+            0, int(numpy.ceil(oqparam.maximum_distance / dw) + 1))
+        tl = oqparam.truncation_level
+        eps = numpy.linspace(-tl, tl, oqparam.num_epsilon_bins + 1)
+        trts = sorted(set(tm.trt for tm in csm.trt_models))
+        return cls(mags, dists, eps, trts, sitecol,
+                   oqparam.maximum_distance, oqparam.coordinate_bin_width)
+
+    @property
+    def shape(self):
+        """The number of bins for Mag, Dist, Lon, Lat, Eps, TRT"""
+        return (len(self.mags) - 1, len(self.dists) - 1, self.n_lons,
+                self.n_lats, len(self.eps) - 1, len(self.trts))
+
+    def get_lon_lat_edges(self, sid):
+        """
+        :param sid: a site ID
+        :returns: the longitude and latitude bin edges for the given site
+        """
+        lons = self.lon0[sid] + self.width * numpy.arange(self.n_lons + 1)
+        lats = self.lat0[sid] + self.width * numpy.arange(self.n_lats + 1)
+        return lons, lats
+
+    def get_dims(self, kind):
+        """
+        :param kind: a kind of disaggregation matrix, like 'Mag_Dist'
+        :returns: the number of bins for each dimension of the matrix
+        """
+        idx = dict(Mag=0, Dist=1, Lon=2, Lat=3, Eps=4, TRT=5)
+        return tuple(self.shape[idx[label]] for label in kind.split('_'))
+
+    def zero_matrices(self, num_sites, num_imts, num_poes):
+        """
+        :returns: a dictionary kind -> zero array of shape (N, I, P, ...)
+        """
+        return {kind: numpy.zeros((num_sites, num_imts, num_poes) +
+                                  self.get_dims(kind), numpy.float32)
+                for kind in DISAGG_KINDS}
+
+
+def _bin_index(values, edges):
+    # index of the bin containing each value; the values outside
+    # are assigned to the first or last bin
+    return numpy.clip(numpy.searchsorted(edges, values, 'right') - 1,
+                      0, len(edges) - 2)
+
+
+@parallel.litetask
+def disaggregation(sources, sitecol, gsims_assoc, imls_by_rlz, bin_edges,
+                   monitor):
+    """
+    Compute the disaggregation matrices for a block of sites and all the
+    realizations associated to the given sources, by generating each
+    rupture only once.
+
+    :param sources:
+        a non-empty sequence of sources of homogeneous tectonic region type
+    :param sitecol:
+        a SiteCollection instance with the n sites of the block
+    :param gsims_assoc:
+        associations trt_model_id -> gsims
+    :param imls_by_rlz:
+        a dictionary rlz.ordinal -> array of shape (n, I, P) with the
+        intensity levels to disaggregate for the sites of the block,
+        obtained from the hazard curves
+    :param bin_edges:
+        a :class:`BinEdges` instance
+    :param monitor:
+        a monitor instance
+    :returns:
+        an AccumDict rlz.ordinal -> kind -> array of shape (n, I, P, ...)
+        containing the logarithms of the probabilities of no exceedance;
+        the attribute .sids contains the IDs of the sites of the block
+    """
+    oq = monitor.oqparam
+    rlzs_assoc = monitor.rlzs_assoc
+    imts = map(from_string, sorted(oq.imtls))
+    trt_model_id = sources[0].trt_model_id
+    trt_idx = bin_edges.trts.index(sources[0].tectonic_region_type)
+    gsims = gsims_assoc[trt_model_id]
+    rlzs_by_gsim = {gsim: rlzs_assoc[trt_model_id, str(gsim)]
+                    for gsim in gsims}
+    I = len(imts)
+    P = len(oq.poes_disagg)
+    acc = AccumDict()
+    acc.sids = sitecol.sids
+    for rlzs in rlzs_by_gsim.itervalues():
+        for rlz in rlzs:
+            acc[rlz.ordinal] = bin_edges.zero_matrices(len(sitecol), I, P)
+    distribution = scipy.stats.truncnorm(
+        -oq.truncation_level, oq.truncation_level)
+    eps_cdf = distribution.cdf(bin_edges.eps)
+    binning_mon = monitor('binning ruptures', autoflush=False)
+    for src, rupture, r_sites in calc.gen_ruptures(
+            sources, sitecol, oq.maximum_distance, monitor):
+        with binning_mon:
+            sids = r_sites.sids
+            idxs = numpy.searchsorted(acc.sids, sids)  # indices in the block
+            mag = _bin_index(rupture.mag, bin_edges.mags)
+            dist = _bin_index(rupture.surface.get_joyner_boore_distance(
+                r_sites.mesh), bin_edges.dists)
+            closest = rupture.surface.get_closest_points(r_sites.mesh)
+            # managing the international date line
+            dlons = (closest.lons - bin_edges.lon0[sids] + 180) % 360 - 180
+            dlats = closest.lats - bin_edges.lat0[sids]
+            lon = numpy.clip(numpy.floor(dlons / bin_edges.width).astype(int),
+                             0, bin_edges.n_lons - 1)
+            lat = numpy.clip(numpy.floor(dlats / bin_edges.width).astype(int),
+                             0, bin_edges.n_lats - 1)
+            for gsim in gsims:
+                sctx, rctx, dctx = gsim.make_contexts(r_sites, rupture)
+                for i, imt in enumerate(imts):
+                    mean, [stddev] = gsim.get_mean_and_stddevs(
+                        sctx, rctx, dctx, imt, [const.StdDev.TOTAL])
+                    for rlz in rlzs_by_gsim[gsim]:
+                        imls = imls_by_rlz[rlz.ordinal][idxs, i]  # (n, P)
+                        with numpy.errstate(divide='ignore'):
+                            z = ((numpy.log(imls) - mean[:, None]) /
+                                 stddev[:, None])
+                        # probability of exceedance in each epsilon bin,
+                        # an array of shape (n, P, E)
+                        zc = numpy.clip(z[:, :, None], bin_edges.eps[:-1],
+                                        bin_edges.eps[1:])
+                        poes = eps_cdf[1:] - distribution.cdf(zc)
+                        poes[imls <= 0] = 0  # no disaggregation
+                        lnpne = numpy.log(numpy.maximum(
+                            rupture.get_probability_no_exceedance(poes),
+                            MIN_PNE))
+                        _update(acc[rlz.ordinal], idxs, i, mag, dist,
+                                lon, lat, trt_idx, lnpne)
+    binning_mon.flush()
+    return acc
+
+
+def _update(mats, idxs, i, mag, dist, lon, lat, trt, lnpne):
+    # update the disaggregation matrices with the contributions of a rupture
+    # affecting the sites with indices `idxs` in the block; lnpne has shape
+    # (n, P, E); the pairs (idx, bin) are unique, so that fancy indexing
+    # can be used
+    lnpne_sum = lnpne.sum(axis=2)  # shape (n, P)
+    mats['Mag'][idxs, i, :, mag] += lnpne_sum
+    mats['Dist'][idxs, i, :, dist] += lnpne_sum
+    mats['TRT'][idxs, i, :, trt] += lnpne_sum
+    mats['Mag_Dist'][idxs, i, :, mag, dist] += lnpne_sum
+    mats['Mag_Dist_Eps'][idxs, i, :, mag, dist] += lnpne
+    mats['Lon_Lat'][idxs, i, :, lon, lat] += lnpne_sum
+    mats['Mag_Lon_Lat'][idxs, i, :, mag, lon, lat] += lnpne_sum
+    mats['Lon_Lat_TRT'][idxs, i, :, lon, lat, trt] += lnpne_sum
+
+
+def agg_matrices(acc, val):
+    """
+    :param acc: a dictionary rlz.ordinal -> kind -> array (N, I, P, ...)
+    :param val: an AccumDict rlz.ordinal -> kind -> array (n, I, P, ...)
+                for the sites of a block, with attribute .sids
+
+    Works by side effect, by updating the accumulator.
+    """
+    for rlz_ordinal, mats in val.iteritems():
+        for kind, mat in mats.iteritems():
+            acc[rlz_ordinal][kind][val.sids] += mat
+    return acc
 
 
 @base.calculators.add('disaggregation')
-class DisaggregationCalculator(base.HazardCalculator):
+class DisaggregationCalculator(ClassicalCalculator):
     """
     Classical disaggregation PSHA calculator
     """
+    bin_edges = datastore.persistent_attribute('disagg_bin_edges')
+
+    def execute(self):
+        """
+        Run the classical calculator to compute the hazard curves, then
+        run in parallel `disaggregation(sources, sitecol, ...)` for the
+        intensity levels corresponding to the poes_disagg. There is a
+        task for each block of sources and each block of sites, so that
+        each task allocates the matrices of its sites only.
+        """
+        curves_by_trt_gsim = super(DisaggregationCalculator, self).execute()
+        oq = self.oqparam
+        if not oq.poes_disagg:
+            logging.warn('There are no poes_disagg, nothing to disaggregate')
+            return curves_by_trt_gsim, {}
+        sitecol = self.sitecol.complete
+        zc = zero_curves(len(sitecol), oq.imtls)
+        curves_by_rlz = self.rlzs_assoc.combine_curves(
+            curves_by_trt_gsim, agg_curves, zc)
+        imls_by_rlz = {}
+        for rlz, curves in curves_by_rlz.iteritems():
+            imls_by_rlz[rlz.ordinal] = numpy.array(  # shape (N, I, P)
+                [calc.compute_hazard_maps(curves[imt], oq.imtls[imt],
+                                          oq.poes_disagg)
+                 for imt in sorted(oq.imtls)]).transpose(1, 0, 2)
+        self.imls_by_rlz = imls_by_rlz
+        self.bin_edges = bin_edges = BinEdges.build(
+            oq, self.composite_source_model, sitecol)
+        logging.info('Disaggregation bins (Mag, Dist, Lon, Lat, Eps, TRT): '
+                     '%s', bin_edges.shape)
+
+        monitor = self.monitor(disaggregation.__name__)
+        monitor.oqparam = oq
+        monitor.rlzs_assoc = self.rlzs_assoc
+        sources = self.composite_source_model.get_sources()
+        gsims_assoc = self.rlzs_assoc.get_gsims_by_trt_id()
+        num_sites = len(self.sitecol)
+        num_blocks = int(numpy.ceil(num_sites / float(SITES_PER_BLOCK)))
+        chunks = list(split_in_blocks(
+            sources, max((oq.concurrent_tasks or 1) // num_blocks, 1),
+            weight=operator.attrgetter('weight'),
+            key=operator.attrgetter('trt_model_id')))
+        all_args = []
+        for start in range(0, num_sites, SITES_PER_BLOCK):
+            mask = numpy.zeros(num_sites, bool)
+            mask[start:start + SITES_PER_BLOCK] = True
+            block = self.sitecol.filter(mask)
+            # the intensity levels of the sites in the block, shape (n, I, P)
+            block_imls = {ordinal: imls[block.sids]
+                          for ordinal, imls in imls_by_rlz.iteritems()}
+            for chunk in chunks:
+                all_args.append((chunk, block, gsims_assoc, block_imls,
+                                 bin_edges, monitor))
+        N = len(sitecol)
+        I = len(oq.imtls)
+        P = len(oq.poes_disagg)
+        acc = {rlz.ordinal: bin_edges.zero_matrices(N, I, P)
+               for rlz in self.rlzs_assoc.realizations}
+        matrices = parallel.starmap(disaggregation, all_args).reduce(
+            agg_matrices, acc)
+        return curves_by_trt_gsim, matrices
+
     def post_execute(self, result):
-        return {}
+        """
+        Store the hazard curves and the disaggregation matrices.
+
+        :param result:
+            a pair (curves_by_trt_gsim, matrices) where matrices is
+            a dictionary rlz.ordinal -> kind -> array of logarithms of the
+            probabilities of no exceedance
+        """
+        curves_by_trt_gsim, matrices = result
+        super(DisaggregationCalculator, self).post_execute(curves_by_trt_gsim)
+        rlzs = self.rlzs_assoc.realizations
+        for rlz_ordinal, mats in sorted(matrices.iteritems()):
+            rlz = rlzs[rlz_ordinal]
+            key = 'disagg/%s/' % rlz.uid
+            self.datastore[key + 'imls'] = self.imls_by_rlz[rlz_ordinal]
+            for kind, lnpne in mats.iteritems():
+                # the probabilities of exceedance, shape (N, I, P, ...)
+                self.datastore[key + kind] = -numpy.expm1(lnpne)
@@ -117,11 +117,16 @@ class EventBasedRiskCalculator(base.RiskCalculator):
         rup_by_tag = sum(self.datastore['sescollection'], AccumDict())
         all_ruptures = [rup_by_tag[tag] for tag in sorted(rup_by_tag)]
         num_samples = min(len(all_ruptures), epsilon_sampling)
-        eps_dict = riskinput.make_eps_dict(
-            assets_by_site, num_samples, oq.master_seed, oq.asset_correlation)
-        logging.info('Generated %d epsilons', num_samples * len(eps_dict))
-        self.epsilon_matrix = numpy.array(
-            [eps_dict[a['asset_ref']] for a in self.assetcol])
+        if oq.lazy_epsilons:  # generated in the workers, block by block
+            eps_dict = riskinput.EpsilonGetter(
+                oq.master_seed, oq.asset_correlation, num_samples)
+        else:
+            eps_dict = riskinput.make_eps_dict(
+                assets_by_site, num_samples, oq.master_seed,
+                oq.asset_correlation)
+            logging.info('Generated %d epsilons', num_samples * len(eps_dict))
+            self.epsilon_matrix = numpy.array(
+                [eps_dict[a['asset_ref']] for a in self.assetcol])
         self.riskinputs = list(self.riskmodel.build_inputs_from_ruptures(
             self.sitecol.complete, all_ruptures, gsims_by_col,
             oq.truncation_level, correl_model, eps_dict,
@@ -152,7 +157,8 @@ class EventBasedRiskCalculator(base.RiskCalculator):
         # ugly: attaching an attribute needed in the task function
         self.monitor.num_outputs = 2 if oq.insured_losses else 1
         # attaching two other attributes used in riskinput.gen_outputs
-        self.monitor.assets_by_site = self.assets_by_site
+        self.monitor.assetcol = riskinput.AssetCollection(
+            self.assets_by_site, oq.time_event)
         self.monitor.num_assets = self.count_assets()
         return apply_reduce(
             self.core_func.__func__,
@@ -161,7 +167,8 @@ class EventBasedRiskCalculator(base.RiskCalculator):
             agg=self.agg,
             acc=cube(self.monitor.num_outputs, self.L, self.R, list),
             weight=operator.attrgetter('weight'),
-            key=operator.attrgetter('col_id'))
+            key=operator.attrgetter('col_id'),
+            task_duration=oq.task_duration)
 
     def agg(self, acc, losses):
         """
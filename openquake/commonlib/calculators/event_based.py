@@ -26,18 +26,16 @@ import collections
 import numpy
 
 from openquake.baselib.general import AccumDict, groupby, humansize
-from openquake.hazardlib.calc.filters import \
-    filter_sites_by_distance_to_rupture
-from openquake.hazardlib.calc.hazard_curve import zero_curves
 from openquake.hazardlib import geo, site, calc
 from openquake.hazardlib.gsim.base import gsim_imt_dt
 from openquake.commonlib import readinput, parallel, datastore
 from openquake.commonlib.util import max_rel_diff_index
+from openquake.commonlib.siteindex import SiteIndex
 
 from openquake.commonlib.calculators import base
-from openquake.commonlib.calculators.calc import MAX_INT, gmvs_to_haz_curve
-from openquake.commonlib.calculators.classical import (
-    ClassicalCalculator, agg_dicts)
+from openquake.commonlib.calculators.calc import (
+    MAX_INT, zero_counts, count_exceedances, agg_counts, counts_to_curves)
+from openquake.commonlib.calculators.classical import ClassicalCalculator
 
 # ######################## rupture calculator ############################ #
 
@@ -289,11 +287,12 @@ def compute_ruptures(sources, sitecol, info, monitor):
     trt_model_id = sources[0].trt_model_id
     oq = monitor.oqparam
     sesruptures = []
+    index = SiteIndex(sitecol)
 
     # Compute and save stochastic event sets
     for src in sources:
-        s_sites = src.filter_sites_by_distance_to_source(
-            oq.maximum_distance, sitecol)
+        s_sites = index.filter_sites_by_distance_to_source(
+            src, oq.maximum_distance)
         if s_sites is None:
             continue
 
@@ -304,7 +303,7 @@ def compute_ruptures(sources, sitecol, info, monitor):
         # to call sample_ruptures *before* the filtering
 
         for rup, rups in build_ses_ruptures(
-                src, num_occ_by_rup, s_sites, oq.maximum_distance, sitecol):
+                src, num_occ_by_rup, s_sites, oq.maximum_distance, index):
             sesruptures.extend(rups)
 
     return {trt_model_id: sesruptures}
@@ -341,15 +340,20 @@ def sample_ruptures(src, num_ses, info):
 
 
 def build_ses_ruptures(
-        src, num_occ_by_rup, s_sites, maximum_distance, sitecol):
+        src, num_occ_by_rup, s_sites, maximum_distance, index):
     """
     Filter the ruptures stored in the dictionary num_occ_by_rup and
     yield pairs (rupture, <list of associated SESRuptures>)
+
+    :param index:
+        a :class:`openquake.commonlib.siteindex.SiteIndex` instance
+        over the site collection of the task
     """
+    sitecol = index.sitecol
     rnd = random.Random(src.seed)
     for rup in sorted(num_occ_by_rup, key=operator.attrgetter('rup_no')):
         # filtering ruptures
-        r_sites = filter_sites_by_distance_to_rupture(
+        r_sites = index.filter_sites_by_distance_to_rupture(
             rup, maximum_distance, s_sites)
         if r_sites is None:
             # ignore ruptures which are far away
@@ -409,7 +413,8 @@ class EventBasedRuptureCalculator(base.HazardCalculator):
             (sources, self.sitecol, csm.info, monitor),
             concurrent_tasks=self.oqparam.concurrent_tasks,
             weight=operator.attrgetter('weight'),
-            key=operator.attrgetter('trt_model_id'))
+            key=operator.attrgetter('trt_model_id'),
+            task_duration=self.oqparam.task_duration)
 
         logging.info('Generated %d SESRuptures',
                      sum(len(v) for v in ruptures_by_trt.itervalues()))
@@ -515,48 +520,26 @@ def compute_gmfs_and_curves(ses_ruptures, sitecol, rlzs_assoc, monitor):
     num_sites = len(sitecol)
     gmfs = make_gmfs(ses_ruptures, sitecol, oq.imtls, gsims,
                      trunc_level, correl_model, monitor)
-    result = {(trt_id, col_id): numpy.concatenate(gmfs)
-              if oq.ground_motion_fields else None}
+    gmfa = numpy.concatenate(gmfs)
+    result = {(trt_id, col_id): gmfa if oq.ground_motion_fields else None}
     if oq.hazard_curves_from_gmfs:
         with monitor('bulding hazard curves', measuremem=False) as mon:
-            duration = oq.investigation_time * oq.ses_per_logic_tree_path * (
-                oq.number_of_logic_tree_samples or 1)
-            # collect the gmvs by site
-            gmvs_by_sid = collections.defaultdict(list)
-            for sr, gmf in zip(ses_ruptures, gmfs):
-                site_ids = get_site_ids(sr, num_sites)
-                for sid, gmv in zip(site_ids, gmf):
-                    gmvs_by_sid[sid].append(gmv)
-            # build the hazard curves for each GSIM
+            # the site indices of the gmvs, for the whole batch of ruptures
+            sids = numpy.concatenate(
+                [get_site_ids(sr, num_sites) for sr in ses_ruptures])
+            # count the exceedances for each GSIM; the counts are summed
+            # across the tasks and converted into hazard curves at the end
             for gsim in gsims:
                 gs = str(gsim)
-                result[trt_id, gs] = to_haz_curves(
-                    tot_sites, gmvs_by_sid, gs, oq.imtls,
-                    oq.investigation_time, duration)
+                counts = zero_counts(tot_sites, oq.imtls)
+                for imt in oq.imtls:
+                    count_exceedances(counts[imt], sids, gmfa[gs][imt],
+                                      oq.imtls[imt])
+                result[trt_id, gs] = counts
         mon.flush()
     return result
 
 
-def to_haz_curves(num_sites, gmvs_by_sid, gs, imtls,
-                  investigation_time, duration):
-    """
-    :param num_sites: length of the full site collection
-    :param gmvs_by_sid: dictionary site_id -> gmvs
-    :param gs: GSIM string
-    :param imtls: ordered dictionary {IMT: intensity measure levels}
-    :param investigation_time: investigation time
-    :param duration: investigation_time * number of Stochastic Event Sets
-    """
-    curves = zero_curves(num_sites, imtls)
-    for imt in imtls:
-        curves[imt] = numpy.array([
-            gmvs_to_haz_curve(
-                [gmv[gs][imt] for gmv in gmvs_by_sid[sid]],
-                imtls[imt], investigation_time, duration)
-            for sid in range(num_sites)])
-    return curves
-
-
 @base.calculators.add('event_based')
 class EventBasedCalculator(ClassicalCalculator):
     """
@@ -586,13 +569,13 @@ class EventBasedCalculator(ClassicalCalculator):
 
     def combine_curves_and_save_gmfs(self, acc, res):
         """
-        Combine the hazard curves (if any) and save the gmfs (if any)
+        Sum the exceedance counts (if any) and save the gmfs (if any)
         sequentially; notice that the gmfs may come from
         different tasks in any order.
 
-        :param acc: an accumulator for the hazard curves
-        :param res: a dictionary trt_id, gsim -> gmf_array or curves_by_imt
-        :returns: a new accumulator
+        :param acc: an accumulator for the exceedance counts
+        :param res: a dictionary trt_id, gsim -> gmf_array or counts_by_imt
+        :returns: the updated accumulator
         """
         sav_mon = self.monitor('saving gmfs')
         agg_mon = self.monitor('aggregating hcurves')
@@ -606,11 +589,10 @@ class EventBasedCalculator(ClassicalCalculator):
                     dataset.extend(gmfa)
                     self.nbytes += gmfa.nbytes
                     self.datastore.hdf5.flush()
-            elif isinstance(gsim_or_col, str):  # aggregate hcurves
+            elif isinstance(gsim_or_col, str):  # aggregate counts
                 with agg_mon:
-                    curves_by_imt = res[trt_id, gsim_or_col]
-                    acc = agg_dicts(
-                        acc, AccumDict({(trt_id, gsim_or_col): curves_by_imt}))
+                    key = trt_id, gsim_or_col
+                    agg_counts(acc[key], res[key])
         sav_mon.flush()
         agg_mon.flush()
         return acc
@@ -626,15 +608,18 @@ class EventBasedCalculator(ClassicalCalculator):
             return
         monitor = self.monitor(self.core_func.__name__)
         monitor.oqparam = oq
-        zc = zero_curves(len(self.sitecol.complete), self.oqparam.imtls)
-        zerodict = AccumDict((key, zc) for key in self.rlzs_assoc)
+        num_sites = len(self.sitecol.complete)
+        # the counts are updated in place, so each key needs its own array
+        zerodict = AccumDict((key, zero_counts(num_sites, oq.imtls))
+                             for key in self.rlzs_assoc)
         self.nbytes = 0
-        curves_by_trt_gsim = parallel.apply_reduce(
+        counts_by_trt_gsim = parallel.apply_reduce(
             self.core_func.__func__,
             (self.sesruptures, self.sitecol, self.rlzs_assoc, monitor),
             concurrent_tasks=self.oqparam.concurrent_tasks,
             acc=zerodict, agg=self.combine_curves_and_save_gmfs,
-            key=operator.attrgetter('col_id'))
+            key=operator.attrgetter('col_id'),
+            task_duration=oq.task_duration)
         if oq.ground_motion_fields:
             # sanity check on the saved gmfs size
             expected_nbytes = self.datastore[
@@ -642,7 +627,11 @@ class EventBasedCalculator(ClassicalCalculator):
             self.datastore['gmfs'].attrs['nbytes'] = self.nbytes
             assert self.nbytes == expected_nbytes, (
                 self.nbytes, expected_nbytes)
-        return curves_by_trt_gsim
+        duration = oq.investigation_time * oq.ses_per_logic_tree_path * (
+            oq.number_of_logic_tree_samples or 1)
+        return AccumDict(
+            (key, counts_to_curves(counts, oq.investigation_time, duration))
+            for key, counts in counts_by_trt_gsim.iteritems())
 
     def post_execute(self, result):
         """
@@ -22,12 +22,59 @@ import collections
 
 import numpy
 
-from openquake.baselib.general import AccumDict, groupby
+from openquake.baselib.general import AccumDict, groupby, humansize
 from openquake.commonlib.calculators import base
 from openquake.commonlib import readinput, parallel, datastore
 from openquake.risklib import riskinput, scientific
 
 
+# rows of the asset event loss table: rup_id is the index of the rupture
+# in the list of all ruptures sorted by tag and ass_id is the index of
+# the asset in the list of sorted assets
+ela_dt = numpy.dtype([('rup_id', numpy.uint32), ('ass_id', numpy.uint32),
+                      ('loss', numpy.float32), ('ins_loss', numpy.float32)])
+
+# number of rows of the asset event loss table read at once
+BLOCK_SIZE = 1000000
+
+
+def asset_loss_table(riskinputs, riskmodel, rlzs_assoc, monitor):
+    """
+    :param riskinputs:
+        a list of :class:`openquake.risklib.riskinput.RiskInput` objects
+    :param riskmodel:
+        a :class:`openquake.risklib.riskinput.RiskModel` instance
+    :param rlzs_assoc:
+        a class:`openquake.commonlib.source.RlzsAssoc` instance
+    :param monitor:
+        :class:`openquake.commonlib.parallel.PerformanceMonitor` instance
+    :returns:
+        a numpy array of shape (L, R); each element is a list containing
+        a single array of dtype ela_dt with the nonzero losses, or an
+        empty list
+    """
+    lt_idx = {lt: lti for lti, lt in enumerate(riskmodel.get_loss_types())}
+    ass_idx = {asset_ref: i for i, asset_ref in enumerate(
+        sorted(monitor.assetcol.asset_refs))}
+    tables = numpy.zeros((len(lt_idx), len(rlzs_assoc.realizations)), object)
+    for idx, _ in numpy.ndenumerate(tables):
+        tables[idx] = []
+    for out_by_rlz in riskmodel.gen_outputs(riskinputs, rlzs_assoc, monitor):
+        start = out_by_rlz.rup_slice.start
+        for out in out_by_rlz:
+            indices = numpy.array([ass_idx[asset.id] for asset in out.assets])
+            rups, asss = out.event_loss_per_asset.nonzero()
+            table = numpy.zeros(len(rups), ela_dt)
+            table['rup_id'] = start + rups
+            table['ass_id'] = indices[asss]
+            table['loss'] = out.event_loss_per_asset[rups, asss]
+            table['ins_loss'] = out.insured_loss_per_asset[rups, asss]
+            tables[lt_idx[out.loss_type], out.hid].append(table)
+    for idx, arrays in numpy.ndenumerate(tables):
+        tables[idx] = [numpy.concatenate(arrays)] if arrays else []
+    return tables
+
+
 @parallel.litetask
 def event_based_risk(riskinputs, riskmodel, rlzs_assoc, monitor):
     """
@@ -40,12 +87,15 @@ def event_based_risk(riskinputs, riskmodel, rlzs_assoc, monitor):
     :param monitor:
         :class:`openquake.commonlib.parallel.PerformanceMonitor` instance
     :returns:
-        a dictionary rlz.ordinal -> (loss_type, tag) -> AccumDict()
+        a dictionary rlz.ordinal -> (loss_type, tag) -> AccumDict() or,
+        if the parameter asset_loss_table is set, the output of
+        :func:`asset_loss_table`
     """
+    if monitor.oqparam.asset_loss_table:
+        return asset_loss_table(riskinputs, riskmodel, rlzs_assoc, monitor)
     specific = set(monitor.oqparam.specific_assets)
     if monitor.num_assets <= 10:  # hack
-        specific = set(a.id for assets in monitor.assets_by_site
-                       for a in assets)
+        specific = set(monitor.assetcol.asset_refs)
     acc = AccumDict({rlz.ordinal: AccumDict()
                      for rlz in rlzs_assoc.realizations})
     # rlz.ordinal -> (loss_type, tag) -> AccumDict
@@ -53,7 +103,7 @@ def event_based_risk(riskinputs, riskmodel, rlzs_assoc, monitor):
         for out in out_by_rlz:
             acc_rlz = acc[out.hid]
             acc_rlz[out.loss_type, 'counts_matrix'] = AccumDict(
-                zip(out.assets, out.counts_matrix))
+                zip([asset.id for asset in out.assets], out.counts_matrix))
             for tag, losses, ins_losses in zip(
                     out.tags, out.event_loss_per_asset,
                     out.insured_loss_per_asset):
@@ -154,17 +204,54 @@ class EventBasedRiskCalculator(base.RiskCalculator):
         rup_by_tag = sum(self.datastore['sescollection'], AccumDict())
         all_ruptures = [rup_by_tag[tag] for tag in sorted(rup_by_tag)]
         num_samples = min(len(all_ruptures), epsilon_sampling)
-        eps_dict = riskinput.make_eps_dict(
-            assets_by_site, num_samples, oq.master_seed, oq.asset_correlation)
-        logging.info('Generated %d epsilons', num_samples * len(eps_dict))
-        self.epsilon_matrix = numpy.array(
-            [eps_dict[a['asset_ref']] for a in self.assetcol])
+        if oq.lazy_epsilons:  # generated in the workers, block by block
+            eps_dict = riskinput.EpsilonGetter(
+                oq.master_seed, oq.asset_correlation, num_samples)
+        else:
+            eps_dict = riskinput.make_eps_dict(
+                assets_by_site, num_samples, oq.master_seed,
+                oq.asset_correlation)
+            logging.info('Generated %d epsilons', num_samples * len(eps_dict))
+            self.epsilon_matrix = numpy.array(
+                [eps_dict[a['asset_ref']] for a in self.assetcol])
+        self.tags = [rup.tag for rup in all_ruptures]
         self.riskinputs = list(self.riskmodel.build_inputs_from_ruptures(
             self.sitecol.complete, all_ruptures, gsims_by_col,
             oq.truncation_level, correl_model, eps_dict,
             oq.concurrent_tasks or 1))
         logging.info('Built %d risk inputs', len(self.riskinputs))
 
+        if oq.asset_loss_table:
+            # preparing the empty datasets for the asset event loss table
+            loss_types = self.riskmodel.get_loss_types()
+            self.datastore.hdf5.create_group('asset_loss_table-rlzs')
+            self.datasets = {}
+            for l, loss_type in enumerate(loss_types):
+                for r, rlz in enumerate(self.rlzs_assoc.realizations):
+                    key = 'asset_loss_table-rlzs/%s/%s' % (loss_type, rlz.uid)
+                    self.datasets[l, r] = self.datastore.create_dset(
+                        key, ela_dt)
+
+    def agg_result(self, acc, result):
+        """
+        If the parameter asset_loss_table is set, save the losses coming
+        from a task directly in the datastore and count them; otherwise
+        sum the results.
+
+        :param acc: the accumulator
+        :param result: the result of a task
+        :returns: the updated accumulator
+        """
+        if not self.oqparam.asset_loss_table:
+            return acc + result
+        saved = AccumDict()
+        for (l, r), arrays in numpy.ndenumerate(result):
+            for array in arrays:
+                self.datasets[l, r].extend(array)
+                saved += {(l, r): len(array)}
+        self.datastore.hdf5.flush()
+        return acc + saved
+
     def zeros(self, shape, dtype):
         """
         Build a composite dtype from the given loss_types and dtype and
@@ -180,6 +267,8 @@ class EventBasedRiskCalculator(base.RiskCalculator):
         rlz.ordinal -> (loss_type, tag) -> [(asset.id, loss), ...]
         several interesting outputs.
         """
+        if self.oqparam.asset_loss_table:
+            return self.post_execute_asset_loss_table(result)
         oq = self.oqparam
         # take the cached self.rlzs_assoc and write it on the datastore
         self.rlzs_assoc = self.rlzs_assoc
@@ -260,8 +349,8 @@ class EventBasedRiskCalculator(base.RiskCalculator):
                         # build the loss maps per asset, array of shape (N, P)
                         losses_poes = numpy.array(  # shape (N, 2, C)
                             [lc['losses'], lc['poes']]).transpose(1, 0, 2)
-                        lmaps = scientific.loss_map_matrix(
-                            oq.conditional_loss_poes, losses_poes)  # (P, N)
+                        lmaps = scientific.conditional_loss_ratios(
+                            losses_poes, oq.conditional_loss_poes)  # (P, N)
                         for lm, lmap in zip(lm_names, lmaps):
                             loss_maps[loss_type][lm] = lmap
 
@@ -292,6 +381,122 @@ class EventBasedRiskCalculator(base.RiskCalculator):
             self.compute_store_stats('loss_curves')
             self.compute_store_stats('agg_loss_curve')
 
+    def post_execute_asset_loss_table(self, result):
+        """
+        Build the loss curves, maps and aggregate outputs by reading
+        the asset event loss table in blocks from the datastore.
+
+        :param result: a dictionary (l, r) -> number of stored losses
+                       (not used, the sizes are read from the datastore)
+        """
+        oq = self.oqparam
+        self.rlzs_assoc = self.rlzs_assoc
+        rlzs = self.rlzs_assoc.realizations
+        loss_types = self.riskmodel.get_loss_types()
+        time_span = oq.risk_investigation_time or oq.investigation_time
+
+        C = oq.loss_curve_resolution
+        self.loss_curve_dt = numpy.dtype(
+            [('losses', (float, C)), ('poes', (float, C)), ('avg', float)])
+        if oq.conditional_loss_poes:
+            lm_names = _loss_map_names(oq.conditional_loss_poes)
+            self.loss_map_dt = numpy.dtype([(f, float) for f in lm_names])
+
+        self.assets = assets = riskinput.sorted_assets(self.assets_by_site)
+        specific_idx = numpy.array(
+            [i for i, a in enumerate(assets)
+             if a.id in self.oqparam.specific_assets], numpy.uint32)
+        N = len(assets)
+        T = len(self.tags)
+
+        event_loss_asset = [{} for rlz in rlzs]
+        event_loss = [{} for rlz in rlzs]
+        for r, rlz in enumerate(rlzs):
+            loss_curves = self.zeros(N, self.loss_curve_dt)
+            ins_curves = self.zeros(N, self.loss_curve_dt)
+            if oq.conditional_loss_poes:
+                loss_maps = self.zeros(N, self.loss_map_dt)
+            agg_loss_curve = self.zeros(1, self.loss_curve_dt)
+            for l, loss_type in enumerate(loss_types):
+                # the table is read from the datastore, so that this
+                # works also when the calculation is resumed
+                dset = self.datastore['asset_loss_table-rlzs/%s/%s' % (
+                    loss_type, rlz.uid)]
+                size = len(dset)
+                logging.info('rlz=%d, %s: %d nonzero losses, %s',
+                             r, loss_type, size,
+                             humansize(dset.attrs['nbytes']))
+                builder = scientific.LossTableCurveBuilder(N, C)
+                ins_builder = scientific.LossTableCurveBuilder(N, C)
+                agg_losses = numpy.zeros(T)
+                agg_ins_losses = numpy.zeros(T)
+                rows = []
+                # first pass: maximum losses, aggregate and specific losses
+                for start in range(0, size, BLOCK_SIZE):
+                    block = dset[start:start + BLOCK_SIZE]
+                    builder.update_max(block['ass_id'], block['loss'])
+                    ins_builder.update_max(block['ass_id'], block['ins_loss'])
+                    agg_losses += numpy.bincount(
+                        block['rup_id'], block['loss'], minlength=T)
+                    agg_ins_losses += numpy.bincount(
+                        block['rup_id'], block['ins_loss'], minlength=T)
+                    if len(specific_idx):
+                        rows.append(block[numpy.in1d(
+                            block['ass_id'], specific_idx)])
+                # second pass: counts of the exceedances
+                for start in range(0, size, BLOCK_SIZE):
+                    block = dset[start:start + BLOCK_SIZE]
+                    builder.update_counts(block['ass_id'], block['loss'])
+                    if oq.insured_losses:
+                        ins_builder.update_counts(
+                            block['ass_id'], block['ins_loss'])
+
+                if rows:
+                    event_loss_asset[r][loss_type] = sorted(
+                        (self.tags[row['rup_id']], assets[row['ass_id']].id,
+                         row['loss'], row['ins_loss'])
+                        for row in numpy.concatenate(rows))
+
+                lc = loss_curves[loss_type]
+                lc['losses'], lc['poes'], lc['avg'] = builder.build_curves(
+                    oq.tses, time_span)
+                if oq.insured_losses:
+                    ic = ins_curves[loss_type]
+                    ic['losses'], ic['poes'], ic['avg'] = \
+                        ins_builder.build_curves(oq.tses, time_span)
+                if oq.conditional_loss_poes:
+                    losses_poes = numpy.array(  # shape (N, 2, C)
+                        [lc['losses'], lc['poes']]).transpose(1, 0, 2)
+                    lmaps = scientific.conditional_loss_ratios(
+                        losses_poes, oq.conditional_loss_poes)  # (P, N)
+                    for lm, lmap in zip(lm_names, lmaps):
+                        loss_maps[loss_type][lm] = lmap
+
+                # the ruptures without losses do not change the curve
+                nonzero = agg_losses.nonzero()[0]
+                event_loss[r][loss_type] = [
+                    (self.tags[i], agg_losses[i], agg_ins_losses[i])
+                    for i in nonzero]
+                if len(nonzero):
+                    losses, poes, avg, _ = self.build_agg_loss_curve_and_map(
+                        agg_losses[nonzero])
+                    agg_loss_curve[loss_type][0] = (losses, poes, avg)
+
+            self.store('loss_curves', rlz, loss_curves)
+            if oq.insured_losses:
+                self.store('ins_curves', rlz, ins_curves)
+            if oq.conditional_loss_poes:
+                self.store('loss_maps', rlz, loss_maps)
+            self.store('agg_loss_curve', rlz, agg_loss_curve)
+
+        if len(specific_idx):
+            self.event_loss_asset = event_loss_asset
+        self.event_loss = event_loss
+
+        if len(rlzs) > 1:
+            self.compute_store_stats('loss_curves')
+            self.compute_store_stats('agg_loss_curve')
+
     def clean_up(self):
         """
         Final checks and cleanup
@@ -317,8 +522,8 @@ class EventBasedRiskCalculator(base.RiskCalculator):
         losses_poes = scientific.event_based(
             losses, tses=oq.tses, time_span=oq.risk_investigation_time or
             oq.investigation_time, curve_resolution=oq.loss_curve_resolution)
-        loss_map = scientific.loss_map_matrix(
-            clp, [losses_poes]).reshape(len(clp)) if clp else None
+        loss_map = scientific.conditional_loss_ratios(
+            [losses_poes], clp).reshape(len(clp)) if clp else None
         return (losses_poes[0], losses_poes[1],
                 scientific.average_loss(losses_poes), loss_map)
 
@@ -97,7 +97,8 @@ class ScenarioCalculator(base.HazardCalculator):
         args = (self.tag_seed_pairs, self.computer, self.monitor('calc_gmfs'))
         return parallel.apply_reduce(
             self.core_func.__func__, args,
-            concurrent_tasks=self.oqparam.concurrent_tasks)
+            concurrent_tasks=self.oqparam.concurrent_tasks,
+            task_duration=self.oqparam.task_duration)
 
     def post_execute(self, gmf_by_tag):
         """
@@ -19,9 +19,11 @@
 import os
 import logging
 
+import numpy
+
 from openquake.commonlib import parallel, datastore
-from openquake.risklib import scientific
-from openquake.baselib.general import AccumDict
+from openquake.commonlib.parallel import apply_reduce
+from openquake.risklib import workflows
 from openquake.commonlib.calculators import base
 
 
@@ -39,27 +41,53 @@ def scenario_damage(riskinputs, riskmodel, rlzs_assoc, monitor):
     :param monitor:
         :class:`openquake.commonlib.parallel.PerformanceMonitor` instance
     :returns:
-        a dictionary {('asset', asset): <mean stddev>,
-                      ('taxonomy', asset.taxonomy): <damage array>}
+        a dictionary {'taxonomy': <array R x T x E x D>,
+                      'asset': <list of triples (r, idxs, n x 2 x D array)>}
+
+    where R is the number of realizations, T the number of taxonomies,
+    E the number of ground motion fields, D the number of damage states
+    and n the number of assets of an output; the triples contain the
+    index of the realization, the indices of the assets and the means and
+    the standard deviations of their damages, so that only the assets of
+    the task are returned.
     """
     logging.info('Process %d, considering %d risk input(s) of weight %d',
                  os.getpid(), len(riskinputs),
                  sum(ri.weight for ri in riskinputs))
-    ordinals = range(len(rlzs_assoc.realizations))
-    result = AccumDict({i: AccumDict() for i in ordinals})
-    # ordinal -> (key_type, key) -> array
+    result = dict(
+        taxonomy=numpy.zeros((len(rlzs_assoc.realizations),
+                              len(monitor.taxonomies), monitor.num_gmfs,
+                              len(riskmodel.damage_states))),
+        asset=[])
+    taxo_idx = {taxo: i for i, taxo in enumerate(monitor.taxonomies)}
     for out_by_rlz in riskmodel.gen_outputs(
             riskinputs, rlzs_assoc, monitor):
         for out in out_by_rlz:
-            for asset, fraction in zip(out.assets, out.damages):
-                damages = fraction * asset.number
-                result[out.hid] += {
-                    ('asset', asset.id): scientific.mean_std(damages)}
-                result[out.hid] += {
-                    ('taxonomy', asset.taxonomy): damages}
+            assets = out.assets
+            numbers = workflows.get_numbers(assets)
+            damages = out.damages * numbers[:, None, None]  # n x E x D
+            idxs = numpy.array([monitor.assetno[asset.id] for asset in assets])
+            stats = numpy.array([damages.mean(axis=1),
+                                 damages.std(axis=1, ddof=1)])  # 2 x n x D
+            result['asset'].append((out.hid, idxs, stats.transpose(1, 0, 2)))
+            result['taxonomy'][out.hid, taxo_idx[assets[0].taxonomy]] += (
+                damages.sum(axis=0))
     return result
 
 
+def zero_damages(num_rlzs, taxonomies, num_gmfs, num_assets, num_dmg_states):
+    """
+    :returns:
+        a dictionary with keys 'taxonomy' and 'asset' and preallocated
+        arrays of zeros with shapes R x T x E x D and R x N x 2 x D
+        respectively
+    """
+    return dict(
+        taxonomy=numpy.zeros(
+            (num_rlzs, len(taxonomies), num_gmfs, num_dmg_states)),
+        asset=numpy.zeros((num_rlzs, num_assets, 2, num_dmg_states)))
+
+
 @base.calculators.add('scenario_damage')
 class ScenarioDamageCalculator(base.RiskCalculator):
     """
@@ -74,7 +102,47 @@ class ScenarioDamageCalculator(base.RiskCalculator):
         if 'gmfs' in self.oqparam.inputs:
             self.pre_calculator = None
         base.RiskCalculator.pre_execute(self)
-        self.riskinputs = self.build_riskinputs(base.get_gmfs(self))
+        gmfs = base.get_gmfs(self)
+        self.riskinputs = self.build_riskinputs(gmfs)
+        # the number of ground motion fields, as read from the GMFs
+        self.monitor.num_gmfs = gmfs.itervalues().next().shape[1]
+        self.monitor.taxonomies = sorted(set(
+            asset.taxonomy for assets in self.assets_by_site
+            for asset in assets))
+        self.monitor.assetno = {
+            ref: i for i, ref in enumerate(self.assetcol['asset_ref'])}
+
+    def execute(self):
+        """
+        Parallelize on the riskinputs and accumulate the damages in
+        preallocated arrays.
+        """
+        acc = zero_damages(
+            len(self.rlzs_assoc.realizations), self.monitor.taxonomies,
+            self.monitor.num_gmfs, len(self.monitor.assetno),
+            len(self.riskmodel.damage_states))
+        self.monitor.oqparam = self.oqparam
+        return apply_reduce(
+            self.core_func.__func__,
+            (self.riskinputs, self.riskmodel, self.rlzs_assoc, self.monitor),
+            acc=acc, concurrent_tasks=self.oqparam.concurrent_tasks,
+            agg=self.agg_result, weight=base.get_weight,
+            key=self.riskinput_key,
+            task_duration=self.oqparam.task_duration)
+
+    def agg_result(self, acc, result):
+        """
+        Sum in place the damages by taxonomy returned by the tasks and
+        scatter the damages of their assets in the array of all assets
+        """
+        acc['taxonomy'] += result['taxonomy']
+        for r, idxs, stats in result['asset']:
+            acc['asset'][r, idxs] += stats
+        return acc
 
     def post_execute(self, result):
+        """
+        Store the arrays of damages, together with the taxonomies
+        """
+        result['taxonomies'] = numpy.array(self.monitor.taxonomies)
         self.damages_by_key = result
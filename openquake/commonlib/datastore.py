@@ -41,6 +41,25 @@ view = CallableDict()
 
 DATADIR = os.environ.get('OQ_DATADIR', os.path.expanduser('~/oqdata'))
 
+# HDF5 storage options for the big outputs, by key prefix; the datasets
+# not listed here are stored contiguously and without compression; the
+# dictionaries of arrays with the option group=True are stored as HDF5
+# groups and read back lazily, the other ones are pickled
+STORAGE = {
+    'curves_by_trt_gsim': dict(
+        chunks=(10000,), compression='gzip', group=True),
+    'gmf_by_trt_gsim': dict(chunks=(10000,), compression='gzip', group=True),
+    'hcurves': dict(chunks=(10000,), compression='gzip'),
+    'hmaps': dict(chunks=(10000, 1), compression='gzip'),
+    'gmfs': dict(chunks=(10000,), compression='lzf'),
+    'asset_loss_table-rlzs': dict(chunks=(10000,), compression='lzf'),
+    'event_loss_table-rlzs': dict(chunks=(10000,), compression='lzf'),
+    'insured_loss_table-rlzs': dict(chunks=(10000,), compression='lzf'),
+}
+
+# name of the dataset with the keys of a dictionary of arrays
+DICT_KEYS = '__keys__'
+
 
 def get_nbytes(dset):
     """
@@ -101,6 +120,31 @@ def get_last_calc_id(datadir=DATADIR):
     return calcs[-1]
 
 
+def storage_options(options, shape):
+    """
+    Adapt the storage options to the shape of a dataset: chunks and
+    compression make sense only for non-empty arrays, and the chunks
+    cannot be larger than the dataset, unless it is extendable.
+
+    :param options: a dictionary with keys chunks, compression and group
+    :param shape: the shape of the dataset, with None for extendable axes
+    :returns: a dictionary of keyword arguments for h5py create_dataset
+    """
+    if not shape or 0 in shape:
+        return {}
+    opts = dict(options)
+    opts.pop('group', None)  # not an option of h5py
+    chunks = opts.get('chunks')
+    if isinstance(chunks, tuple):
+        if len(chunks) != len(shape):  # use the default chunk shape
+            opts['chunks'] = True
+        else:
+            opts['chunks'] = tuple(
+                c if n is None else max(min(c, n), 1)
+                for c, n in zip(chunks, shape))
+    return opts
+
+
 class Hdf5Dataset(object):
     """
     Little wrapper around a one-dimensional HDF5 dataset.
@@ -109,18 +153,26 @@ class Hdf5Dataset(object):
     :param key: an hdf5 key string
     :param dtype: dtype of the dataset (usually composite)
     :param size: size of the dataset (if None, the dataset is extendable)
+    :param chunks: None, True or the chunk shape as a tuple of one integer
+    :param compression: None, 'gzip' or 'lzf'
+
+    Extendable datasets are always chunked; if the chunks are not given,
+    the chunk shape is guessed by h5py.
     """
-    def __init__(self, hdf5, key, dtype, size):
+    def __init__(self, hdf5, key, dtype, size, chunks=None, compression=None):
         self.hdf5 = hdf5
         self.key = key
         self.dtype = dtype
+        options = dict(chunks=chunks, compression=compression)
         if size is None:  # extendable dataset
             self.dset = self.hdf5.create_dataset(
-                key, (0,), dtype, chunks=True, maxshape=(None,))
+                key, (0,), dtype, maxshape=(None,),
+                **storage_options(options, (None,)))
             self.size = 0
             self.dset.attrs['nbytes'] = 0
         else:  # fixed-size dataset
-            self.dset = self.hdf5.create_dataset(key, (size,), dtype)
+            self.dset = self.hdf5.create_dataset(
+                key, (size,), dtype, **storage_options(options, (size,)))
             self.size = size
             self.dset.attrs['nbytes'] = size * numpy.zeros(1, dtype).nbytes
         self.attrs = self.dset.attrs
@@ -163,6 +215,14 @@ class DataStore(collections.MutableMapping):
     is an array, and the last field of the key is 'hdf5'. When reading the
     items, the DataStore will return a generator. The items will be ordered
     lexicographically according to their name.
+
+    The chunk shape and the compression of the arrays are taken from the
+    `storage` dictionary, which is initialized with :data:`STORAGE` and can
+    be changed per key. Dictionaries of arrays, like the curves by
+    (trt_model_id, gsim), are stored as HDF5 groups with a dataset per key
+    only if their storage options have group=True; they are read back as
+    a :class:`Hdf5Dict`, so that a single item can be read without
+    touching the others. The other dictionaries are pickled.
     """
     def __init__(self, calc_id=None, datadir=DATADIR, parent=()):
         if not os.path.exists(datadir):
@@ -187,16 +247,43 @@ class DataStore(collections.MutableMapping):
         self.hdf5path = os.path.join(self.calc_dir, 'output.hdf5')
         mode = 'r+' if os.path.exists(self.hdf5path) else 'w'
         self.hdf5 = h5py.File(self.hdf5path, mode, libver='latest')
+        self.storage = dict(STORAGE)
+
+    def get_storage(self, key):
+        """
+        :param key: a datastore key
+        :returns: the storage options for the key or for its longest prefix
+        """
+        parts = key.strip('/').split('/')
+        for i in range(len(parts), 0, -1):
+            prefix = '/'.join(parts[:i])
+            if prefix in self.storage:
+                return self.storage[prefix]
+        return {}
 
     def create_dset(self, key, dtype, size=None):
         """
-        Create a one-dimensional HDF5 dataset.
+        Create a one-dimensional HDF5 dataset, with the chunks and the
+        compression specified in the storage options for the key.
 
         :param key: a string starting with '/'
         :param dtype: dtype of the dataset (usually composite)
         :param size: size of the dataset (if None, the dataset is extendable)
         """
-        return Hdf5Dataset(self.hdf5, key, dtype, size)
+        storage = self.get_storage(key)
+        return Hdf5Dataset(self.hdf5, key, dtype, size,
+                           storage.get('chunks'), storage.get('compression'))
+
+    def create_array(self, key, value):
+        """
+        Store an array, with the storage options for the key.
+
+        :param key: an hdf5 key string
+        :param value: a numpy array (not of objects)
+        """
+        return self.hdf5.create_dataset(
+            key, data=value,
+            **storage_options(self.get_storage(key), value.shape))
 
     def export_path(self, key, fmt):
         """
@@ -272,28 +359,40 @@ class DataStore(collections.MutableMapping):
         try:
             shape = val.shape
         except AttributeError:  # val is a group
+            if DICT_KEYS in val:
+                return Hdf5Dict(val)
             return val
         if not shape:
             val = cPickle.loads(val.value)
         return val
 
     def __setitem__(self, key, value):
-        if (not isinstance(value, numpy.ndarray) or
-                value.dtype is numpy.dtype(object)):
-            val = numpy.array(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
-        else:
-            val = value
         if key in self.hdf5:
             # there is a bug in the current version of HDF5 for composite
             # arrays: is impossible to save twice the same key; so we remove
             # the key first, then it is possible to save it again
             del self[key]
         try:
-            self.hdf5[key] = val
+            if (self.get_storage(key).get('group') and
+                    is_dict_of_arrays(value)):
+                self._set_dict(key, value)
+            elif is_array(value):
+                self.create_array(key, value)
+            else:
+                self.hdf5[key] = pickled(value)
         except RuntimeError as exc:
             raise RuntimeError('Could not save %s: %s in %s' %
                                (key, exc, self.hdf5path))
 
+    def _set_dict(self, key, dic):
+        # store a dictionary of arrays as a group with a dataset for
+        # each key, named by the index of the key in the list of keys
+        keys = list(dic)
+        group = self.hdf5.create_group(key)
+        group[DICT_KEYS] = pickled(keys)
+        for i, k in enumerate(keys):
+            self.create_array('%s/%d' % (key, i), dic[k])
+
     def __delitem__(self, key):
         del self.hdf5[key]
 
@@ -311,6 +410,54 @@ class DataStore(collections.MutableMapping):
         return '<%s %d>' % (self.__class__.__name__, self.calc_id)
 
 
+class Hdf5Dict(collections.Mapping):
+    """
+    Read-only mapping over a dictionary of arrays stored as an HDF5 group
+    by the DataStore: the arrays are read only when accessed.
+
+    :param group: an HDF5 group with a dataset for each key
+    """
+    def __init__(self, group):
+        self.group = group
+        self._keys = cPickle.loads(group[DICT_KEYS].value)
+        self.index = {k: i for i, k in enumerate(self._keys)}
+
+    def __getitem__(self, key):
+        return self.group[str(self.index[key])].value
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.group.name)
+
+
+def is_array(value):
+    """
+    :returns: True if the value is a numpy array which is not of objects
+    """
+    return (isinstance(value, numpy.ndarray) and
+            value.dtype is not numpy.dtype(object))
+
+
+def is_dict_of_arrays(value):
+    """
+    :returns: True if the value is a non-empty dictionary of arrays
+    """
+    return (isinstance(value, dict) and len(value) > 0 and
+            all(is_array(val) for val in value.itervalues()))
+
+
+def pickled(value):
+    """
+    :returns: the value pickled into a numpy array, to be stored in HDF5
+    """
+    return numpy.array(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+
+
 def persistent_attribute(key):
     """
     Persistent attributes are persisted to the datastore and cached.
@@ -437,6 +437,61 @@ def export_gmf(ekey, dstore):
     return fnames
 
 
+DisaggMatrix = collections.namedtuple(
+    'DisaggMatrix', 'poe iml dim_labels matrix')
+
+
+@export.add(('disagg', 'xml'))
+def export_disagg_xml(ekey, dstore):
+    """
+    Export the disaggregation matrices in XML format, with a file for
+    each realization, site, intensity measure type and poe.
+
+    :param ekey: export key, i.e. a pair (datastore key, fmt)
+    :param dstore: datastore object
+    """
+    oq = dstore['oqparam']
+    rlzs = dstore['rlzs_assoc'].realizations
+    sitecol = dstore['sitecol']
+    bin_edges = dstore['disagg_bin_edges']
+    samples = oq.number_of_logic_tree_samples
+    key, fmt = ekey
+    fnames = []
+    for rlz in rlzs:
+        if rlz.uid not in dstore[key]:
+            continue
+        group = dstore[key][rlz.uid]
+        matrices = [(kind, group[kind].value) for kind in bin_edges.kinds]
+        imls = group['imls'].value  # shape (N, I, P)
+        for sid, site in zip(sitecol.sids, sitecol):
+            lon, lat = site.location.longitude, site.location.latitude
+            lons, lats = bin_edges.get_lon_lat_edges(sid)
+            for i, imt_str in enumerate(sorted(oq.imtls)):
+                imt = from_string(imt_str)
+                for p, poe in enumerate(oq.poes_disagg):
+                    fname = build_name(
+                        rlz, 'disagg_matrix(%s)-%s-lon_%s-lat_%s' % (
+                            poe, imt_str, lon, lat), fmt, samples)
+                    dest = os.path.join(dstore.export_dir, fname)
+                    writer = hazard_writers.DisaggXMLWriter(
+                        dest, investigation_time=oq.investigation_time,
+                        imt=imt[0], sa_period=imt[1], sa_damping=imt[2],
+                        lon=lon, lat=lat,
+                        mag_bin_edges=bin_edges.mags,
+                        dist_bin_edges=bin_edges.dists,
+                        lon_bin_edges=lons, lat_bin_edges=lats,
+                        eps_bin_edges=bin_edges.eps,
+                        tectonic_region_types=bin_edges.trts,
+                        smlt_path='_'.join(rlz.sm_lt_path),
+                        gsimlt_path=rlz.gsim_rlz.uid)
+                    writer.serialize(
+                        [DisaggMatrix(poe, imls[sid, i, p], kind.split('_'),
+                                      matrix[sid, i, p])
+                         for kind, matrix in matrices])
+                    fnames.append(dest)
+    return fnames
+
+
 def export_hazard_curves_xml(key, export_dir, fname, sitecol, curves_by_imt,
                              imtls, investigation_time):
     """
@@ -253,33 +253,30 @@ def export_damage(ekey, dstore):
     damages_by_key = dstore['damages_by_key']
     assetcol = dstore['assetcol']
     sitemesh = dstore['sitemesh']
-    assetno = dict((ref, i) for i, ref in enumerate(assetcol['asset_ref']))
     dmg_states = [DmgState(s, i)
                   for i, s in enumerate(riskmodel.damage_states)]
+    taxonomies = damages_by_key['taxonomies']
+    # arrays R x T x E x D and R x N x 2 x D
+    dmg_by_taxon = damages_by_key['taxonomy']
+    dmg_by_asset = damages_by_key['asset']
+    sites = [Site(point['lon'], point['lat'])
+             for point in sitemesh[assetcol['site_id']]]
     fnames = []
-    for i in sorted(damages_by_key):
-        rlz = rlzs[i]
-        result = damages_by_key[i]
+    for i, rlz in enumerate(rlzs):
         dd_taxo = []
+        for taxonomy, values in zip(taxonomies, dmg_by_taxon[i]):
+            means, stds = scientific.mean_std(values)
+            for dmg_state, mean, std in zip(dmg_states, means, stds):
+                dd_taxo.append(
+                    DmgDistPerTaxonomy(taxonomy, dmg_state, mean, std))
         dd_asset = []
-        shape = oqparam.number_of_ground_motion_fields, len(dmg_states)
-        totals = numpy.zeros(shape)  # R x D matrix
-        for (key_type, key), values in result.iteritems():
-            if key_type == 'taxonomy':
-                # values are fractions, R x D matrix
-                totals += values
-                means, stds = scientific.mean_std(values)
-                for dmg_state, mean, std in zip(dmg_states, means, stds):
-                    dd_taxo.append(
-                        DmgDistPerTaxonomy(key, dmg_state, mean, std))
-            elif key_type == 'asset':
-                means, stddevs = values
-                point = sitemesh[assetcol[assetno[key]]['site_id']]
-                site = Site(point['lon'], point['lat'])
-                for dmg_state, mean, std in zip(dmg_states, means, stddevs):
-                    dd_asset.append(
-                        DmgDistPerAsset(
-                            ExposureData(key, site), dmg_state, mean, std))
+        for asset_ref, site, (means, stddevs) in zip(
+                assetcol['asset_ref'], sites, dmg_by_asset[i]):
+            for dmg_state, mean, std in zip(dmg_states, means, stddevs):
+                dd_asset.append(
+                    DmgDistPerAsset(
+                        ExposureData(asset_ref, site), dmg_state, mean, std))
+        totals = dmg_by_taxon[i].sum(axis=0)  # E x D matrix
         dd_total = []
         for dmg_state, total in zip(dmg_states, totals.T):
             mean, std = scientific.mean_std(total)
@@ -42,6 +42,7 @@ class OqParam(valid.ParamSet):
     area_source_discretization = valid.Param(
         valid.NoneOr(valid.positivefloat), None)
     asset_correlation = valid.Param(valid.NoneOr(valid.FloatRange(0, 1)), 0)
+    asset_loss_table = valid.Param(valid.boolean, False)
     asset_life_expectancy = valid.Param(valid.positivefloat)
     base_path = valid.Param(valid.utf8, '.')
     calculation_mode = valid.Param(valid.Choice(*CALCULATORS), '')
@@ -51,12 +52,15 @@ class OqParam(valid.ParamSet):
         valid.positiveint, parallel.executor.num_tasks_hint)
     conditional_loss_poes = valid.Param(valid.probabilities, [])
     continuous_fragility_discretization = valid.Param(valid.positiveint, 20)
+    cost_model_calculation_id = valid.Param(
+        valid.NoneOr(valid.positiveint), None)
     description = valid.Param(valid.utf8_not_empty)
     distance_bin_width = valid.Param(valid.positivefloat)
     mag_bin_width = valid.Param(valid.positivefloat)
     epsilon_sampling = valid.Param(valid.positiveint, 1000)
     export_dir = valid.Param(valid.utf8, None)
     export_multi_curves = valid.Param(valid.boolean, False)
+    exposure_cache = valid.Param(valid.boolean, False)
     exports = valid.Param(valid.export_formats, ())
     ground_motion_correlation_model = valid.Param(
         valid.NoneOr(valid.Choice(*GROUND_MOTION_CORRELATION_MODELS)), None)
@@ -78,6 +82,7 @@ class OqParam(valid.ParamSet):
     # hazard_imtls = valid.Param(valid.intensity_measure_types_and_levels, {})
     interest_rate = valid.Param(valid.positivefloat)
     investigation_time = valid.Param(valid.positivefloat, None)
+    lazy_epsilons = valid.Param(valid.boolean, False)
     loss_curve_resolution = valid.Param(valid.positiveint, 50)
     lrem_steps_per_interval = valid.Param(valid.positiveint, 0)
     steps_per_interval = valid.Param(valid.positiveint, 0)
@@ -111,8 +116,11 @@ class OqParam(valid.ParamSet):
     ses_per_logic_tree_path = valid.Param(valid.positiveint, 1)
     sites = valid.Param(valid.NoneOr(valid.coordinates), None)
     sites_disagg = valid.Param(valid.NoneOr(valid.coordinates), [])
+    source_model_cache = valid.Param(valid.boolean, False)
     specific_assets = valid.Param(valid.namelist, [])
     statistics = valid.Param(valid.boolean, True)
+    statistics_block_size = valid.Param(valid.positiveint, 10000)
+    task_duration = valid.Param(valid.NoneOr(valid.positiveint), None)
     taxonomies_from_model = valid.Param(valid.boolean, False)
     time_event = valid.Param(str, None)
     truncation_level = valid.Param(valid.NoneOr(valid.positivefloat), None)
@@ -25,12 +25,16 @@ import sys
 import cPickle
 import logging
 import operator
+import collections
 import functools
 import traceback
 import time
+import tempfile
 from datetime import datetime
-from concurrent.futures import as_completed, ProcessPoolExecutor
+from concurrent.futures import (
+    as_completed, wait, FIRST_COMPLETED, ProcessPoolExecutor)
 
+import numpy
 import psutil
 
 
@@ -116,6 +120,16 @@ def safely_call(func, args, pickle=False):
     return res
 
 
+def timed_call(func, *args):
+    """
+    Call the given function with the given arguments and return a pair
+    (result, duration in seconds).
+    """
+    t0 = time.time()
+    res = func(*args)
+    return res, time.time() - t0
+
+
 def log_percent_gen(taskname, todo, progress):
     """
     Generator factory. Each time the generator object is called
@@ -143,6 +157,12 @@ def log_percent_gen(taskname, todo, progress):
     yield done
 
 
+task_info_dt = numpy.dtype([('task_no', numpy.uint32),
+                            ('num_items', numpy.uint32),
+                            ('weight', numpy.float32),
+                            ('duration', numpy.float32)])
+
+
 class Pickled(object):
     """
     An utility to manually pickling/unpickling objects.
@@ -170,6 +190,54 @@ class Pickled(object):
         return cPickle.loads(self.pik)
 
 
+class Shared(object):
+    """
+    A lightweight replacement for a :class:`Pickled` object which is sent
+    to many tasks. The object is written only once in a temporary file
+    and it is read lazily by the workers when calling `.unpickle`.
+    Numpy arrays are stored in .npy format and memory-mapped in
+    copy-on-write mode, so that the workers share the same pages.
+
+    :param obj: the object to share
+    :param pik: the Pickled version of the object
+    :param dirname: the directory where to save the file (None for the
+                    default temporary directory)
+    """
+    def __init__(self, obj, pik, dirname=None):
+        self.clsname = pik.clsname
+        self.nbytes = len(pik)
+        self.is_array = isinstance(obj, numpy.ndarray) and (
+            obj.dtype != object)
+        suffix = '.npy' if self.is_array else '.pik'
+        fd, self.path = tempfile.mkstemp(suffix, 'shared-', dirname)
+        with os.fdopen(fd, 'wb') as f:
+            if self.is_array:
+                numpy.save(f, obj)
+            else:
+                f.write(pik.pik)
+        self.size = len(cPickle.dumps(self, cPickle.HIGHEST_PROTOCOL))
+
+    def __repr__(self):
+        """String representation of the shared object"""
+        return '<Shared %s %s>' % (self.clsname, humansize(self.nbytes))
+
+    def __len__(self):
+        """Length of the pickled handle, i.e. the data actually sent"""
+        return self.size
+
+    def unpickle(self):
+        """Read the underlying object from the file"""
+        if self.is_array:
+            return numpy.load(self.path, mmap_mode='c')
+        with open(self.path, 'rb') as f:
+            return cPickle.load(f)
+
+    def remove(self):
+        """Remove the underlying file"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
 def get_pickled_sizes(obj):
     """
     Return the pickled sizes of an object and its direct attributes,
@@ -225,9 +293,21 @@ class TaskManager(object):
       print tm.reduce()
 
     Progress report is built-in.
+
+    Arguments bigger than `share_threshold` bytes which are sent to more
+    than one task are written only once in `shared_dir` and the tasks
+    receive :class:`Shared` handles. The mechanism is disabled if
+    `shared_dir` or `share_threshold` are None; the calculators set
+    `shared_dir` to the directory of the calculation. Notice that such
+    arguments are pickled only once, so they must not be changed between
+    submissions.
     """
     executor = executor
     progress = staticmethod(logging.info)
+    share_threshold = 1024 * 1024  # 1 MB
+    shared_dir = None  # no sharing unless a directory is set
+    min_blocks_factor = 10  # at most ~10 x concurrent_tasks adaptive blocks
+    task_info = {}  # task name -> array of task_info_dt, see .pop_task_info
 
     @classmethod
     def restart(cls):
@@ -247,12 +327,24 @@ class TaskManager(object):
             self.submit(*a)
         return self
 
+    @classmethod
+    def pop_task_info(cls):
+        """
+        :returns:
+            the timing information collected by the tasks run in adaptive
+            mode, as a list of pairs (task name, array of task_info_dt);
+            the information is removed from the TaskManager
+        """
+        items = sorted(cls.task_info.iteritems())
+        cls.task_info.clear()
+        return items
+
     @classmethod
     def apply_reduce(cls, task, task_args, agg=operator.add, acc=None,
                      concurrent_tasks=executor._max_workers,
                      weight=lambda item: 1,
                      key=lambda item: 'Unspecified',
-                     name=None):
+                     name=None, task_duration=None):
         """
         Apply a task to a tuple of the form (sequence, \*other_args)
         by first splitting the sequence in chunks, according to the weight
@@ -270,6 +362,12 @@ class TaskManager(object):
         :param concurrent_tasks: hint about how many tasks to generate
         :param weight: function to extract the weight of an item in arg0
         :param key: function to extract the kind of an item in arg0
+        :param task_duration:
+            if given, the blocks are generated lazily and their size is
+            adapted to the observed durations, so that a task lasts about
+            `task_duration` seconds (see `.adaptive_reduce`);
+            concurrent_tasks keeps its meaning of hint for the number of
+            tasks to generate
         """
         arg0 = task_args[0]  # this is assumed to be a sequence
         num_items = len(arg0)
@@ -281,6 +379,11 @@ class TaskManager(object):
             return acc
         elif num_items == 1:  # apply the function in the master process
             return agg(acc, task_func(arg0, *args))
+        if task_duration and concurrent_tasks and not no_distribute():
+            self = cls(task, name)
+            return self.adaptive_reduce(
+                arg0, args, agg, acc, concurrent_tasks, weight, key,
+                task_duration)
         chunks = list(split_in_blocks(
             arg0, concurrent_tasks or 1, weight, key))
         cls.apply_reduce.__func__._chunks = chunks
@@ -297,8 +400,10 @@ class TaskManager(object):
         self.name = name or oqtask.__name__
         self.results = []
         self.sent = 0
+        self.saved = 0
         self.received = 0
         self.no_distribute = no_distribute()
+        self.shared = {}  # id(obj) -> (obj, Pickled or Shared instance)
 
     def submit(self, *args):
         """
@@ -312,11 +417,166 @@ class TaskManager(object):
         if self.no_distribute:
             res = safely_call(self.task_func, args)
         else:
-            piks = pickle_sequence(args)
+            piks = self.pickle_args(args)
             self.sent += sum(len(p) for p in piks)
             res = self._submit(piks)
         self.results.append(res)
 
+    def pickle_args(self, args):
+        """
+        Convert the arguments of a task into a list of pickled objects.
+        A big argument is pickled once; when it is sent for the second
+        time it is published as a :class:`Shared` object, which is reused
+        for all the following tasks.
+
+        :param args: the arguments of a task
+        :returns: a list of Pickled and Shared objects
+        """
+        cache = {}
+        out = []
+        for obj in args:
+            obj_id = id(obj)
+            if obj_id in cache:  # repeated argument in the same task
+                out.append(cache[obj_id])
+                continue
+            if obj_id in self.shared:
+                pik = self.shared[obj_id][1]
+                if isinstance(pik, Pickled):  # seen before, publish it
+                    pik = Shared(obj, pik, self.shared_dir)
+                    self.shared[obj_id] = (obj, pik)
+                self.saved += pik.nbytes - len(pik)
+            else:
+                pik = obj if isinstance(obj, (Pickled, Shared)) else Pickled(
+                    obj)
+                if (self.shared_dir is not None and
+                        self.share_threshold is not None and
+                        len(pik) > self.share_threshold):
+                    # keep a reference to the object, so that
+                    # its id cannot be reused by another object
+                    self.shared[obj_id] = (obj, pik)
+            cache[obj_id] = pik
+            out.append(pik)
+        return out
+
+    def remove_shared(self):
+        """
+        Remove the files of the shared objects, if any
+        """
+        for _obj, pik in self.shared.itervalues():
+            if isinstance(pik, Shared):
+                pik.remove()
+        self.shared.clear()
+
+    def adaptive_reduce(self, items, args, agg, acc, concurrent_tasks,
+                        weight, key, task_duration):
+        """
+        Apply the task to blocks of items and reduce the results as soon
+        as they arrive. The blocks are submitted lazily, with at most
+        min(concurrent_tasks, 2 * num_workers) tasks in flight. The first
+        blocks have a weight of total_weight / concurrent_tasks; then
+        the weight of a block is reduced to remaining_weight / in_flight,
+        so that the last tasks are small, and to the weight that can be
+        processed in `task_duration` seconds, according to the
+        durations observed so far. The weight of a block is never below
+        total_weight / (concurrent_tasks * `.min_blocks_factor`), to
+        avoid a storm of tiny tasks at the end. The timing information
+        is stored in `.task_info` under the name of the task.
+
+        :param items: a sequence of items
+        :param args: the other arguments of the task
+        :param agg: the aggregation function, (acc, val) -> new acc
+        :param acc: the initial value of the accumulator
+        :param concurrent_tasks: hint about how many tasks to generate
+        :param weight: function to extract the weight of an item
+        :param key: function to extract the kind of an item; each block
+                    contains items of the same kind
+        :param task_duration: target duration of a task in seconds
+        :returns: the final value of the accumulator
+        """
+        max_in_flight = min(concurrent_tasks, 2 * self.executor._max_workers)
+        total_weight = float(sum(weight(item) for item in items))
+        # measured costs and durations
+        stats = dict(todo=total_weight, weight=0., duration=0.)
+        min_weight = total_weight / (concurrent_tasks * self.min_blocks_factor)
+
+        def block_weight():
+            bw = min(total_weight / concurrent_tasks,
+                     stats['todo'] / max_in_flight)
+            if stats['weight'] and stats['duration']:  # observed durations
+                cost = stats['duration'] / stats['weight']  # per unit weight
+                bw = min(bw, task_duration / cost)
+            return max(bw, min_weight)
+
+        def gen_blocks():
+            groups = collections.OrderedDict()
+            for item in items:
+                groups.setdefault(key(item), []).append(item)
+            for group in groups.itervalues():
+                block, tot = [], 0
+                for item in group:
+                    block.append(item)
+                    tot += weight(item)
+                    if tot >= block_weight():
+                        yield block, tot
+                        block, tot = [], 0
+                if block:
+                    yield block, tot
+
+        def submit(block, tot):
+            piks = self.pickle_args((block,) + args)
+            self.sent += sum(len(p) for p in piks)
+            stats['todo'] -= tot
+            if self.oqtask is self.task_func:
+                fut = self.executor.submit(
+                    timed_call, safely_call, self.task_func, piks, True)
+            else:  # call the decorated task
+                fut = self.executor.submit(timed_call, self.oqtask, *piks)
+            running[fut] = (len(running) + len(info), len(block), tot)
+
+        running = {}  # future -> (task_no, num_items, weight)
+        info = []
+        blocks = gen_blocks()
+        prev_percent = 0
+        try:
+            for block, tot in blocks:
+                submit(block, tot)
+                if len(running) >= max_in_flight:
+                    break
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    check_mem_usage()
+                    # log a warning if too much memory is used
+                    task_no, num_items, tot = running.pop(fut)
+                    pik, duration = fut.result()
+                    self.received += len(pik)
+                    val, exc = pik.unpickle()
+                    if exc:
+                        raise RuntimeError(val)
+                    acc = agg(acc, val)
+                    info.append((task_no, num_items, tot, duration))
+                    stats['weight'] += tot
+                    stats['duration'] += duration
+                    percent = int(stats['weight'] / total_weight * 100
+                                  if total_weight else 100)
+                    if percent > prev_percent:
+                        self.progress('%s %3d%%', self.name, percent)
+                        prev_percent = percent
+                    for block, tot in blocks:  # submit a new block
+                        submit(block, tot)
+                        break
+        finally:
+            self.remove_shared()
+        self.progress('Sent %s of data in %d tasks, saved %s by sharing '
+                      'the arguments', humansize(self.sent), len(info),
+                      humansize(self.saved))
+        self.progress('Received %s of data', humansize(self.received))
+        array = numpy.array(sorted(info), task_info_dt)
+        if self.name in self.task_info:
+            array = numpy.concatenate([self.task_info[self.name], array])
+        self.task_info[self.name] = array
+        return acc
+
     def _submit(self, piks):
         # submit tasks by using the ProcessPoolExecutor
         if self.oqtask is self.task_func:
@@ -369,8 +629,16 @@ class TaskManager(object):
         if self.no_distribute:
             agg_result = reduce(agg_and_percent, self.results, acc)
         else:
-            self.progress('Sent %s of data', humansize(self.sent))
-            agg_result = self.aggregate_result_set(agg_and_percent, acc)
+            if self.saved:
+                self.progress('Sent %s of data, saved %s by sharing '
+                              'the arguments', humansize(self.sent),
+                              humansize(self.saved))
+            else:
+                self.progress('Sent %s of data', humansize(self.sent))
+            try:
+                agg_result = self.aggregate_result_set(agg_and_percent, acc)
+            finally:
+                self.remove_shared()
             self.progress('Received %s of data', humansize(self.received))
         self.results = []
         return agg_result
@@ -439,6 +707,10 @@ class PerformanceMonitor(object):
     .duration: time elapsed between start and stop (in seconds)
     .exc: None unless an exception happened inside the block of code
     .mem: the memory delta in bytes
+    .counts: how many times the block of code was executed
+
+    The counts can also be set by the caller, to store a counter in the
+    performance file, for instance `monitor('cache hits', counts=10)`.
 
     The behaviour of the PerformanceMonitor can be customized by subclassing it
     and by overriding the method on_exit(), called at end and used to display
@@ -456,8 +728,9 @@ class PerformanceMonitor(object):
             self._proc = None
         self.mem = 0
         self.duration = 0
+        self.counts = 0
         self._start_time = time.time()
-        self.write('operation pid time_sec memory_mb'.split())
+        self.write('operation pid time_sec memory_mb counts'.split())
 
     def write(self, row):
         """Write a row on the performance file"""
@@ -498,6 +771,7 @@ class PerformanceMonitor(object):
         self.stop_mem = self.measure_mem()
         self.mem = max(self.mem, self.stop_mem - self.start_mem)
         self.duration += time.time() - self._start_time
+        self.counts += 1
         self.on_exit()
 
     def on_exit(self):
@@ -511,7 +785,8 @@ class PerformanceMonitor(object):
         """
         time_sec = str(self.duration)
         memory_mb = str(self.mem / 1024. / 1024.)
-        self.write([self.operation, str(self.pid), time_sec, memory_mb])
+        self.write([self.operation, str(self.pid), time_sec, memory_mb,
+                    str(self.counts)])
 
     def __call__(self, operation, **kw):
         """
@@ -519,6 +794,7 @@ class PerformanceMonitor(object):
         """
         self_vars = vars(self).copy()
         del self_vars['operation']
+        self_vars.pop('counts', None)  # the new operation starts from zero
         new = self.__class__(operation)
         vars(new).update(self_vars)
         vars(new).update(kw)
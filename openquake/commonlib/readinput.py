@@ -33,9 +33,12 @@ from openquake.hazardlib import geo, site, correlation, imt
 from openquake.risklib import workflows, riskinput
 
 from openquake.commonlib.oqvalidation import OqParam
-from openquake.commonlib.node import read_nodes, LiteralNode, context
-from openquake.commonlib import nrml, valid, logictree, InvalidFile
+from openquake.commonlib.node import (
+    read_nodes, LiteralNode, context, iterparse, striptag)
+from openquake.commonlib import (
+    nrml, valid, logictree, datastore, InvalidFile)
 from openquake.commonlib.oqvalidation import vulnerability_files
+from openquake.commonlib.util import file_checksum
 from openquake.commonlib.riskmodels import \
     get_fragility_functions, get_vfs
 from openquake.baselib.general import groupby, AccumDict, writetmp
@@ -376,7 +379,8 @@ def possibly_gunzip(fname):
     return fname
 
 
-def get_source_models(oqparam, source_model_lt, sitecol=None, in_memory=True):
+def get_source_models(oqparam, source_model_lt, sitecol=None, in_memory=True,
+                      monitor=DummyMonitor()):
     """
     Build all the source models generated by the logic tree.
 
@@ -386,6 +390,8 @@ def get_source_models(oqparam, source_model_lt, sitecol=None, in_memory=True):
         a :class:`openquake.commonlib.logictree.SourceModelLogicTree` instance
     :param in_memory:
         if True, keep in memory the sources, else just collect the TRTs
+    :param monitor:
+        a monitor instance, passed to the parsing tasks
     :returns:
         an iterator over :class:`openquake.commonlib.source.SourceModel`
         tuples
@@ -396,10 +402,21 @@ def get_source_models(oqparam, source_model_lt, sitecol=None, in_memory=True):
         oqparam.complex_fault_mesh_spacing,
         oqparam.width_of_mfd_bin,
         oqparam.area_source_discretization)
+    cache_dir = (os.path.join(datastore.DATADIR, 'cache')
+                 if oqparam.source_model_cache else None)
+    parser = source.SourceModelParser(converter, cache_dir)
 
     # consider only the effective realizations
     rlzs = logictree.get_effective_rlzs(source_model_lt)
     samples_by_lt_path = source_model_lt.samples_by_lt_path()
+    fnames = {}  # source model name -> full path
+    for rlz in rlzs:
+        if rlz.value not in fnames:
+            fnames[rlz.value] = possibly_gunzip(
+                os.path.join(oqparam.base_path, rlz.value))
+    if in_memory:  # convert all the files at once, in parallel
+        parser.parse_files(
+            sorted(fnames.itervalues()), oqparam.concurrent_tasks, monitor)
     for i, rlz in enumerate(rlzs):
         sm = rlz.value  # name of the source model
         smpath = rlz.lt_path
@@ -407,23 +424,10 @@ def get_source_models(oqparam, source_model_lt, sitecol=None, in_memory=True):
         if num_samples > 1:
             logging.warn('The source path %s was sampled %d times',
                          smpath, num_samples)
-        fname = possibly_gunzip(os.path.join(oqparam.base_path, sm))
+        fname = fnames[sm]
         if in_memory:
             apply_unc = source_model_lt.make_apply_uncertainties(smpath)
-            try:
-                trt_models = source.parse_source_model(
-                    fname, converter, apply_unc)
-            except ValueError as e:
-                if str(e) in ('Surface does not conform with Aki & '
-                              'Richards convention',
-                              'Edges points are not in the right order'):
-                    raise InvalidFile('''\
-    %s: %s. Probably you are using an obsolete model.
-    In that case you can fix the file with the command
-    python -m openquake.engine.tools.correct_complex_sources %s
-    ''' % (fname, e, fname))
-                else:
-                    raise
+            trt_models = parser.parse_trt_models(fname, apply_unc)
         else:  # just collect the TRT models
             smodel = read_nodes(fname, lambda el: 'sourceModel' in el.tag,
                                 source.nodefactory['sourceModel']).next()
@@ -447,6 +451,36 @@ def get_source_models(oqparam, source_model_lt, sitecol=None, in_memory=True):
             sm, weight, smpath, trt_models, gsim_lt, i, num_samples)
 
 
+def get_cost_model(oqparam):
+    """
+    Read the source timings measured by the calculation with ID
+    `oqparam.cost_model_calculation_id` and build a cost model.
+
+    :param oqparam:
+        an :class:`openquake.commonlib.oqvalidation.OqParam` instance
+    :returns:
+        a :class:`openquake.commonlib.source.CostModel` instance or None
+    """
+    calc_id = oqparam.cost_model_calculation_id
+    if calc_id is None:
+        return
+    dstore = datastore.DataStore(calc_id)
+    try:
+        source_data = dstore['source_data'][:]
+    except KeyError:
+        logging.warn('There are no source timings in calculation %d, '
+                     'using the default weights', calc_id)
+        return
+    finally:
+        dstore.close()
+    logging.info('Calibrating the cost model on %d sources of calculation '
+                 '%d', len(source_data), calc_id)
+    try:
+        return source.CostModel(source_data)
+    except ValueError as exc:
+        logging.warn('%s, using the default weights', exc)
+
+
 def get_composite_source_model(
         oqparam, sitecol=None, SourceProcessor=source.SourceFilterSplitter,
         monitor=DummyMonitor(), no_distribute=False):
@@ -468,13 +502,14 @@ def get_composite_source_model(
         an iterator over :class:`openquake.commonlib.source.SourceModel`
     """
     processor = SourceProcessor(sitecol, oqparam.maximum_distance,
-                                oqparam.area_source_discretization)
+                                oqparam.area_source_discretization,
+                                get_cost_model(oqparam))
     source_model_lt = get_source_model_lt(oqparam)
     smodels = []
     trt_id = 0
     for source_model in get_source_models(
             oqparam, source_model_lt, processor.sitecol,
-            in_memory=hasattr(processor, 'process')):
+            in_memory=hasattr(processor, 'process'), monitor=monitor):
         for trt_model in source_model.trt_models:
             trt_model.id = trt_id
             trt_id += 1
@@ -649,6 +684,8 @@ def get_exposure(oqparam):
     :returns:
         an :class:`Exposure` instance
     """
+    if oqparam.exposure_cache:
+        return get_exposure_fast(oqparam)
     out_of_region = 0
     if oqparam.region_constraint:
         region = wkt.loads(oqparam.region_constraint)
@@ -765,6 +802,303 @@ Exposure = collections.namedtuple(
                  'deductible_is_absolute', 'area', 'assets', 'taxonomies'])
 
 
+# ###################### fast exposure reader ###################### #
+
+def _read_exposure_header(fname):
+    """
+    Read the metadata of an exposure, stopping at the <assets> tag.
+
+    :param fname: path of the XML file containing the exposure
+    :returns: an :class:`Exposure` instance without assets
+    """
+    attrib = {}
+    description = None
+    cost_types = []
+    inslimit = deductible = None
+    area = dict(type='')
+    for event, el in iterparse(fname, events=('start', 'end')):
+        tag = striptag(el.tag)
+        if event == 'start':
+            if tag == 'exposureModel':
+                attrib = dict(el.attrib)
+            elif tag == 'assets':
+                break
+            continue
+        if tag == 'description':
+            description = valid.utf8(el.text or '')
+        elif tag == 'costType':
+            cost_types.append(
+                dict(el.attrib, name=valid.name(el.get('name')),
+                     type=valid.name(el.get('type'))))
+        elif tag == 'insuranceLimit':
+            inslimit = valid.boolean(el.get('isAbsolute'))
+        elif tag == 'deductible':
+            deductible = valid.boolean(el.get('isAbsolute'))
+        elif tag == 'area':
+            area = dict(el.attrib)
+    return Exposure(attrib['id'], attrib['category'], description,
+                    cost_types, inslimit, deductible, area, [], set())
+
+
+def _change_dtype(array, dtype):
+    """
+    :returns: a copy of the composite array with the new dtype; the new
+              float fields are filled with NaNs
+    """
+    new = numpy.zeros(len(array), dtype)
+    for name in dtype.names:
+        if name in array.dtype.names:
+            new[name] = array[name]
+        elif dtype[name].kind == 'f':
+            new[name] = numpy.nan
+    return new
+
+
+def read_exposure_array(fname, cost_types, number_required=False,
+                        region=None, ignore_missing_costs=(),
+                        block_size=65536):
+    """
+    Read the assets of an exposure with a streaming parser, without
+    building intermediate nodes, and store them in a composite array
+    which is filled by blocks and concatenated at the end. Missing values
+    are stored as NaNs.
+
+    :param fname: path of the XML file containing the exposure
+    :param cost_types: the cost types to read (including occupants, if any)
+    :param number_required: if True, raise an error for missing numbers
+    :param region: a shapely polygon (or None)
+    :param ignore_missing_costs: the cost types which can be missing
+    :param block_size: the number of rows to allocate each time
+    :returns: a triple (array, taxonomies, out_of_region)
+    """
+    relevant = sorted(set(cost_types) - set(['occupants']))
+    ignore_missing_costs = set(ignore_missing_costs)
+    fields = [('asset_ref', (bytes, 20)), ('taxonomy', numpy.uint32),
+              ('number', float), ('lon', float), ('lat', float),
+              ('area', float)]
+    for cost_type in relevant:
+        fields.extend([(cost_type, float),
+                       ('deductible~' + cost_type, float),
+                       ('insurance_limit~' + cost_type, float)])
+    if 'occupants' in cost_types:
+        fields.append(('fatalities_None', float))
+    dtype = numpy.dtype(fields)
+    blocks = []  # the filled blocks
+    block = numpy.zeros(0, dtype)
+    taxo_idx = {}
+    asset_refs = set()
+    out_of_region = 0
+    n = 0  # number of rows in the current block
+    assets = None
+    for event, el in iterparse(fname, events=('start', 'end')):
+        tag = striptag(el.tag)
+        if event == 'start':
+            if tag == 'assets':
+                assets = el
+            continue
+        elif tag != 'asset':
+            continue
+        asset_id = el.get('id')
+        taxonomy = el.get('taxonomy')
+        lineno = getattr(el, 'sourceline', '?')
+        if asset_id in asset_refs:
+            raise DuplicatedID(asset_id)
+        asset_refs.add(asset_id)
+        location = next(child for child in el.iter()
+                        if striptag(child.tag) == 'location')
+        lon, lat = float(location.get('lon')), float(location.get('lat'))
+        if region and not geometry.Point(lon, lat).within(region):
+            # discard the asset before filling a row
+            out_of_region += 1
+            el.clear()
+            if assets is not None:
+                assets.remove(el)  # save memory
+            continue
+        if n == len(block):  # start a new block of rows
+            if n:
+                blocks.append(block)
+            block = numpy.zeros(block_size, dtype)
+            for name in dtype.names[6:]:
+                block[name] = numpy.nan
+            n = 0
+        if len(asset_id) > dtype['asset_ref'].itemsize:
+            fields[0] = ('asset_ref', (bytes, len(asset_id)))
+            dtype = numpy.dtype(fields)
+            block = _change_dtype(block, dtype)
+        rec = block[n]
+        number = el.get('number')
+        if number is None:
+            if number_required:
+                raise KeyError("node asset: 'number', line %s of %s" %
+                               (lineno, fname))
+            rec['number'] = 1
+        else:
+            rec['number'] = float(number)
+            if 'occupants' in cost_types:
+                rec['fatalities_None'] = rec['number']
+        rec['area'] = float(el.get('area', 1))
+        rec['lon'] = lon
+        rec['lat'] = lat
+        found = set()
+        for child in el.iter():
+            ctag = striptag(child.tag)
+            if ctag == 'cost':
+                cost_type = child.get('type')
+                if cost_type not in relevant:
+                    continue
+                found.add(cost_type)
+                rec[cost_type] = float(child.get('value'))
+                deduct = child.get('deductible')
+                if deduct is not None:
+                    rec['deductible~' + cost_type] = float(deduct)
+                limit = child.get('insuranceLimit')
+                if limit is not None:
+                    rec['insurance_limit~' + cost_type] = float(limit)
+            elif ctag == 'occupancy':
+                name = 'fatalities_%s' % child.get('period')
+                if name not in dtype.names:
+                    fields.append((name, float))
+                    dtype = numpy.dtype(fields)
+                    block = _change_dtype(block, dtype)
+                    rec = block[n]
+                rec[name] = float(child.get('occupants'))
+        missing = set(relevant) - found
+        if missing and not missing <= ignore_missing_costs:
+            raise ValueError("Invalid Exposure. Missing cost %s for asset %s"
+                             % (missing, asset_id))
+        elif missing:
+            logging.warn('Ignoring asset %s, missing cost type(s): %s',
+                         asset_id, ', '.join(missing))
+        el.clear()
+        if assets is not None:
+            assets.remove(el)  # save memory
+        rec['asset_ref'] = asset_id
+        rec['taxonomy'] = taxo_idx.setdefault(taxonomy, len(taxo_idx))
+        n += 1
+    blocks.append(block[:n])
+    # the blocks filled before a change of dtype are converted only once
+    array = numpy.concatenate([
+        blk if blk.dtype == dtype else _change_dtype(blk, dtype)
+        for blk in blocks])
+    _check_exposure_array(array, fname)
+    taxonomies = sorted(taxo_idx, key=taxo_idx.get)
+    return array, taxonomies, out_of_region
+
+
+# validators used by nrml.ExposureDataNode, by column of the exposure array
+EXPOSURE_VALIDATORS = dict(
+    number=valid.compose(valid.positivefloat, valid.nonzero),
+    lon=valid.longitude,
+    lat=valid.latitude)
+
+
+def _check_exposure_array(array, fname):
+    # the same checks performed by get_exposure, on whole columns; the
+    # validators of nrml.ExposureDataNode are called on the first invalid
+    # value, to raise the same error
+    for name in array.dtype.names[2:]:
+        col = array[name]
+        if name == 'number':
+            bad = ~(col > 0)
+        elif name == 'lon':
+            bad = ~((col >= -180) & (col <= 180))
+        elif name == 'lat':
+            bad = ~((col >= -90) & (col <= 90))
+        else:  # NaNs are missing values
+            bad = numpy.zeros(len(col), bool)
+            ok = ~numpy.isnan(col)
+            bad[ok] = col[ok] < 0
+        if bad.any():
+            idx = bad.nonzero()[0][0]
+            validator = EXPOSURE_VALIDATORS.get(name, valid.positivefloat)
+            try:
+                validator(repr(col[idx]))
+            except ValueError as exc:
+                error = 'Could not convert %s->%s: %s' % (
+                    name, validator.__name__, exc)
+            else:  # NaN numbers and coordinates
+                error = 'Invalid %s=%s' % (name, col[idx])
+            raise ValueError('%s for asset %s in %s' % (
+                error, array['asset_ref'][idx], fname))
+    # sanity check
+    assert len(array), 'Could not find any value??'
+
+
+def get_exposure_array(oqparam, cache_dir=None):
+    """
+    Read the exposure with :func:`read_exposure_array`, or get it from
+    a cache file in the directory `<OQ_DATADIR>/cache`, keyed by the
+    checksum of the exposure file and of the relevant parameters.
+
+    :param oqparam:
+        an :class:`openquake.commonlib.oqvalidation.OqParam` instance
+    :param cache_dir:
+        the cache directory (if None, use `<OQ_DATADIR>/cache`)
+    :returns: a triple (array, taxonomies, out_of_region)
+    """
+    fname = oqparam.inputs['exposure']
+    cost_types = sorted(vulnerability_files(oqparam.inputs))
+    number_required = 'damage' in oqparam.calculation_mode
+    ignore_missing_costs = sorted(oqparam.ignore_missing_costs)
+    checksum = file_checksum(
+        fname, cost_types, number_required, oqparam.region_constraint,
+        ignore_missing_costs)
+    cache_dir = cache_dir or os.path.join(datastore.DATADIR, 'cache')
+    cache = os.path.join(cache_dir, 'exposure-%s.hdf5' % checksum)
+    if os.path.exists(cache):
+        logging.info('Reading the exposure from %s', cache)
+        with datastore.h5py.File(cache, 'r') as f:
+            return (f['assets'][()], list(f['taxonomies'][()]),
+                    f.attrs['out_of_region'])
+    region = (wkt.loads(oqparam.region_constraint)
+              if oqparam.region_constraint else None)
+    array, taxonomies, out_of_region = read_exposure_array(
+        fname, cost_types, number_required, region, ignore_missing_costs)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # write on a temporary file first, since other calculations could be
+    # reading the same exposure
+    fd, tmp = tempfile.mkstemp(suffix='.hdf5', dir=cache_dir)
+    os.close(fd)
+    with datastore.h5py.File(tmp, 'w') as f:
+        f['assets'] = array
+        f['taxonomies'] = numpy.array(taxonomies)
+        f.attrs['out_of_region'] = out_of_region
+    os.rename(tmp, cache)
+    logging.info('Saved the exposure in %s', cache)
+    return array, taxonomies, out_of_region
+
+
+def get_exposure_fast(oqparam):
+    """
+    Build an :class:`Exposure` instance from the array returned by
+    :func:`get_exposure_array`. This is used by :func:`get_exposure`
+    when the parameter `exposure_cache` is set. The assets are stored
+    in an :class:`openquake.risklib.riskinput.AssetCollection` built
+    directly from the array, so iterating on them yields AssetRecords.
+
+    :param oqparam:
+        an :class:`openquake.commonlib.oqvalidation.OqParam` instance
+    :returns:
+        an :class:`Exposure` instance
+    """
+    exposure = _read_exposure_header(oqparam.inputs['exposure'])
+    array, taxonomies, out_of_region = get_exposure_array(oqparam)
+    aggregated = {
+        ct['name']: (ct['type'] == 'aggregated' or
+                     exposure.area['type'] == 'aggregated')
+        for ct in exposure.cost_types}
+    assets = riskinput.AssetCollection.from_array(
+        array, taxonomies, aggregated, oqparam.time_event)
+    if oqparam.region_constraint:
+        logging.info('Read %d assets within the region_constraint '
+                     'and discarded %d assets outside the region',
+                     len(assets), out_of_region)
+    else:
+        logging.info('Read %d assets', len(assets))
+    return exposure._replace(assets=assets, taxonomies=set(taxonomies))
+
+
 def get_specific_assets(oqparam):
     """
     Get the assets from the parameters specific_assets or specific_assets_csv
@@ -0,0 +1,206 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2015, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A spatial index over a site collection, used to speed up the filtering
+of the sites by distance to the sources and to the ruptures. The sites
+are stored in a k-d tree on their Cartesian coordinates; a source (or a
+rupture) is enclosed in a ball and only the sites inside the ball are
+passed to the exact filters of hazardlib. In this way the filtering of
+a source costs O(log N + K) instead of O(N), where N is the number of
+sites and K the number of sites close to the source.
+"""
+import hashlib
+
+import numpy
+from scipy.spatial import cKDTree
+
+from openquake.hazardlib.calc import filters
+from openquake.hazardlib.geo.geodetic import EARTH_RADIUS
+from openquake.hazardlib.geo.utils import spherical_to_cartesian
+
+# relative and absolute (in km) enlargements of the enclosing balls,
+# to take into account the approximations in the exact filters
+REL_MARGIN = 0.01
+ABS_MARGIN = 1.
+
+# collections with less sites are not indexed
+MIN_SITES = 100
+
+# k-d trees already built in the current process, by checksum of the sites
+_trees = {}
+
+
+class SiteIndex(object):
+    """
+    Spatial index over a site collection. The k-d tree is built lazily,
+    the first time it is needed, and it is cached in the current process,
+    so that the index can be sent to many tasks without building the tree
+    more than once per worker.
+
+    :param sitecol:
+        a :class:`openquake.hazardlib.site.SiteCollection` instance
+        (or a filtered site collection)
+    """
+    def __init__(self, sitecol):
+        self.sitecol = sitecol
+        self.checksum = None
+        if len(sitecol) >= MIN_SITES:
+            sha1 = hashlib.sha1(numpy.ascontiguousarray(sitecol.lons))
+            sha1.update(numpy.ascontiguousarray(sitecol.lats))
+            self.checksum = sha1.hexdigest()
+
+    @property
+    def tree(self):
+        """
+        The k-d tree over the Cartesian coordinates of the sites
+        """
+        try:
+            return _trees[self.checksum]
+        except KeyError:
+            _trees.clear()  # keep a single tree per process
+            xyz = spherical_to_cartesian(self.sitecol.lons, self.sitecol.lats)
+            tree = _trees[self.checksum] = cKDTree(xyz)
+            return tree
+
+    def _positions(self, sites):
+        # positions in the indexed collection of a subset of its sites
+        indices = getattr(self.sitecol, 'indices', None)
+        if indices is None:
+            return sites.indices
+        return numpy.searchsorted(indices, sites.indices)
+
+    def close_sites(self, lons, lats, dilation, sites=None):
+        """
+        Find the sites which can be within `dilation` km from the region
+        enclosed by the given points, i.e. the sites in a ball containing
+        the region and enlarged by `dilation`. The region must be smaller
+        than a hemisphere, otherwise no prefiltering is performed.
+
+        :param lons: longitudes of the points enclosing the region
+        :param lats: latitudes of the points enclosing the region
+        :param dilation: distance in km
+        :param sites:
+            a subset of the indexed sites (default: all of them)
+        :returns:
+            a subset of `sites` or None if all the sites are far away
+        """
+        if sites is None:
+            sites = self.sitecol
+        if self.checksum is None:  # too few sites to be indexed
+            return sites
+        xyz = spherical_to_cartesian(lons, lats).reshape(-1, 3)
+        center = xyz.mean(axis=0)
+        norm = numpy.sqrt(numpy.dot(center, center))
+        if norm == 0:  # degenerate region
+            return sites
+        center *= EARTH_RADIUS / norm
+        # all the points of the region are within the cone around the
+        # center containing the given points, if its angle is < 90 degrees
+        chord = numpy.sqrt(((xyz - center) ** 2).sum(axis=1)).max()
+        angle = 2 * numpy.arcsin(min(chord / 2 / EARTH_RADIUS, 1))
+        if angle >= numpy.pi / 2:
+            return sites
+        angle = (angle * (1 + REL_MARGIN) +
+                 (dilation * (1 + REL_MARGIN) + ABS_MARGIN) / EARTH_RADIUS)
+        if angle >= numpy.pi:
+            return sites
+        radius = 2 * EARTH_RADIUS * numpy.sin(angle / 2)
+        mask = numpy.zeros(len(self.sitecol), bool)
+        mask[self.tree.query_ball_point(center, radius)] = True
+        if len(sites) < len(self.sitecol):
+            mask = mask[self._positions(sites)]
+        return sites.filter(mask)
+
+    def filter_sites_by_distance_to_source(self, src, maxdist, sites=None):
+        """
+        Equivalent to `src.filter_sites_by_distance_to_source`, but the
+        distances are computed only for the sites close to the source.
+
+        :param src: a hazardlib source
+        :param maxdist: the maximum distance in km
+        :param sites: a subset of the indexed sites (default: all of them)
+        :returns: a filtered site collection or None
+        """
+        if sites is None:
+            sites = self.sitecol
+        if self.checksum is not None:
+            try:
+                poly = src.get_rupture_enclosing_polygon(maxdist)
+            except (AttributeError, NotImplementedError):
+                pass  # i.e. nonparametric sources, no prefiltering
+            else:
+                sites = self.close_sites(poly.lons, poly.lats, 0, sites)
+                if sites is None:
+                    return
+        return src.filter_sites_by_distance_to_source(maxdist, sites)
+
+    def filter_sites_by_distance_to_rupture(self, rupture, maxdist,
+                                            sites=None):
+        """
+        Equivalent to `filters.filter_sites_by_distance_to_rupture`, but
+        the distances are computed only for the sites close to the rupture.
+
+        :param rupture: a hazardlib rupture
+        :param maxdist: the maximum distance in km
+        :param sites: a subset of the indexed sites (default: all of them)
+        :returns: a filtered site collection or None
+        """
+        if sites is None:
+            sites = self.sitecol
+        if self.checksum is not None:
+            try:
+                mesh = rupture.surface.get_mesh()
+            except (AttributeError, NotImplementedError):
+                pass  # i.e. multi surfaces, no prefiltering
+            else:
+                sites = self.close_sites(mesh.lons, mesh.lats, maxdist, sites)
+                if sites is None:
+                    return
+        return filters.filter_sites_by_distance_to_rupture(
+            rupture, maxdist, sites)
+
+    def source_site_filter(self, maxdist):
+        """
+        :param maxdist: the maximum distance in km
+        :returns:
+            a source-site filter, equivalent to
+            `filters.source_site_distance_filter(maxdist)`
+        """
+        def filter_func(sources_sites):
+            for src, sites in sources_sites:
+                s_sites = self.filter_sites_by_distance_to_source(
+                    src, maxdist, sites)
+                if s_sites is not None:
+                    yield src, s_sites
+        return filter_func
+
+    def rupture_site_filter(self, maxdist):
+        """
+        :param maxdist: the maximum distance in km
+        :returns:
+            a rupture-site filter, equivalent to
+            `filters.rupture_site_distance_filter(maxdist)`
+        """
+        def filter_func(ruptures_sites):
+            for rupture, sites in ruptures_sites:
+                r_sites = self.filter_sites_by_distance_to_rupture(
+                    rupture, maxdist, sites)
+                if r_sites is not None:
+                    yield rupture, r_sites
+        return filter_func
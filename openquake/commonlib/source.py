@@ -13,11 +13,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import mock
 import time
+import cPickle
+import tempfile
 import logging
 import operator
-import itertools
 import collections
 import random
 from lxml import etree
@@ -25,8 +27,12 @@ from lxml import etree
 import numpy
 
 from openquake.baselib.general import AccumDict, groupby
+from openquake.baselib.performance import DummyMonitor
 from openquake.commonlib.node import read_nodes
-from openquake.commonlib import valid, logictree, sourceconverter, parallel
+from openquake.commonlib.util import file_checksum
+from openquake.commonlib.siteindex import SiteIndex
+from openquake.commonlib import (
+    valid, logictree, sourceconverter, parallel, InvalidFile)
 from openquake.commonlib.nrml import nodefactory, PARSE_NS_MAP
 
 
@@ -209,41 +215,258 @@ class TrtModel(collections.Sequence):
         return len(self.sources)
 
 
-def parse_source_model(fname, converter, apply_uncertainties=lambda src: None):
+# files bigger than that are converted in slices, in parallel
+PARSE_SLICE_SIZE = 10 * 1024 * 1024  # bytes
+
+# errors raised by the converter on source models in the old format
+OBSOLETE_SOURCE_ERRORS = (
+    'Surface does not conform with Aki & Richards convention',
+    'Edges points are not in the right order')
+
+
+def read_source_nodes(fname):
     """
-    Parse a NRML source model and return an ordered list of TrtModel
-    instances.
+    :param str fname:
+        the full pathname of a NRML source model file
+    :returns:
+        a lazy iterator over the source nodes of the file
+    """
+    return read_nodes(fname, lambda elem: 'Source' in elem.tag,
+                      nodefactory['sourceModel'])
+
+
+@parallel.litetask
+def convert_sources(fname, converter, src_nodes, start, monitor):
+    """
+    Convert a block of source nodes of a NRML source model.
 
     :param str fname:
         the full pathname of the source model file
     :param converter:
         :class:`openquake.commonlib.source.SourceConverter` instance
-    :param apply_uncertainties:
-        a function modifying the sources (or do nothing)
+    :param src_nodes:
+        a list of source nodes, or None to convert all the sources in
+        the file, which is parsed by the task itself
+    :param start:
+        the ordinal of the first source node in the file
+    :param monitor:
+        a monitor instance
+    :returns:
+        a dictionary fname -> list of pairs (ordinal, source)
     """
     converter.fname = fname
-    source_stats_dict = {}
-    source_ids = set()
-    src_nodes = read_nodes(fname, lambda elem: 'Source' in elem.tag,
-                           nodefactory['sourceModel'])
+    if src_nodes is None:
+        src_nodes = read_source_nodes(fname)
+    pairs = []
     for no, src_node in enumerate(src_nodes, 1):
-        src = converter.convert_node(src_node)
+        try:
+            src = converter.convert_node(src_node)
+        except ValueError as e:
+            if any(err in str(e) for err in OBSOLETE_SOURCE_ERRORS):
+                raise InvalidFile('''\
+    %s: %s. Probably you are using an obsolete model.
+    In that case you can fix the file with the command
+    python -m openquake.engine.tools.correct_complex_sources %s
+    ''' % (fname, e, fname))
+            raise
+        pairs.append((start + no - 1, src))
+        if no % 10000 == 0:  # log every 10,000 sources parsed
+            logging.info('Parsed %d sources from %s', no, fname)
+    return {fname: pairs}
+
+
+def merge_slices(pairs):
+    """
+    Merge the slices returned by :func:`convert_sources` and check that
+    there are no duplicated source IDs.
+
+    :param pairs: a list of pairs (ordinal, source) in any order
+    :returns: the list of sources in the order of the source model file
+    """
+    sources = []
+    source_ids = set()
+    for _no, src in sorted(pairs, key=operator.itemgetter(0)):
         if src.source_id in source_ids:
             raise DuplicatedID(
                 'The source ID %s is duplicated!' % src.source_id)
+        sources.append(src)
+        source_ids.add(src.source_id)
+    return sources
+
+
+def parse_sources(fname, converter):
+    """
+    Parse a NRML source model and return the list of its sources,
+    converted into hazardlib objects.
+
+    :param str fname:
+        the full pathname of the source model file
+    :param converter:
+        :class:`openquake.commonlib.source.SourceConverter` instance
+    """
+    pairs = convert_sources.task_func(
+        fname, converter, None, 0, DummyMonitor())
+    return merge_slices(pairs[fname])
+
+
+def build_trt_models(sources, apply_uncertainties=lambda src: None):
+    """
+    Apply the uncertainties to the sources and return an ordered list
+    of TrtModel instances.
+
+    :param sources:
+        a sequence of hazardlib sources
+    :param apply_uncertainties:
+        a function modifying the sources (or do nothing)
+    """
+    source_stats_dict = {}
+    for src in sources:
         apply_uncertainties(src)
         trt = src.tectonic_region_type
         if trt not in source_stats_dict:
             source_stats_dict[trt] = TrtModel(trt)
         source_stats_dict[trt].update(src)
-        source_ids.add(src.source_id)
-        if no % 10000 == 0:  # log every 10,000 sources parsed
-            logging.info('Parsed %d sources from %s', no, fname)
-
     # return ordered TrtModels
     return sorted(source_stats_dict.itervalues())
 
 
+def parse_source_model(fname, converter, apply_uncertainties=lambda src: None):
+    """
+    Parse a NRML source model and return an ordered list of TrtModel
+    instances.
+
+    :param str fname:
+        the full pathname of the source model file
+    :param converter:
+        :class:`openquake.commonlib.source.SourceConverter` instance
+    :param apply_uncertainties:
+        a function modifying the sources (or do nothing)
+    """
+    return build_trt_models(
+        parse_sources(fname, converter), apply_uncertainties)
+
+
+class SourceModelParser(object):
+    """
+    Parse the source model files, converting each file only once even
+    if it is used by many branches of the source model logic tree.
+    The converted sources are kept in memory and each branch gets a copy
+    of them, with its uncertainties applied. If a cache directory is given,
+    the converted sources are also pickled there, in a file named after the
+    checksum of the source model file and of the converter parameters, so
+    that later calculations on the same file do not read the XML at all.
+
+    :param converter:
+        :class:`openquake.commonlib.source.SourceConverter` instance
+    :param cache_dir:
+        the directory of the pickled sources, or None
+    """
+    def __init__(self, converter, cache_dir=None):
+        self.converter = converter
+        self.cache_dir = cache_dir
+        self.sources = {}  # fname -> pickled sources
+
+    def _cache_path(self, fname):
+        conv = self.converter
+        checksum = file_checksum(
+            fname, conv.tom.time_span, conv.rupture_mesh_spacing,
+            conv.complex_fault_mesh_spacing, conv.width_of_mfd_bin,
+            conv.area_source_discretization)
+        return os.path.join(self.cache_dir, 'sources-%s.pik' % checksum)
+
+    def _read_cache(self, fname):
+        # read the pickled sources from the cache directory, if any
+        if self.cache_dir is None:
+            return
+        cache = self._cache_path(fname)
+        if os.path.exists(cache):
+            logging.info('Reading the sources of %s from %s', fname, cache)
+            with open(cache, 'rb') as f:
+                self.sources[fname] = f.read()
+
+    def _store(self, fname, sources):
+        # keep the pickled sources in memory and in the cache directory
+        data = self.sources[fname] = cPickle.dumps(
+            sources, cPickle.HIGHEST_PROTOCOL)
+        if self.cache_dir is None:
+            return
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        # write on a temporary file first, since other calculations could be
+        # reading the same source model
+        cache = self._cache_path(fname)
+        fd, tmp = tempfile.mkstemp(suffix='.pik', dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, cache)
+        logging.info('Saved the sources of %s in %s', fname, cache)
+
+    def parse_files(self, fnames, concurrent_tasks=0,
+                    monitor=DummyMonitor()):
+        """
+        Convert the given source model files, unless they are already
+        in memory or in the cache directory. If `concurrent_tasks` is
+        nonzero the files are converted in parallel; the files bigger than
+        `PARSE_SLICE_SIZE` are parsed once and their source nodes are split
+        in slices, converted by different tasks and merged back in the
+        original order.
+
+        :param fnames:
+            a sequence of source model file names
+        :param concurrent_tasks:
+            hint about the number of tasks to generate (0 = no parallelism)
+        :param monitor:
+            a monitor instance
+        """
+        todo = []
+        for fname in fnames:
+            if fname not in self.sources and fname not in todo:
+                self._read_cache(fname)
+                if fname not in self.sources:
+                    todo.append(fname)
+        all_args = []
+        for fname in todo:
+            nslices = min(os.path.getsize(fname) // PARSE_SLICE_SIZE + 1,
+                          concurrent_tasks or 1)
+            if nslices == 1:  # the file is parsed by the task
+                all_args.append((fname, self.converter, None, 0, monitor))
+                continue
+            # the file is parsed only once, here, and the tasks
+            # convert contiguous blocks of source nodes
+            src_nodes = list(read_source_nodes(fname))
+            size = -(-len(src_nodes) // nslices)  # ceil division
+            all_args.extend(
+                (fname, self.converter, src_nodes[start:start + size],
+                 start, monitor)
+                for start in range(0, len(src_nodes), size))
+        if len(all_args) > 1 and concurrent_tasks:
+            pairs = parallel.starmap(convert_sources, all_args).reduce(
+                acc=AccumDict())
+        else:  # convert the files in the current process
+            pairs = AccumDict()
+            for args in all_args:
+                pairs += convert_sources.task_func(*args)
+        for fname in todo:
+            self._store(fname, merge_slices(pairs[fname]))
+
+    def parse_trt_models(self, fname, apply_uncertainties=lambda src: None):
+        """
+        :param str fname:
+            the full pathname of the source model file
+        :param apply_uncertainties:
+            a function modifying the sources (or do nothing)
+        :returns:
+            an ordered list of TrtModel instances with fresh copies of
+            the sources of the given file
+        """
+        if fname not in self.sources:
+            self.parse_files([fname])
+        # unpickling is the cheapest way to get a deep copy of the
+        # sources, which are modified by apply_uncertainties
+        sources = cPickle.loads(self.sources[fname])
+        return build_trt_models(sources, apply_uncertainties)
+
+
 def agg_prob(acc, prob):
     """Aggregation function for probabilities"""
     return 1. - (1. - acc) * (1. - prob)
@@ -348,6 +571,26 @@ class RlzsAssoc(collections.Mapping):
                 ad[rlz] = agg(ad[rlz], value)
         return ad
 
+    def gen_curves_by_rlz(self, results, agg, acc):
+        """
+        Same as :meth:`combine_curves`, but yielding the aggregated curves
+        one realization at the time, so that they are never all in memory.
+
+        :param results: dictionary (trt_model_id, gsim_name) -> curves
+        :param agg: aggregation function (composition of probabilities)
+        :yields: pairs (rlz, aggregated curves) in the realizations order
+        """
+        keys_by_rlz = collections.defaultdict(list)
+        for key, rlzs in self.rlzs_assoc.iteritems():
+            if key in results:
+                for rlz in rlzs:
+                    keys_by_rlz[rlz].append(key)
+        for rlz in self.realizations:
+            curves = acc
+            for key in keys_by_rlz[rlz]:
+                curves = agg(curves, results[key])
+            yield rlz, curves
+
     def combine_gmfs(self, gmfs):
         """
         :param gmfs: datastore /gmfs object
@@ -696,12 +939,13 @@ def filter_and_split(src, sourceprocessor):
     :returns: a named tuple of type SourceInfo
     """
     if sourceprocessor.sitecol:  # filter
-        info = sourceprocessor.filter(src)
+        info, sites = sourceprocessor.filter_sites(src)
         if not info.sources:
             return info  # filtered away
         filter_time = info.filter_time
     else:  # only split
         filter_time = 0
+        sites = None
     t1 = time.time()
     out = []
     weight_time = 0
@@ -709,7 +953,8 @@ def filter_and_split(src, sourceprocessor):
     for ss in sourceconverter.split_source(src, sourceprocessor.asd):
         if sourceprocessor.weight:
             t = time.time()
-            ss.weight = get_weight(ss)
+            # the sites close to the parent source are reused
+            sourceprocessor.set_weight(ss, sites)
             weight_time += time.time() - t
             weight += ss.weight
         out.append(ss)
@@ -719,6 +964,17 @@ def filter_and_split(src, sourceprocessor):
                       weight, out, filter_time, weight_time, split_time)
 
 
+def filter_and_split_block(sources, sourceprocessor):
+    """
+    Filter and split a block of sources by using the source processor.
+
+    :param sources: a list of hazardlib source objects
+    :param sourceprocessor: a SourceFilterSplitter object
+    :returns: a list of SourceInfo named tuples, one per source
+    """
+    return [filter_and_split(src, sourceprocessor) for src in sources]
+
+
 SourceInfo = collections.namedtuple(
     'SourceInfo', 'trt_model_id source_id source_class weight sources '
     'filter_time weight_time split_time')
@@ -733,6 +989,55 @@ source_info_dt = numpy.dtype(
      ('weight_time', numpy.float32),
      ('split_time', numpy.float32)])
 
+# the timings of the sources measured by the classical calculator
+source_data_dt = numpy.dtype(
+    [('source_id', (str, 20)),
+     ('source_class', (str, 20)),
+     ('num_ruptures', numpy.uint32),
+     ('num_sites', numpy.uint32),
+     ('num_gsims', numpy.uint16),
+     ('calc_time', numpy.float32)])
+
+
+class CostModel(object):
+    """
+    A model of the computational cost of the sources, calibrated on the
+    timings measured in a previous calculation. The cost of a source is
+    assumed to be proportional to the number of ruptures, to the number
+    of sites within the maximum distance and to the number of GSIMs,
+    with a coefficient depending on the source class. The weights are
+    normalized so that a rupture of average cost has weight 1, as in
+    :func:`get_weight`.
+
+    :param source_data: an array of dtype `source_data_dt`
+    """
+    def __init__(self, source_data):
+        num_ruptures = source_data['num_ruptures'].astype(float)
+        size = (num_ruptures * numpy.maximum(source_data['num_sites'], 1) *
+                source_data['num_gsims'])
+        calc_time = source_data['calc_time']
+        if not calc_time.sum() or not size.sum():
+            raise ValueError('There are no timings to calibrate the '
+                             'cost model')
+        self.time_per_rupture = calc_time.sum() / num_ruptures.sum()
+        self.default = calc_time.sum() / size.sum()
+        self.coeff = {}  # source class -> time per rupture, site and GSIM
+        for cls in numpy.unique(source_data['source_class']):
+            ok = source_data['source_class'] == cls
+            if calc_time[ok].sum() and size[ok].sum():
+                self.coeff[cls] = calc_time[ok].sum() / size[ok].sum()
+
+    def get_weight(self, src, num_sites, num_gsims):
+        """
+        :param src: a hazardlib source with a `.num_ruptures` attribute
+        :param num_sites: the number of sites within the maximum distance
+        :param num_gsims: the number of GSIMs of the source
+        :returns: the predicted cost of the source, in units of ruptures
+        """
+        coeff = self.coeff.get(src.__class__.__name__, self.default)
+        return (src.num_ruptures * max(num_sites, 1) * num_gsims * coeff /
+                self.time_per_rupture)
+
 
 class BaseSourceProcessor(object):
     """
@@ -744,13 +1049,42 @@ class BaseSourceProcessor(object):
         maximum distance for the filtering
     :param area_source_discretization:
         area source discretization
+    :param cost_model:
+        a :class:`CostModel` instance, or None
     """
     weight = False  # when True, set the weight on each source
 
-    def __init__(self, sitecol, maxdist, area_source_discretization=None):
+    def __init__(self, sitecol, maxdist, area_source_discretization=None,
+                 cost_model=None):
         self.sitecol = sitecol
         self.maxdist = maxdist
         self.asd = area_source_discretization
+        self.cost_model = cost_model
+        self.index = None if sitecol is None else SiteIndex(sitecol)
+        self.num_gsims = {}  # trt_model_id -> number of GSIMs
+
+    def set_weight(self, src, sites=None):
+        """
+        Set the attributes `.num_ruptures` and `.weight` of the given
+        source. Without a cost model the weight is given by
+        :func:`get_weight`, otherwise it is the cost predicted by the
+        model on the sites within the maximum distance.
+
+        :param src: a hazardlib source object
+        :param sites: the sites close to the source (None = compute them)
+        :returns: the weight of the source
+        """
+        src.num_ruptures = src.count_ruptures()
+        if self.cost_model is None or self.index is None:
+            src.weight = get_weight(src, num_ruptures=src.num_ruptures)
+        else:
+            if sites is None:
+                sites = self.index.filter_sites_by_distance_to_source(
+                    src, self.maxdist)
+            src.weight = self.cost_model.get_weight(
+                src, 0 if sites is None else len(sites),
+                self.num_gsims.get(src.trt_model_id, 1))
+        return src.weight
 
 
 class SourceFilter(BaseSourceProcessor):
@@ -760,23 +1094,34 @@ class SourceFilter(BaseSourceProcessor):
     information about the processing times.
     """
     def filter(self, src):
+        """
+        :param src: a hazardlib source object
+        :returns: a SourceInfo instance
+        """
+        return self.filter_sites(src)[0]
+
+    def filter_sites(self, src):
+        """
+        :param src: a hazardlib source object
+        :returns: a SourceInfo instance and the sites close to the source
+        """
         t0 = time.time()
-        sites = src.filter_sites_by_distance_to_source(
-            self.maxdist, self.sitecol)
+        sites = self.index.filter_sites_by_distance_to_source(
+            src, self.maxdist)
         t1 = time.time()
         filter_time = t1 - t0
         if sites is not None and self.weight:
             t2 = time.time()
-            weight = get_weight(src)
-            src.weight = weight
+            weight = self.set_weight(src, sites)
             weight_time = time.time() - t2
         else:
             weight = numpy.nan
             weight_time = 0
         sources = [] if sites is None else [src]
-        return SourceInfo(
+        info = SourceInfo(
             src.trt_model_id, src.source_id, src.__class__.__name__,
             weight, sources, filter_time, weight_time, 0)
+        return info, sites
 
     def agg_source_info(self, acc, info):
         """
@@ -795,6 +1140,7 @@ class SourceFilter(BaseSourceProcessor):
         :returns: the times spent in sequential and parallel processing
         """
         sources = csm.get_sources()
+        self.num_gsims = {tm.id: len(tm.gsims) or 1 for tm in csm.trt_models}
         self.infos = []
         seqtime, partime = 0, 0
         sources_by_trt = AccumDict()
@@ -849,51 +1195,88 @@ class SourceFilterSplitter(SourceFilterWeighter):
     Filter and split in parallel the sources of the given CompositeSourceModel
     instance. An array `.source_info` is added to the instance, containing
     information about the processing times and the splitting process.
+    The slow sources are sent to the workers one per task; the fast
+    sources (point and area sources) are processed in the master if they
+    are few, otherwise they are sent to the workers in blocks of
+    `fast_block_size` sources.
 
     :param sitecol: a SiteCollection instance
     :param maxdist: maximum distance for the filtering
     :param area_source_discretization: area source discretization
     """
+    fast_block_size = 5000  # number of fast sources per task
+
+    def agg_source_infos(self, acc, infos):
+        """
+        :param acc: a dictionary {trt_model_id: sources}
+        :param infos: a list of SourceInfo instances
+        """
+        return reduce(self.agg_source_info, infos, acc)
+
     def process(self, csm, no_distribute=False):
         """
         :param csm: a CompositeSourceModel instance
         :param no_distribute: flag to disable parallel processing
-        :returns: the times spent in sequential and parallel processing
+        :returns: the times spent in processing the fast and slow sources;
+                  if the fast sources are processed in parallel, they are
+                  the total times spent in the tasks for each kind
         """
         sources = csm.get_sources()
-        fast_sources = [(src, self) for src in sources
+        fast_sources = [src for src in sources
                         if src.__class__.__name__ in
                         ('PointSource', 'AreaSource')]
         slow_sources = [(src, self) for src in sources
                         if src.__class__.__name__ not in
                         ('PointSource', 'AreaSource')]
+        blocks = [(fast_sources[i:i + self.fast_block_size], self)
+                  for i in range(0, len(fast_sources), self.fast_block_size)]
+        parallel_fast = len(blocks) > 1
+        self.num_gsims = {tm.id: len(tm.gsims) or 1 for tm in csm.trt_models}
         self.infos = []
         seqtime, partime = 0, 0
         sources_by_trt = AccumDict()
 
         # start multicore processing
-        if slow_sources:
-            t0 = time.time()
-            logging.warn('Processing %d slow sources...', len(slow_sources))
-            with mock.patch.object(
-                    parallel, 'no_distribute', lambda: no_distribute):
+        t0 = time.time()
+        with mock.patch.object(
+                parallel, 'no_distribute', lambda: no_distribute):
+            if slow_sources:
+                logging.warn(
+                    'Processing %d slow sources...', len(slow_sources))
                 ss = parallel.TaskManager.starmap(
                     filter_and_split, slow_sources)
+            if parallel_fast:
+                logging.info('Processing %d fast sources in %d blocks...',
+                             len(fast_sources), len(blocks))
+                fs = parallel.TaskManager.starmap(
+                    filter_and_split_block, blocks)
 
         # single core processing
-        if fast_sources:
+        if fast_sources and not parallel_fast:
             logging.info('Processing %d fast sources...', len(fast_sources))
             t1 = time.time()
             sources_by_trt += reduce(
                 self.agg_source_info,
-                itertools.starmap(filter_and_split, fast_sources), AccumDict())
+                (filter_and_split(src, self) for src in fast_sources),
+                AccumDict())
             seqtime = time.time() - t1
 
         # finish multicore processing
-        sources_by_trt += (ss.reduce(self.agg_source_info)
-                           if slow_sources else {})
+        if parallel_fast:
+            sources_by_trt += fs.reduce(self.agg_source_infos)
         if slow_sources:
+            sources_by_trt += ss.reduce(self.agg_source_info)
             partime = time.time() - t0
+        if parallel_fast:
+            # the fast and slow tasks run concurrently, so the wall clock
+            # time cannot be split; use the times measured in the tasks
+            seqtime = partime = 0
+            for info in self.infos:
+                dt = info.filter_time + info.weight_time + info.split_time
+                if info.source_class in ('PointSource', 'AreaSource'):
+                    seqtime += dt
+                else:
+                    partime += dt
 
         self.update(csm, sources_by_trt)
 
@@ -23,6 +23,7 @@ from openquake.hazardlib.tom import PoissonTOM
 from openquake.commonlib.node import context, striptag
 from openquake.commonlib import valid
 from openquake.commonlib import parallel
+from openquake.commonlib.siteindex import SiteIndex
 
 # this must stay here for the nrml_converters: don't remove it!
 from openquake.commonlib.obsolete import NrmlHazardlibConverter
@@ -643,8 +644,9 @@ def parse_ses_ruptures(fname):
 def _filter_sources(sources, sitecol, maxdist, monitor):
     # called by filter_sources
     srcs = []
+    index = SiteIndex(sitecol)
     for src in sources:
-        sites = src.filter_sites_by_distance_to_source(maxdist, sitecol)
+        sites = index.filter_sites_by_distance_to_source(src, maxdist)
         if sites is not None:
             srcs.append(src)
     return srcs
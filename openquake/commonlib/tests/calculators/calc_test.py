@@ -1,5 +1,7 @@
 import unittest
 import numpy
+from openquake.hazardlib.calc.hazard_curve import zero_curves
+from openquake.risklib import scientific
 from openquake.commonlib.calculators import calc
 
 aaae = numpy.testing.assert_array_almost_equal
@@ -38,3 +40,84 @@ class HazardMapsTestCase(unittest.TestCase):
         ]
         actual = calc.compute_hazard_maps(curves, imls, poes)
         aaae(expected, actual.T)
+
+    def test_compute_hazard_maps_by_block(self):
+        imtls = {'PGA': [0.005, 0.007, 0.0098]}
+        curves = numpy.zeros(5, [('PGA', (float, (3,)))])
+        curves['PGA'] = [
+            [0.8, 0.5, 0.1],
+            [0.98, 0.15, 0.05],
+            [0.6, 0.5, 0.4],
+            [0.1, 0.01, 0.001],
+            [0.8, 0.2, 0.1],
+        ]
+        poes = [0.1, 0.2]
+        hmaps = numpy.zeros((5, 2), [('PGA', float)])
+        calc.compute_hazard_maps_by_block(curves, imtls, poes, hmaps,
+                                          block_size=2)
+        aaae(hmaps['PGA'], calc.compute_hazard_maps(
+            curves['PGA'], imtls['PGA'], poes))
+
+    def test_compute_hazard_map_single_level(self):
+        actual = calc.compute_hazard_maps([[0.5], [0.05]], [0.1], [0.1])
+        aaae(actual, [[0.1], [0]])
+
+
+class ExceedanceCountsTestCase(unittest.TestCase):
+    imtls = {'PGA': [0.03, 0.04, 0.05]}
+
+    def test_same_as_gmvs_to_haz_curve(self):
+        gmvs_by_sid = {0: [0.04750576, 0.02, 0.05], 1: [], 2: [0.1, 0.04]}
+        sids = [0, 0, 0, 2, 2]
+        gmvs = [0.04750576, 0.02, 0.05, 0.1, 0.04]
+        counts = calc.zero_counts(3, self.imtls)
+        calc.count_exceedances(counts['PGA'], sids, gmvs, self.imtls['PGA'])
+        numpy.testing.assert_equal(
+            counts['PGA'], [[2, 2, 1], [0, 0, 0], [2, 2, 1]])
+        curves = calc.counts_to_curves(counts, 50., 500.)
+        for sid in range(3):
+            aaae(curves['PGA'][sid], calc.gmvs_to_haz_curve(
+                gmvs_by_sid[sid], self.imtls['PGA'], 50., 500.))
+
+    def test_merge_by_addition(self):
+        acc = calc.zero_counts(2, self.imtls)
+        for sids, gmvs in [([0, 1], [0.035, 0.06]), ([1], [0.045])]:
+            counts = calc.zero_counts(2, self.imtls)
+            calc.count_exceedances(counts['PGA'], sids, gmvs,
+                                   self.imtls['PGA'])
+            calc.agg_counts(acc, counts)
+        numpy.testing.assert_equal(acc['PGA'], [[1, 0, 0], [2, 2, 1]])
+
+
+class ComputeStatsTestCase(unittest.TestCase):
+    imtls = {'PGA': [0.1, 0.2], 'SA(0.1)': [0.1, 0.2, 0.3]}
+
+    def setUp(self):
+        rng = numpy.random.RandomState(42)
+        self.curves_by_rlz = []
+        for rlz in range(4):
+            curves = zero_curves(5, self.imtls)
+            for imt in self.imtls:
+                curves[imt] = rng.random_sample(curves[imt].shape)
+            self.curves_by_rlz.append(curves)
+
+    def gen_curves(self, start, stop):
+        for curves in self.curves_by_rlz:
+            yield curves[start:stop]
+
+    def check(self, weights):
+        mean, quantiles = calc.compute_stats(
+            self.gen_curves, 4, 5, self.imtls, weights, [0.1, 0.5],
+            block_size=2)
+        for imt in self.imtls:
+            curves = [c[imt] for c in self.curves_by_rlz]
+            aaae(mean[imt], scientific.mean_curve(curves, weights))
+            for q in (0.1, 0.5):
+                aaae(quantiles[q][imt], scientific.quantile_curve(
+                    curves, q, weights).reshape((5, -1)))
+
+    def test_weighted(self):
+        self.check([0.1, 0.2, 0.3, 0.4])
+
+    def test_sampling(self):
+        self.check(None)
@@ -1,3 +1,4 @@
+import numpy
 from nose.plugins.attrib import attr
 from openquake.commonlib.tests.calculators import CalculatorTestCase
 from openquake.qa_tests_data.classical import (
@@ -173,3 +174,23 @@ hazard_uhs-smltp_SM2_a3pt2b0pt8-gsimltp_CB2008_@.csv'''.split(),
             'hazard_curve-smltp_b1-gsimltp_@_@_@_@_b53_@_@.csv',
             'hazard_curve-smltp_b1-gsimltp_@_@_@_@_b54_@_@.csv',
         ], case_19.__file__, delta=1E-7)
+
+    @attr('qa', 'hazard', 'classical')
+    def test_cost_model(self):
+        # the first run stores the timings of the computed sources
+        self.run_calc(case_1.__file__, 'job.ini')
+        calc_id = self.calc.datastore.calc_id
+        sources = self.calc.composite_source_model.get_sources()
+        source_data = self.calc.datastore['source_data'].value
+        self.assertEqual(sorted(source_data['source_id']),
+                         sorted(src.source_id for src in sources))
+        self.assertGreater(source_data['calc_time'].sum(), 0)
+        weights = self.calc.datastore['source_info'].value['weight']
+
+        # the second run weights the sources with the cost model; the
+        # point source has weight 1/40 per rupture by default, while the
+        # model gives weight 1 to a rupture of average cost
+        self.run_calc(case_1.__file__, 'job.ini',
+                      cost_model_calculation_id=calc_id)
+        new_weights = self.calc.datastore['source_info'].value['weight']
+        numpy.testing.assert_allclose(new_weights, weights * 40, rtol=1E-6)
@@ -0,0 +1,62 @@
+import os
+
+import numpy
+from nose.plugins.attrib import attr
+
+from openquake.commonlib.node import node_from_xml
+from openquake.commonlib.tests.calculators import CalculatorTestCase
+from openquake.qa_tests_data.disagg import case_1
+
+EXPECTED = os.path.join(
+    os.path.dirname(case_1.__file__), 'expected_output', 'disagg_matrix')
+
+
+def read_marginals(fname):
+    """
+    :param fname: an XML file with the disaggregation matrices of a site
+    :returns: a pair (iml, {kind: probabilities}) for the 1D matrices
+    """
+    [matrices] = node_from_xml(fname)
+    marginals = {}
+    for matrix in matrices:
+        iml = float(matrix['iml'])
+        if ',' not in matrix['type']:
+            marginals[matrix['type']] = numpy.array(
+                [float(prob['value']) for prob in matrix])
+    return iml, marginals
+
+
+class DisaggregationTestCase(CalculatorTestCase):
+
+    @attr('qa', 'hazard', 'disagg')
+    def test_case_1(self):
+        out = self.run_calc(case_1.__file__, 'job.ini', exports='xml')
+        # 1 realization x 2 sites x 2 IMTs x 2 poes
+        fnames = out['disagg', 'xml']
+        self.assertEqual(len(fnames), 8)
+        mats = self.calc.datastore['disagg/b1,b1']
+        # 2 sites, 2 IMTs, 2 poes, 3 magnitude bins
+        self.assertEqual(mats['Mag'].shape, (2, 2, 2, 3))
+        # the probabilities are consistent across the marginals
+        mag = mats['Mag'].value
+        self.assertTrue((mag >= 0).all())
+        self.assertTrue((mag <= 1).all())
+        imls = mats['imls'].value  # shape (N, I, P)
+
+        # compare the marginals of the first site with the ones computed
+        # by the engine; the distance bins start from 0 with the same
+        # width, but the engine does not store the empty bins at the end
+        for i, imt in enumerate(['PGA', 'SA-0.025']):
+            for p, poe in enumerate(['0.02', '0.1']):
+                fname = os.path.join(
+                    EXPECTED, imt, 'disagg_matrix(%s)-lon_10.1-lat_40.1-'
+                    'smltp_b1-gsimltp_b1.xml' % poe)
+                iml, expected = read_marginals(fname)
+                numpy.testing.assert_allclose(imls[0, i, p], iml, rtol=1E-2)
+                for kind in ('Mag', 'Dist', 'TRT'):
+                    got = mats[kind][0, i, p]
+                    exp = expected[kind]
+                    numpy.testing.assert_allclose(
+                        got[:len(exp)], exp, rtol=1E-2, atol=1E-6)
+                    numpy.testing.assert_allclose(got[len(exp):], 0,
+                                                  atol=1E-6)
@@ -1,6 +1,6 @@
 import unittest
 import numpy
-from openquake.commonlib.datastore import DataStore, view
+from openquake.commonlib.datastore import DataStore, Hdf5Dict, view
 
 
 @view.add('key1_upper')
@@ -57,3 +57,41 @@ class DataStoreTestCase(unittest.TestCase):
 
         # it is possible to store twice the same key (work around a bug)
         self.dstore['key1'] = 'value1'
+
+    def test_storage(self):
+        # optional test, run only if h5py is available
+        try:
+            import h5py
+        except ImportError:
+            raise unittest.SkipTest
+
+        # by default the dictionaries of arrays are pickled
+        curves = {(0, 'GSIM_A'): numpy.arange(5.),
+                  (1, 'GSIM_B'): numpy.ones(5)}
+        self.dstore['curves'] = curves
+        self.assertIsInstance(self.dstore['curves'], dict)
+
+        # with group=True they are stored natively, with compression,
+        # and read back lazily
+        self.dstore.storage['curves'] = dict(
+            chunks=(2,), compression='gzip', group=True)
+        self.dstore['curves'] = curves
+        self.assertIsInstance(self.dstore['curves'], Hdf5Dict)
+        self.assertEqual(sorted(self.dstore['curves']), sorted(curves))
+        for key in curves:
+            numpy.testing.assert_equal(self.dstore['curves'][key],
+                                       curves[key])
+        dset = self.dstore.hdf5['curves/0']
+        self.assertEqual(dset.compression, 'gzip')
+        self.assertEqual(dset.chunks, (2,))
+
+        # a chunk larger than the array is reduced to the array size
+        self.dstore['curves/small'] = numpy.ones(1)
+        self.assertEqual(self.dstore.hdf5['curves/small'].chunks, (1,))
+
+        # extendable datasets use the storage options too
+        self.dstore.storage['table'] = dict(compression='lzf')
+        dset = self.dstore.create_dset('/table/x', numpy.float32)
+        dset.extend(numpy.ones(3, numpy.float32))
+        self.assertEqual(dset.dset.compression, 'lzf')
+        numpy.testing.assert_equal(self.dstore['table/x'][1:], [1, 1])
@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 import numpy
 from openquake.commonlib import parallel
@@ -7,6 +9,10 @@ def get_length(data):
     return {'n': len(data)}
 
 
+def get_weight(data, weights):
+    return {'weight': weights[data].sum()}
+
+
 class TaskManagerTestCase(unittest.TestCase):
     monitor = parallel.DummyMonitor()
 
@@ -35,3 +41,59 @@ class TaskManagerTestCase(unittest.TestCase):
             res[key] = val.reduce()
         parallel.TaskManager.restart()
         self.assertEqual(res, {'a': {'n': 10}, 'c': {'n': 15}, 'b': {'n': 20}})
+
+    def test_shared_args(self):
+        weights = numpy.arange(1000.)
+        tm = parallel.TaskManager(get_weight)
+        tm.share_threshold = 1000
+        tm.shared_dir = tempfile.mkdtemp()
+        for data in ([1, 2], [3], [4, 5, 6]):
+            tm.submit(data, weights)
+        self.assertEqual(len(tm.shared), 1)
+        [(_obj, shared)] = tm.shared.values()
+        self.assertIsInstance(shared, parallel.Shared)
+        self.assertGreater(tm.saved, 0)
+        res = tm.reduce()
+        self.assertEqual(res, {'weight': 21.})
+        self.assertEqual(tm.shared, {})
+        self.assertFalse(os.path.exists(shared.path))
+        self.assertEqual(os.path.dirname(shared.path), tm.shared_dir)
+        os.rmdir(tm.shared_dir)
+
+    def test_no_shared_dir(self):
+        weights = numpy.arange(1000.)
+        tm = parallel.TaskManager(get_weight)
+        tm.share_threshold = 1000
+        for data in ([1, 2], [3], [4, 5, 6]):
+            tm.submit(data, weights)
+        self.assertEqual(tm.shared, {})
+        self.assertEqual(tm.reduce(), {'weight': 21.})
+
+    def test_apply_reduce_adaptive(self):
+        res = parallel.apply_reduce(
+            get_length, (numpy.arange(100),), concurrent_tasks=10,
+            key=lambda item: item % 2, task_duration=60)
+        self.assertEqual(res, {'n': 100})
+        [(name, info)] = parallel.TaskManager.pop_task_info()
+        self.assertEqual(name, 'get_length')
+        self.assertEqual(info['num_items'].sum(), 100)
+        self.assertEqual(list(info['task_no']), range(len(info)))
+        self.assertEqual(parallel.TaskManager.task_info, {})
+
+
+class PerformanceMonitorTestCase(unittest.TestCase):
+    def test_counts(self):
+        fd, fname = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        mon = parallel.PerformanceMonitor('test', monitor_csv=fname)
+        for _ in range(2):
+            with mon:
+                pass
+        mon.flush()
+        mon('cache hits', counts=10).flush()
+        rows = [line.split('\t') for line in open(fname).read().splitlines()]
+        os.remove(fname)
+        self.assertEqual(rows[0][-1], 'counts')
+        self.assertEqual([row[-1] for row in rows if row[0] == 'test'], ['2'])
+        self.assertEqual(
+            [row[-1] for row in rows if row[0] == 'cache hits'], ['10'])
@@ -24,7 +24,9 @@ import unittest
 import collections
 from StringIO import StringIO
 
+import numpy
 from numpy.testing import assert_allclose
+from shapely import wkt
 
 from openquake.commonlib import readinput, valid
 from openquake.baselib import general
@@ -309,6 +311,7 @@ class ExposureTestCase(unittest.TestCase):
 POLYGON((78.0 31.5, 89.5 31.5, 89.5 25.5, 78.0 25.5, 78.0 31.5))'''
         oqparam.time_event = None
         oqparam.ignore_missing_costs = []
+        oqparam.exposure_cache = False
 
         with self.assertRaises(KeyError) as ctx:
             readinput.get_exposure(oqparam)
@@ -322,12 +325,134 @@ POLYGON((78.0 31.5, 89.5 31.5, 89.5 25.5, 78.0 25.5, 78.0 31.5))'''
 POLYGON((78.0 31.5, 89.5 31.5, 89.5 25.5, 78.0 25.5, 78.0 31.5))'''
         oqparam.time_event = None
         oqparam.ignore_missing_costs = []
+        oqparam.exposure_cache = False
 
         with self.assertRaises(ValueError) as ctx:
             readinput.get_exposure(oqparam)
         self.assertIn("node assets: Could not convert number->compose(positivefloat,nonzero): '0' is zero, line 17", str(ctx.exception))
 
 
+class ExposureArrayTestCase(unittest.TestCase):
+    exposure = ExposureTestCase.exposure
+
+    def test_read_exposure_array(self):
+        array, taxonomies, out_of_region = readinput.read_exposure_array(
+            self.exposure, ['structural'], block_size=2)
+        self.assertEqual(taxonomies, ['RM', 'RC', 'W'])
+        self.assertEqual(out_of_region, 0)
+        self.assertEqual(list(array['asset_ref']), ['a1', 'a2', 'a3'])
+        assert_allclose(array['number'], [3000, 1, 2000])
+        assert_allclose(array['structural'], [1000, 500, 1000])
+        self.assertTrue(numpy.isnan(array['deductible~structural']).all())
+
+    def test_missing_number(self):
+        with self.assertRaises(KeyError):
+            readinput.read_exposure_array(
+                self.exposure, ['structural'], number_required=True)
+
+    def test_zero_number(self):
+        with self.assertRaises(ValueError) as ctx:
+            readinput.read_exposure_array(
+                ExposureTestCase.exposure0, ['structural'])
+        self.assertIn('Could not convert number->compose(positivefloat,'
+                      'nonzero): ', str(ctx.exception))
+
+    def test_get_exposure_fast(self):
+        oqparam = mock.Mock()
+        oqparam.calculation_mode = 'scenario_risk'
+        oqparam.inputs = {'exposure': self.exposure,
+                          'structural_vulnerability': 'vf.xml'}
+        oqparam.region_constraint = None
+        oqparam.time_event = None
+        oqparam.ignore_missing_costs = []
+        oqparam.exposure_cache = False
+        exposure = readinput.get_exposure(oqparam)
+        oqparam.exposure_cache = True
+        with mock.patch('openquake.commonlib.datastore.DATADIR',
+                        tempfile.mkdtemp()):
+            fast = readinput.get_exposure(oqparam)
+        # the assets are records of an AssetCollection built from the array
+        self.assertEqual(len(fast.assets), 3)
+        self.assertEqual(fast.taxonomies, exposure.taxonomies)
+        for asset, record in zip(exposure.assets, fast.assets):
+            self.assertEqual(record.id, asset.id)
+            self.assertEqual(record.taxonomy, asset.taxonomy)
+            self.assertEqual(record.number, asset.number)
+            self.assertEqual(record.location, asset.location)
+            self.assertEqual(record.value('structural'),
+                             asset.value('structural'))
+
+    def test_region_constraint(self):
+        # the assets outside the region are discarded before being read:
+        # a1 has no cost and a2 has a deductible, which must not leak in a3
+        exposure = general.writetmp('''\
+<?xml version='1.0' encoding='UTF-8'?>
+<nrml xmlns="http://openquake.org/xmlns/nrml/0.4">
+  <exposureModel id="ep" category="buildings">
+    <description>Exposure model for buildings</description>
+    <conversions>
+      <costTypes>
+        <costType name="structural" unit="USD" type="per_asset"/>
+      </costTypes>
+    </conversions>
+    <assets>
+      <asset id="a1" taxonomy="RM" number="3000">
+        <location lon="81.2985" lat="29.1098"/>
+      </asset>
+      <asset id="a2" taxonomy="RC" number="1000">
+        <location lon="83.082298" lat="27.9006"/>
+        <costs>
+          <cost type="structural" value="500" deductible="100"
+                insuranceLimit="400"/>
+        </costs>
+      </asset>
+      <asset id="a3" taxonomy="W">
+        <location lon="85.747703" lat="27.9015"/>
+        <costs>
+          <cost type="structural" value="1000"/>
+        </costs>
+      </asset>
+      <asset id="a4" taxonomy="RC" number="2000">
+        <location lon="85.747703" lat="28.9015"/>
+        <costs>
+          <cost type="structural" value="800"/>
+        </costs>
+      </asset>
+    </assets>
+  </exposureModel>
+</nrml>''')
+        region = wkt.loads('POLYGON((84 27, 87 27, 87 29.5, 84 29.5, 84 27))')
+        array, taxonomies, out_of_region = readinput.read_exposure_array(
+            exposure, ['structural'], region=region, block_size=2)
+        self.assertEqual(out_of_region, 2)
+        self.assertEqual(taxonomies, ['W', 'RC'])
+        self.assertEqual(list(array['asset_ref']), ['a3', 'a4'])
+        assert_allclose(array['number'], [1, 2000])
+        assert_allclose(array['lon'], [85.747703, 85.747703])
+        assert_allclose(array['lat'], [27.9015, 28.9015])
+        assert_allclose(array['structural'], [1000, 800])
+        self.assertTrue(numpy.isnan(array['deductible~structural']).all())
+        self.assertTrue(
+            numpy.isnan(array['insurance_limit~structural']).all())
+
+    def test_cache(self):
+        oqparam = mock.Mock()
+        oqparam.calculation_mode = 'scenario_risk'
+        oqparam.inputs = {'exposure': self.exposure,
+                          'structural_vulnerability': 'vf.xml'}
+        oqparam.region_constraint = None
+        oqparam.ignore_missing_costs = []
+        cache_dir = tempfile.mkdtemp()
+        array1, taxonomies1, _ = readinput.get_exposure_array(
+            oqparam, cache_dir)
+        [fname] = os.listdir(cache_dir)
+        array2, taxonomies2, _ = readinput.get_exposure_array(
+            oqparam, cache_dir)
+        self.assertEqual(os.listdir(cache_dir), [fname])
+        numpy.testing.assert_equal(array1, array2)
+        self.assertEqual(taxonomies1, taxonomies2)
+
+
 class ReadCsvTestCase(unittest.TestCase):
     def test_get_mesh_csvdata_ok(self):
         fakecsv = StringIO("""\
@@ -0,0 +1,65 @@
+import os
+import itertools
+import unittest
+
+import numpy
+
+from openquake.hazardlib import geo, site
+from openquake.hazardlib.calc import filters
+from openquake.commonlib import sourceconverter, nrml_examples
+from openquake.commonlib.source import parse_sources
+from openquake.commonlib.siteindex import SiteIndex
+
+MIXED_SRC_MODEL = os.path.join(
+    os.path.dirname(nrml_examples.__file__), 'source_model/mixed.xml')
+
+
+def sids(sites):
+    return [] if sites is None else list(sites.sids)
+
+
+class SiteIndexTestCase(unittest.TestCase):
+    MAXDIST = 50  # km
+
+    @classmethod
+    def setUpClass(cls):
+        converter = sourceconverter.SourceConverter(
+            investigation_time=50.,
+            rupture_mesh_spacing=5,  # km
+            complex_fault_mesh_spacing=5,  # km
+            width_of_mfd_bin=1.,  # for Truncated GR MFDs
+            area_source_discretization=10.)
+        cls.sources = parse_sources(MIXED_SRC_MODEL, converter)
+        cls.sitecol = site.SiteCollection(
+            [site.Site(geo.Point(lon, lat), 760, True, 100, 5)
+             for lon in numpy.arange(-128, -118, .1)
+             for lat in numpy.arange(35, 44, .1)])
+        cls.index = SiteIndex(cls.sitecol)
+
+    def test_filter_by_source(self):
+        for src in self.sources:
+            expected = src.filter_sites_by_distance_to_source(
+                self.MAXDIST, self.sitecol)
+            actual = self.index.filter_sites_by_distance_to_source(
+                src, self.MAXDIST)
+            self.assertEqual(sids(actual), sids(expected))
+
+    def test_filter_by_rupture(self):
+        for src in self.sources:
+            s_sites = self.index.filter_sites_by_distance_to_source(
+                src, self.MAXDIST)
+            if s_sites is None:
+                continue
+            for rup in itertools.islice(src.iter_ruptures(), 5):
+                expected = filters.filter_sites_by_distance_to_rupture(
+                    rup, self.MAXDIST, s_sites)
+                actual = self.index.filter_sites_by_distance_to_rupture(
+                    rup, self.MAXDIST, s_sites)
+                self.assertEqual(sids(actual), sids(expected))
+
+    def test_few_sites(self):
+        # small collections are not indexed
+        sitecol = site.SiteCollection(
+            [site.Site(geo.Point(lon, 38), 760, True, 100, 5)
+             for lon in range(-127, -117)])
+        self.assertIsNone(SiteIndex(sitecol).checksum)
@@ -15,6 +15,9 @@
 
 import os
 import mock
+import shutil
+import cPickle
+import tempfile
 import unittest
 from StringIO import StringIO
 
@@ -31,7 +34,9 @@ from openquake.hazardlib.tom import PoissonTOM
 
 from openquake.commonlib import tests, nrml_examples, readinput
 from openquake.commonlib import sourceconverter as s
-from openquake.commonlib.source import parse_source_model, DuplicatedID
+from openquake.commonlib import source as source_module
+from openquake.commonlib.source import (
+    parse_source_model, DuplicatedID, SourceModelParser)
 from openquake.commonlib.nrml import nodefactory
 from openquake.commonlib.node import read_nodes
 from openquake.baselib.general import assert_close
@@ -693,6 +698,108 @@ class TrtModelTestCase(unittest.TestCase):
             '<TrtModel #0 Active Shallow Crust, 2 source(s), 0 rupture(s)>')
 
 
+class SourceModelParserTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.converter = s.SourceConverter(
+            investigation_time=50.,
+            rupture_mesh_spacing=1,  # km
+            complex_fault_mesh_spacing=1,  # km
+            width_of_mfd_bin=1.,  # for Truncated GR MFDs
+            area_source_discretization=1.)
+        cls.cache_dir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.cache_dir)
+
+    def test_parse_once(self):
+        parser = SourceModelParser(self.converter)
+        with mock.patch('openquake.commonlib.source.merge_slices',
+                        side_effect=source_module.merge_slices) as ms:
+            trt_models1 = parser.parse_trt_models(MIXED_SRC_MODEL)
+            trt_models2 = parser.parse_trt_models(
+                MIXED_SRC_MODEL, lambda src: setattr(src, 'mark', 1))
+        self.assertEqual(ms.call_count, 1)
+        self.assertEqual(map(repr, trt_models1), map(repr, trt_models2))
+        # the branches do not share the sources
+        self.assertFalse(hasattr(trt_models1[0].sources[0], 'mark'))
+        self.assertEqual(trt_models2[0].sources[0].mark, 1)
+
+    def test_cache_dir(self):
+        SourceModelParser(self.converter, self.cache_dir).parse_trt_models(
+            MIXED_SRC_MODEL)
+        [fname] = os.listdir(self.cache_dir)
+        self.assertTrue(fname.startswith('sources-'))
+        # a new parser reads the sources from the cache, not from the XML
+        parser = SourceModelParser(self.converter, self.cache_dir)
+        with mock.patch('openquake.commonlib.source.merge_slices') as ms:
+            trt_models = parser.parse_trt_models(MIXED_SRC_MODEL)
+        self.assertEqual(ms.call_count, 0)
+        self.assertEqual(
+            map(repr, trt_models),
+            map(repr, parse_source_model(MIXED_SRC_MODEL, self.converter)))
+
+    @mock.patch.dict(os.environ, OQ_NO_DISTRIBUTE='1')
+    @mock.patch('openquake.commonlib.source.PARSE_SLICE_SIZE', 1)
+    def test_slices(self):
+        # the source nodes parsed once and converted in 3 slices
+        # are in the original order
+        parser = SourceModelParser(self.converter)
+        parser.parse_files([MIXED_SRC_MODEL], concurrent_tasks=3)
+        [pik] = parser.sources.values()
+        expected = source_module.parse_sources(MIXED_SRC_MODEL, self.converter)
+        self.assertEqual([src.source_id for src in cPickle.loads(pik)],
+                         [src.source_id for src in expected])
+        # the check on the duplicated IDs works across the slices
+        converter = s.SourceConverter(
+            investigation_time=50.,
+            rupture_mesh_spacing=1,
+            complex_fault_mesh_spacing=1,
+            width_of_mfd_bin=0.1,
+            area_source_discretization=10)
+        with self.assertRaises(DuplicatedID):
+            SourceModelParser(converter).parse_files(
+                [DUPLICATE_ID_SRC_MODEL], concurrent_tasks=3)
+
+
+class CostModelTestCase(unittest.TestCase):
+    def test_weights(self):
+        # point sources cost 1 second per rupture, site and GSIM,
+        # fault sources 10 seconds per rupture, site and GSIM
+        source_data = numpy.array(
+            [('1', 'PointSource', 10, 2, 1, 20.),
+             ('2', 'PointSource', 10, 1, 2, 20.),
+             ('3', 'SimpleFaultSource', 2, 3, 1, 60.)],
+            source_module.source_data_dt)
+        model = source_module.CostModel(source_data)
+        self.assertAlmostEqual(model.time_per_rupture, 100. / 22)
+
+        PointSource = type('PointSource', (object,), dict(num_ruptures=10))
+        SimpleFaultSource = type(
+            'SimpleFaultSource', (object,), dict(num_ruptures=10))
+        ComplexFaultSource = type(
+            'ComplexFaultSource', (object,), dict(num_ruptures=10))
+        self.assertAlmostEqual(
+            model.get_weight(PointSource(), 5, 1), 50 / model.time_per_rupture)
+        self.assertAlmostEqual(
+            model.get_weight(SimpleFaultSource(), 5, 1),
+            500 / model.time_per_rupture)
+        # far away sources are weighted as if they affected a single site
+        self.assertAlmostEqual(
+            model.get_weight(PointSource(), 0, 2), 20 / model.time_per_rupture)
+        # unknown source classes get the average coefficient
+        self.assertAlmostEqual(
+            model.get_weight(ComplexFaultSource(), 1, 1),
+            10 * 100. / 46 / model.time_per_rupture)
+
+    def test_no_timings(self):
+        source_data = numpy.zeros(0, source_module.source_data_dt)
+        with self.assertRaises(ValueError):
+            source_module.CostModel(source_data)
+
+
 class RuptureConverterTestCase(unittest.TestCase):
 
     def test_well_formed_ruptures(self):
@@ -761,6 +868,21 @@ Subduction Interface,b3,SadighEtAl1997,w=1.0>''')
             "<RlzsAssoc(2)\n0,SadighEtAl1997: ['<0,b1_b5_b8,b2_b3,w=1.0>']\n"
             "1,ChiouYoungs2008: ['<0,b1_b5_b8,b2_b3,w=1.0>']>")
 
+    def test_fast_sources_in_blocks(self):
+        oqparam = tests.get_oqparam('classical_job.ini')
+        sitecol = readinput.get_site_collection(oqparam)
+        csm = readinput.get_composite_source_model(
+            oqparam, sitecol, no_distribute=True)
+        with mock.patch.object(
+                source_module.SourceFilterSplitter, 'fast_block_size', 10):
+            csm_blocks = readinput.get_composite_source_model(
+                oqparam, sitecol, no_distribute=True)
+        self.assertEqual(
+            [[src.source_id for src in tm] for tm in csm_blocks.trt_models],
+            [[src.source_id for src in tm] for tm in csm.trt_models])
+        self.assertEqual(sorted(csm_blocks.source_info['source_id']),
+                         sorted(csm.source_info['source_id']))
+
     def test_many_rlzs(self):
         oqparam = tests.get_oqparam('classical_job.ini')
         oqparam.number_of_logic_tree_samples = 0
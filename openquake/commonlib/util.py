@@ -17,6 +17,7 @@
 #  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import division
+import hashlib
 import numpy
 
 
@@ -78,3 +79,16 @@ def rmsep(array_ref, array, min_value=0.01):
     bigvalues = array_ref > min_value
     reldiffsquare = (1. - array[bigvalues] / array_ref[bigvalues]) ** 2
     return numpy.sqrt(reldiffsquare.mean())
+
+
+def file_checksum(fname, *params):
+    """
+    :param fname: the path of a file
+    :param params: parameters affecting the way the file is read
+    :returns: a SHA1 checksum of the file content and of the parameters
+    """
+    sha1 = hashlib.sha1(repr(params))
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
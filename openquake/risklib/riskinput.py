@@ -52,6 +52,15 @@ def build_asset_collection(assets_by_site, time_event=None):
             break
     else:  # no break
         raise ValueError('There are no assets!')
+    if isinstance(first_asset, AssetRecord):
+        assets = [asset for assets_ in assets_by_site for asset in
+                  sorted(assets_, key=operator.attrgetter('id'))]
+        if same_collection(assets):  # extract the rows of the collection
+            ordinals = numpy.array([a.ordinal for a in assets])
+            assetcol = first_asset.collection.array[ordinals]
+            assetcol['site_id'] = [sid for sid, assets_ in enumerate(
+                assets_by_site) for _ in assets_]
+            return assetcol
     candidate_loss_types = first_asset.values.keys()
     loss_types = []
     the_fatalities = 'fatalities_%s' % time_event
@@ -97,6 +106,250 @@ def build_asset_collection(assets_by_site, time_event=None):
     return assetcol
 
 
+class AssetRecord(object):
+    """
+    A lightweight view over an asset stored in an :class:`AssetCollection`,
+    with the same interface of :class:`openquake.risklib.workflows.Asset`.
+
+    :param collection: an AssetCollection instance
+    :param ordinal: the index of the asset in the collection
+    """
+    __slots__ = ('collection', 'ordinal')
+
+    def __init__(self, collection, ordinal):
+        self.collection = collection
+        self.ordinal = ordinal
+
+    @property
+    def id(self):
+        return self.collection.asset_refs[self.ordinal]
+
+    @property
+    def taxonomy(self):
+        col = self.collection
+        return col.taxonomies[col.taxonomy[self.ordinal]]
+
+    @property
+    def number(self):
+        return self.collection.number[self.ordinal]
+
+    @property
+    def location(self):
+        col = self.collection
+        return col.lons[self.ordinal], col.lats[self.ordinal]
+
+    def value(self, loss_type, time_event=None):
+        """
+        :returns: the total asset value for `loss_type`
+        """
+        return self.collection.array[loss_type][self.ordinal]
+
+    def deductible(self, loss_type):
+        """
+        :returns: the deductible of the asset for `loss_type`
+        """
+        return self.collection.array['deductible~' + loss_type][self.ordinal]
+
+    def insurance_limit(self, loss_type):
+        """
+        :returns: the insurance limit of the asset for `loss_type`
+        """
+        return self.collection.array[
+            'insurance_limit~' + loss_type][self.ordinal]
+
+    def retrofitted(self, loss_type):
+        """
+        :returns: the asset retrofitted value for `loss_type`
+        """
+        return self.collection.array['retrofitted~' + loss_type][self.ordinal]
+
+    def __repr__(self):
+        return '<Asset %s>' % self.id
+
+    def __str__(self):
+        return self.id
+
+
+class AssetCollection(object):
+    """
+    An array-backed replacement for a list of lists of assets, which is
+    cheap to store and to send to the workers. The values, deductibles,
+    insurance limits and retrofitted values are stored in the composite
+    array returned by :func:`build_asset_collection`; the asset ids,
+    taxonomy codes, numbers and locations in separate arrays.
+    Iterating on the collection yields :class:`AssetRecord` objects,
+    whereas indexing it with an array of indices or a boolean mask
+    returns a smaller collection.
+
+    :param assets_by_site: a list of lists of assets
+    :param time_event: a time event string (or None)
+    """
+    def __init__(self, assets_by_site, time_event=None):
+        self.num_sites = len(assets_by_site)
+        assets = [asset for assets_ in assets_by_site for asset in
+                  sorted(assets_, key=operator.attrgetter('id'))]
+        if assets:
+            self.array = build_asset_collection(assets_by_site, time_event)
+        else:
+            self.array = numpy.zeros(
+                0, [('asset_ref', '|S20'), ('site_id', numpy.uint32)])
+        if same_collection(assets):  # take the columns of the collection
+            col = assets[0].collection
+            ordinals = numpy.array([a.ordinal for a in assets])
+            self.taxonomies = col.taxonomies
+            for name in ('asset_refs', 'taxonomy', 'number', 'lons', 'lats'):
+                setattr(self, name, getattr(col, name)[ordinals])
+        else:
+            self.asset_refs = numpy.array([a.id for a in assets])
+            self.taxonomies = sorted(set(a.taxonomy for a in assets))
+            taxo_idx = {taxo: i for i, taxo in enumerate(self.taxonomies)}
+            self.taxonomy = numpy.array(
+                [taxo_idx[a.taxonomy] for a in assets], numpy.uint32)
+            self.number = numpy.array([a.number for a in assets], float)
+            self.lons = numpy.array([a.location[0] for a in assets], float)
+            self.lats = numpy.array([a.location[1] for a in assets], float)
+        self._assets_by_site = None
+
+    @classmethod
+    def from_array(cls, array, taxonomies, aggregated=None, time_event=None):
+        """
+        Build a collection from the exposure array returned by
+        :func:`openquake.commonlib.readinput.read_exposure_array`, without
+        instantiating the assets. The values are multiplied by the number
+        and the area, as in :class:`openquake.risklib.workflows.Asset`; the
+        deductibles and insurance limits which are missing for all the
+        assets are discarded. The site IDs are the indices of the distinct
+        locations, in lexicographic order.
+
+        :param array: a composite array with fields asset_ref, taxonomy,
+                      number, lon, lat, area, followed by the costs
+        :param taxonomies: the taxonomies, indexed by the taxonomy field
+        :param aggregated: a dictionary cost type -> boolean; the
+                           aggregated costs are not multiplied by the number
+        :param time_event: a time event string (or None)
+        """
+        aggregated = aggregated or {}
+        the_fatalities = 'fatalities_%s' % time_event
+        columns = []  # pairs (field, values)
+        for name in array.dtype.names[6:]:
+            if name.startswith('fatalities'):
+                if name == the_fatalities:
+                    columns.append(('fatalities', array[name]))
+                # discard fatalities for different time periods
+            elif '~' in name:  # deductible or insurance limit
+                if not numpy.isnan(array[name]).all():
+                    columns.append((name, array[name]))
+            else:
+                number = 1 if aggregated.get(name) else array['number']
+                columns.append((name, array[name] * number * array['area']))
+        lonlats = numpy.zeros(len(array), [('lon', float), ('lat', float)])
+        lonlats['lon'] = array['lon']
+        lonlats['lat'] = array['lat']
+        locations, site_ids = numpy.unique(lonlats, return_inverse=True)
+        new = object.__new__(cls)
+        new.num_sites = len(locations)
+        new.array = numpy.zeros(
+            len(array), [('asset_ref', array.dtype['asset_ref']),
+                         ('site_id', numpy.uint32)] +
+            [(name, float) for name, _ in columns])
+        new.array['asset_ref'] = array['asset_ref']
+        new.array['site_id'] = site_ids
+        for name, values in columns:
+            new.array[name] = values
+        new.asset_refs = array['asset_ref']
+        new.taxonomies = list(taxonomies)
+        new.taxonomy = array['taxonomy']
+        new.number = array['number']
+        new.lons = array['lon']
+        new.lats = array['lat']
+        new._assets_by_site = None
+        return new
+
+    def get_values(self, loss_type, time_event=None):
+        """
+        :returns: the values of the assets for the given loss type
+        """
+        # the fatalities for the time_event are already in the array
+        return self.array[loss_type]
+
+    def get_deductibles(self, loss_type):
+        """
+        :returns: the deductibles of the assets for the given loss type
+        """
+        return self.array['deductible~' + loss_type]
+
+    def get_insurance_limits(self, loss_type):
+        """
+        :returns: the insurance limits of the assets for the given loss type
+        """
+        return self.array['insurance_limit~' + loss_type]
+
+    def get_taxonomies(self):
+        """
+        :returns: the sorted taxonomies of the assets in the collection
+        """
+        return [self.taxonomies[i] for i in numpy.unique(self.taxonomy)]
+
+    def assets_by_site(self):
+        """
+        :returns: a list of lists of AssetRecords, one list per site
+        """
+        if self._assets_by_site is None:
+            self._assets_by_site = [[] for _ in range(self.num_sites)]
+            for asset, sid in zip(self, self.array['site_id']):
+                self._assets_by_site[sid].append(asset)
+        return self._assets_by_site
+
+    def __getitem__(self, indices):
+        if isinstance(indices, (int, numpy.integer)):
+            return AssetRecord(self, indices)
+        new = object.__new__(self.__class__)
+        new.num_sites = self.num_sites
+        new.taxonomies = self.taxonomies
+        for name in ('array', 'asset_refs', 'taxonomy', 'number',
+                     'lons', 'lats'):
+            setattr(new, name, getattr(self, name)[indices])
+        new._assets_by_site = None
+        return new
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield AssetRecord(self, i)
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getstate__(self):
+        # the records are rebuilt on the other side
+        return dict(self.__dict__, _assets_by_site=None)
+
+    def __repr__(self):
+        return '<%s with %d asset(s)>' % (self.__class__.__name__, len(self))
+
+
+def same_collection(assets):
+    """
+    :param assets: a list of assets
+    :returns: True if the assets are AssetRecords of the same collection
+    """
+    return len(assets) > 0 and all(
+        isinstance(a, AssetRecord) and a.collection is assets[0].collection
+        for a in assets)
+
+
+def asset_array(assets):
+    """
+    :param assets: a list of assets
+    :returns:
+        an AssetCollection if the assets are AssetRecords of the same
+        collection, otherwise a 1-dimensional array of objects
+    """
+    if same_collection(assets):
+        ordinals = numpy.array([a.ordinal for a in assets])
+        return assets[0].collection[ordinals]
+    return object_array(assets)
+
+
 class RiskModel(collections.Mapping):
     """
     A container (imt, taxonomy) -> workflow.
@@ -170,20 +423,29 @@ class RiskModel(collections.Mapping):
         :param gsims_by_col: a dictionary of GSIM instances
         :param trunc_level: the truncation level (or None)
         :param correl_model: the correlation model (or None)
-        :param eps_dict: a dictionary asset_ref -> epsilon array
+        :param eps_dict:
+            a dictionary asset_ref -> epsilon array or an EpsilonGetter
         :param hint: hint for how many blocks to generate
 
         Yield :class:`RiskInputFromRuptures` instances.
         """
         imt_taxonomies = list(self.get_imt_taxonomies())
-        num_epsilons = len(eps_dict.itervalues().next())
+        lazy = isinstance(eps_dict, EpsilonGetter)
+        if lazy:
+            num_epsilons = eps_dict.num_samples
+        else:
+            num_epsilons = len(eps_dict.itervalues().next())
         by_col = operator.attrgetter('col_id')
         rup_start = rup_stop = 0
         for ses_ruptures, indices in split_in_blocks_2(
                 all_ruptures, range(num_epsilons), hint or 1, key=by_col):
             rup_stop += len(ses_ruptures)
             gsims = gsims_by_col[ses_ruptures[0].col_id]
-            edic = {asset: eps[indices] for asset, eps in eps_dict.iteritems()}
+            if lazy:
+                edic = eps_dict.restrict(indices)
+            else:
+                edic = {asset: eps[indices]
+                        for asset, eps in eps_dict.iteritems()}
             yield RiskInputFromRuptures(
                 imt_taxonomies, sitecol, ses_ruptures,
                 gsims, trunc_level, correl_model, edic,
@@ -202,26 +464,32 @@ class RiskModel(collections.Mapping):
         """
         mon_hazard = monitor('getting hazard', autoflush=False)
         mon_risk = monitor('computing individual risk', autoflush=False)
+        cache = scientific.VF_CACHE
+        hits, misses = cache.hits, cache.misses
         for riskinput in riskinputs:
             try:
                 assets_by_site = riskinput.assets_by_site
             except AttributeError:  # for event_based_risk
-                assets_by_site = monitor.assets_by_site
+                assets_by_site = monitor.assetcol.assets_by_site()
             with mon_hazard:
                 # get assets, hazards, epsilons
                 a, h, e = riskinput.get_all(rlzs_assoc, assets_by_site)
+                a, e = asset_array(a), epsilon_array(e)
+                # positions of the assets for each taxonomy
+                taxonomies = [asset.taxonomy for asset in a]
+                indices_by_taxo = groupby(
+                    range(len(a)), taxonomies.__getitem__,
+                    lambda idxs: numpy.array(idxs, int))
             with mon_risk:
                 # compute the outputs by using the worklow
                 for imt, taxonomies in riskinput.imt_taxonomies:
                     for taxonomy in taxonomies:
-                        assets, hazards, epsilons = [], [], []
-                        for asset, hazard, epsilon in zip(a, h, e):
-                            if asset.taxonomy == taxonomy:
-                                assets.append(asset)
-                                hazards.append(hazard[imt])
-                                epsilons.append(epsilon)
-                        if not assets:
+                        idxs = indices_by_taxo.get(taxonomy)
+                        if idxs is None:
                             continue
+                        assets = a[idxs]
+                        hazards = object_array([h[i][imt] for i in idxs])
+                        epsilons = e[idxs]
                         workflow = self[imt, taxonomy]
                         for out_by_rlz in workflow.gen_out_by_rlz(
                                 assets, hazards, epsilons, riskinput.tags):
@@ -231,6 +499,15 @@ class RiskModel(collections.Mapping):
                             yield out_by_rlz
         mon_hazard.flush()
         mon_risk.flush()
+        # store the hits and misses of the vulnerability functions cache
+        # in the counts column of the performance file
+        hits, misses = cache.hits - hits, cache.misses - misses
+        monitor('vulnerability cache hits', autoflush=False,
+                counts=hits).flush()
+        monitor('vulnerability cache misses', autoflush=False,
+                counts=misses).flush()
+        logging.debug('vulnerability cache: %d hits, %d misses',
+                      hits, misses)
 
     def __repr__(self):
         lines = ['%s: %s' % item for item in sorted(self.items())]
@@ -244,24 +521,27 @@ class RiskInput(object):
 
     :param imt: Intensity Measure Type string
     :param hazard_assets_by_taxo: pairs (hazard, {imt: assets}) for each site
+    :param assets_by_site: a list of lists of assets or an AssetCollection
     """
     def __init__(self, imt_taxonomies, hazard_by_site, assets_by_site,
                  eps_dict=None):
         [(self.imt, taxonomies)] = imt_taxonomies
         self.hazard_by_site = hazard_by_site
-        self.assets_by_site = [
-            [a for a in assets if a.taxonomy in taxonomies]
-            for assets in assets_by_site]
-        taxonomies = set()
-        self.weight = 0
-        for assets in self.assets_by_site:
-            for asset in assets:
-                taxonomies.add(asset.taxonomy)
-            self.weight += len(assets)
-        self.taxonomies = sorted(taxonomies)
+        if not isinstance(assets_by_site, AssetCollection):
+            assets_by_site = AssetCollection(assets_by_site)
+        ok = numpy.array([taxo in taxonomies
+                          for taxo in assets_by_site.taxonomies], bool)
+        self.assetcol = assets_by_site[ok[assets_by_site.taxonomy]]
+        self.weight = len(self.assetcol)
+        self.taxonomies = self.assetcol.get_taxonomies()
         self.tags = None  # for API compatibility with RiskInputFromRuptures
         self.eps_dict = eps_dict or {}
 
+    @property
+    def assets_by_site(self):
+        """A list of lists of AssetRecords, one list per site"""
+        return self.assetcol.assets_by_site()
+
     @property
     def imt_taxonomies(self):
         """Return a list of pairs (imt, taxonomies) with a single element"""
@@ -302,13 +582,87 @@ def make_eps_dict(assets_by_site, num_samples, seed, correlation):
     for taxonomy, assets in assets_by_taxo.iteritems():
         shape = (len(assets), num_samples)
         logging.info('Building %s epsilons for taxonomy %s', shape, taxonomy)
-        zeros = numpy.zeros(shape)
-        epsilons = scientific.make_epsilons(zeros, seed, correlation)
+        epsilons = scientific.equicorrelated_epsilons(
+            len(assets), num_samples, seed, correlation)
         for asset, eps in zip(assets, epsilons):
             eps_dict[asset.id] = eps
     return eps_dict
 
 
+class EpsilonGetter(object):
+    """
+    A lazy replacement for the dictionary returned by :func:`make_eps_dict`.
+    The epsilons are generated in the workers, only for the samples of
+    the current block, so that the full epsilon matrix is never built.
+    The epsilons of the sample with index `i` are generated from the
+    seed `master_seed + i`, therefore they do not depend on the blocks.
+
+    :param master_seed: the master random seed
+    :param correlation: the asset correlation coefficient
+    :param num_samples: the total number of samples
+    :param indices: the indices of the samples in the block (or None)
+    """
+    def __init__(self, master_seed, correlation, num_samples, indices=None):
+        self.master_seed = master_seed
+        self.correlation = correlation
+        self.num_samples = num_samples
+        self.indices = range(num_samples) if indices is None else indices
+
+    def restrict(self, indices):
+        """
+        :param indices: the indices of the samples in a block
+        :returns: a new EpsilonGetter for the given block
+        """
+        return self.__class__(self.master_seed, self.correlation,
+                              self.num_samples, indices)
+
+    def get_eps_dict(self, assets_by_site):
+        """
+        :param assets_by_site: a list of lists of assets
+        :returns: dictionary asset_id -> epsilons for the current block
+        """
+        eps_dict = {}
+        seeds = [self.master_seed + i for i in self.indices]
+        all_assets = (a for assets in assets_by_site for a in assets)
+        assets_by_taxo = groupby(all_assets, operator.attrgetter('taxonomy'))
+        for taxonomy, assets in assets_by_taxo.iteritems():
+            epsilons = scientific.EpsilonProvider(
+                len(assets), self.correlation or 0).sample(seeds)
+            for asset, eps in zip(assets, epsilons):
+                eps_dict[asset.id] = eps
+        return eps_dict
+
+
+def object_array(objects):
+    """
+    :param objects: a sequence of Python objects
+    :returns: a 1-dimensional numpy array of objects
+    """
+    array = numpy.empty(len(objects), object)
+    for i, obj in enumerate(objects):
+        array[i] = obj
+    return array
+
+
+def epsilon_array(epsilons):
+    """
+    :param epsilons: a list with an array of epsilons (or None) per asset
+    :returns:
+        a matrix N x E if all the assets have the same number of epsilons,
+        otherwise a 1-dimensional array of objects
+
+    >>> epsilon_array([None, None])
+    array([None, None], dtype=object)
+    >>> epsilon_array([numpy.array([.1, .2]), numpy.array([.3, .4])])
+    array([[ 0.1,  0.2],
+           [ 0.3,  0.4]])
+    """
+    if epsilons and all(eps is not None for eps in epsilons):
+        if len(set(len(eps) for eps in epsilons)) == 1:
+            return numpy.array(epsilons)
+    return object_array(epsilons)
+
+
 def expand(array, N):
     """
     Given a non-empty array with n elements, expands it to a larger
@@ -343,7 +697,8 @@ class RiskInputFromRuptures(object):
     :param gsims: list of GSIM instances
     :param trunc_level: truncation level for the GSIMs
     :param correl_model: correlation model for the GSIMs
-    :params eps_dict: a dictionary asset_id -> epsilons
+    :params eps_dict:
+        a dictionary asset_id -> epsilons or an EpsilonGetter
     :param rup_slice: a slice object specifying which ruptures are in
     """
     def __init__(self, imt_taxonomies, sitecol, ses_ruptures,
@@ -395,6 +750,10 @@ class RiskInputFromRuptures(object):
             lists of assets, hazards and epsilons
         """
         assets, hazards, epsilons = [], [], []
+        if isinstance(self.eps_dict, EpsilonGetter):
+            eps_dict = self.eps_dict.get_eps_dict(assets_by_site)
+        else:
+            eps_dict = self.eps_dict
         gmfs = self.compute_expand_gmfs()
         gsims = map(str, self.gsims)
         trt_id = rlzs_assoc.csm_info.get_trt_id(self.col_id)
@@ -407,7 +766,7 @@ class RiskInputFromRuptures(object):
             for asset in assets_:
                 assets.append(asset)
                 hazards.append(haz_by_imt_rlz)
-                eps = expand(self.eps_dict[asset.id], len(self.ses_ruptures))
+                eps = expand(eps_dict[asset.id], len(self.ses_ruptures))
                 epsilons.append(eps)
         return assets, hazards, epsilons
 
@@ -87,6 +87,36 @@ def fine_graining(points, steps):
 # Input models
 #
 
+# process-wide cache for the LREMs, the mean IMLs and the interpolators of
+# the vulnerability functions; since the keys depend on the content of the
+# functions, the copies unpickled in the workers share the same entries
+VF_CACHE = utils.LRUCache(maxsize=1024)
+
+
+def _content_key(*arrays):
+    """
+    :returns: a tuple of strings depending on the content of the arrays
+    """
+    return tuple(numpy.asarray(array, float).tostring() for array in arrays)
+
+
+def _readonly(array):
+    """
+    Make an array shared through the cache not writeable
+    """
+    array.flags.writeable = False
+    return array
+
+
+def _mean_imls(imls):
+    """
+    :returns: the mean IMLs, including the extrapolated borders
+    """
+    return _readonly(numpy.array(
+        [max(0, imls[0] - ((imls[1] - imls[0]) / 2))] +
+        [numpy.mean(pair) for pair in utils.pairwise(imls)] +
+        [imls[-1] + ((imls[-1] - imls[-2]) / 2)]))
+
 
 class VulnerabilityFunction(object):
     def __init__(self, vf_id, imt, imls, mean_loss_ratios, covs=None,
@@ -143,10 +173,21 @@ class VulnerabilityFunction(object):
 
     def init(self):
         self.stddevs = self.covs * self.mean_loss_ratios
-        self._mlr_i1d = interpolate.interp1d(self.imls, self.mean_loss_ratios)
-        self._covs_i1d = interpolate.interp1d(self.imls, self.covs)
+        self._mlr_i1d = VF_CACHE.get(
+            self._key('mlr_i1d'), interpolate.interp1d,
+            self.imls, self.mean_loss_ratios)
+        self._covs_i1d = VF_CACHE.get(
+            self._key('covs_i1d'), interpolate.interp1d, self.imls, self.covs)
         self.set_distribution(None)
 
+    def _key(self, *extra):
+        """
+        :returns: a key for :data:`VF_CACHE` depending on the content of
+                  the function and on the extra arguments
+        """
+        return _content_key(self.imls, self.mean_loss_ratios, self.covs) + (
+            self.distribution_name,) + extra
+
     def set_distribution(self, epsilons=None):
         if (self.covs > 0).any():
             self.distribution = DISTRIBUTIONS[self.distribution_name]()
@@ -154,7 +195,7 @@ class VulnerabilityFunction(object):
             self.distribution = DegenerateDistribution()
         self.distribution.epsilons = epsilons
 
-    def apply_to(self, ground_motion_values, epsilons):
+    def apply_to(self, ground_motion_values, epsilons, seed=None):
         """
         Apply a copy of the vulnerability function to a set of N
         ground motion vectors, by using N epsilon vectors of length R,
@@ -164,6 +205,9 @@ class VulnerabilityFunction(object):
            matrix of floats N x R
         :param epsilons:
            matrix of floats N x R
+        :param seed:
+           not used, for consistency with
+           :meth:`VulnerabilityFunctionWithPMF.apply_to`
         """
         # NB: changing the order of the ground motion values for a given
         # asset without changing the order of the corresponding epsilon
@@ -172,10 +216,14 @@ class VulnerabilityFunction(object):
             len(epsilons), len(ground_motion_values))
         vulnerability_function = copy.copy(self)
         vulnerability_function.set_distribution(epsilons)
+        gmvs = numpy.asarray(ground_motion_values)
+        if (gmvs.ndim == 2 and
+                vulnerability_function.distribution.can_sample_all(gmvs)):
+            # fast lane, all the assets are managed in a single call
+            return vulnerability_function._apply_all(gmvs)
         return utils.numpy_map(
             vulnerability_function._apply, ground_motion_values)
 
-    @utils.memoized
     def strictly_increasing(self):
         """
         :returns:
@@ -183,6 +231,11 @@ class VulnerabilityFunction(object):
           It is built by removing piece of the function where the mean
           loss ratio is constant.
         """
+        return VF_CACHE.get(
+            self._key('strictly_increasing', self.id, self.imt),
+            self._strictly_increasing)
+
+    def _strictly_increasing(self):
         imls, mlrs, covs = [], [], []
 
         previous_mlr = None
@@ -295,33 +348,61 @@ class VulnerabilityFunction(object):
         ret[idxs] = self.distribution.sample(means, covs, covs * imls_curve)
         return ret
 
-    @utils.memoized
+    def _apply_all(self, gmvs):
+        """
+        Vectorized version of `_apply`, working on the full matrix of
+        ground motion values at once. It gives exactly the same results
+        as calling `_apply` on each row, in order.
+
+        :param gmvs: a matrix of ground motion values of shape N x R
+        :returns: a matrix of loss ratios of shape N x R
+        """
+        # for imls < min(iml) we return a loss of 0 (default)
+        ret = numpy.zeros(gmvs.shape)
+
+        # imls are clipped to max(iml)
+        imls = numpy.where(gmvs > self.imls[-1], self.imls[-1], gmvs)
+
+        # NB: boolean indexing works in row order, so the values are
+        # sampled in the same order as in the row-by-row approach
+        mask = imls >= self.imls[0]
+        imls_curve = imls[mask]
+        means = self._mlr_i1d(imls_curve)
+
+        # apply uncertainty
+        covs = self._cov_for(imls_curve)
+        ret[mask] = self.distribution.sample_all(
+            means, covs, covs * imls_curve, mask)
+        return ret
+
     def loss_ratio_exceedance_matrix(self, steps):
         """Compute the LREM (Loss Ratio Exceedance Matrix).
+        The result is cached in :data:`VF_CACHE` and must not be modified.
 
         :param int steps:
             Number of steps between loss ratios.
         """
+        return VF_CACHE.get(self._key('lrem', steps), self._lrem, steps)
 
+    def _lrem(self, steps):
         # add steps between mean loss ratio values
-        loss_ratios = self.mean_loss_ratios_with_steps(steps)
+        loss_ratios = numpy.array(self.mean_loss_ratios_with_steps(steps))
 
         # LREM has number of rows equal to the number of loss ratios
-        # and number of columns equal to the number of imls
+        # and number of columns equal to the number of imls;
+        # the survival function is computed a column at the time
         lrem = numpy.empty((loss_ratios.size, self.imls.size), float)
+        for col, (mean_loss_ratio, stddev) in enumerate(
+                itertools.izip(self.mean_loss_ratios, self.stddevs)):
+            lrem[:, col] = self.distribution.survival(
+                loss_ratios, mean_loss_ratio, stddev)
+        return _readonly(loss_ratios), _readonly(lrem)
 
-        for row, loss_ratio in enumerate(loss_ratios):
-            for col, (mean_loss_ratio, stddev) in enumerate(
-                    itertools.izip(self.mean_loss_ratios, self.stddevs)):
-                lrem[row][col] = self.distribution.survival(
-                    loss_ratio, mean_loss_ratio, stddev)
-        return loss_ratios, lrem
-
-    @utils.memoized
     def mean_imls(self):
         """
         Compute the mean IMLs (Intensity Measure Level)
         for the given vulnerability function.
+        The result is cached in :data:`VF_CACHE` and must not be modified.
 
         :param vulnerability_function: the vulnerability function where
             the IMLs (Intensity Measure Level) are taken from.
@@ -329,10 +410,8 @@ class VulnerabilityFunction(object):
            :py:class:`openquake.risklib.vulnerability_function.\
            VulnerabilityFunction`
         """
-        return numpy.array(
-            [max(0, self.imls[0] - ((self.imls[1] - self.imls[0]) / 2))] +
-            [numpy.mean(pair) for pair in utils.pairwise(self.imls)] +
-            [self.imls[-1] + ((self.imls[-1] - self.imls[-2]) / 2)])
+        return VF_CACHE.get(
+            ('mean_imls',) + _content_key(self.imls), _mean_imls, self.imls)
 
     def __repr__(self):
         return '<VulnerabilityFunction(%s, %s)>' % (self.id, self.imt)
@@ -362,25 +441,51 @@ class VulnerabilityFunctionWithPMF(object):
         self.init()
 
     def init(self):
-        self._probs_i1d = interpolate.interp1d(self.imls, self.probs)
+        self._probs_i1d = VF_CACHE.get(
+            self._key('probs_i1d'), interpolate.interp1d,
+            self.imls, self.probs)
+        # the cumulative probabilities are linear in the probabilities,
+        # so they can be interpolated directly
+        self._cumprobs = numpy.cumsum(self.probs, axis=0)
         self.set_distribution(None)
 
+    def _key(self, *extra):
+        """
+        :returns: a key for :data:`VF_CACHE` depending on the content of
+                  the function and on the extra arguments
+        """
+        return _content_key(self.imls, self.loss_ratios, self.probs) + (
+            self.distribution_name,) + extra
+
     def set_distribution(self, epsilons=None):
         self.distribution = DISTRIBUTIONS[self.distribution_name]()
         self.distribution.epsilons = epsilons
 
-    def apply_to(self, ground_motion_values, epsilons=None):
+    def apply_to(self, ground_motion_values, epsilons=None, seed=None):
         """
+        Sample the loss ratios of N assets with the inverse-CDF method.
+        A uniform number is drawn for each ground motion value above the
+        minimum IML, in row order, from a random generator initialized
+        with the given seed. If the seed is None the global numpy
+        generator is used, and the losses are the same as the ones
+        given by the scipy sampler used in the past.
+
         :param ground_motion_values:
-           matrix of floats N x M
+           matrix of floats N x R
         :param epsilons:
            not used
-        :returns: a N x M loss matrix
+        :param seed:
+           None or a random seed
+        :returns: a N x R loss matrix
         """
-        vulnerability_function = copy.copy(self)
-        vulnerability_function.set_distribution(epsilons)
-        return utils.numpy_map(
-            vulnerability_function._apply, ground_motion_values)
+        gmvs = numpy.asarray(ground_motion_values)
+        if gmvs.ndim != 2:  # ragged input, sample row by row
+            vulnerability_function = copy.copy(self)
+            vulnerability_function.set_distribution(epsilons)
+            return utils.numpy_map(
+                vulnerability_function._apply, ground_motion_values)
+        rng = numpy.random if seed is None else numpy.random.RandomState(seed)
+        return self._apply_all(gmvs, rng)
 
     def __getstate__(self):
         return (self.id, self.imt, self.imls, self.loss_ratios,
@@ -434,18 +539,73 @@ class VulnerabilityFunctionWithPMF(object):
         ret[idxs] = self.distribution.sample(self.loss_ratios, probs)
         return ret
 
-    @utils.memoized
+    def _apply_all(self, gmvs, rng):
+        """
+        Vectorized version of `_apply`, sampling the full matrix of ground
+        motion values at once.
+
+        :param gmvs: a matrix of ground motion values of shape N x R
+        :param rng: a random generator (or the numpy.random module)
+        :returns: a matrix of loss ratios of shape N x R
+        """
+        # for imls < min(iml) we return a loss of 0 (default)
+        ret = numpy.zeros(gmvs.shape)
+
+        # imls are clipped to max(iml)
+        imls = numpy.where(gmvs > self.imls[-1], self.imls[-1], gmvs)
+        mask = imls >= self.imls[0]
+        imls = imls[mask]
+        uniforms = rng.random_sample(len(imls))
+        # the cumulative probabilities are interpolated one loss ratio
+        # at the time, to avoid a temporary matrix of shape M x N x R
+        cumprobs = (numpy.interp(imls, self.imls, cumprob)
+                    for cumprob in self._cumprobs)
+        ret[mask] = sample_pmf(self.loss_ratios, cumprobs, uniforms)
+        return ret
+
+    def strictly_increasing(self):
+        """
+        :returns: the function itself, since the loss ratios of a PMF
+                  are not associated to the IMLs
+        """
+        return self
+
     def loss_ratio_exceedance_matrix(self, steps):
-        """Compute the LREM (Loss Ratio Exceedance Matrix).
+        """Compute the LREM (Loss Ratio Exceedance Matrix), i.e. the
+        probability of exceeding each loss ratio for each IML, by summing
+        the probabilities of the bigger loss ratios in the PMF.
         Required for the Classical Risk and BCR Calculators.
-        Currently left unimplemented as the PMF format is used only for the
-        Scenario and Event Based Risk Calculators
+        The result is cached in :data:`VF_CACHE` and must not be modified.
+
         :param int steps:
             Number of steps between loss ratios.
         """
-        # TODO: to be implemented if the classical risk calculator
-        # needs to support the pmf vulnerability format
+        return VF_CACHE.get(self._key('lrem', steps), self._lrem, steps)
 
+    def _lrem(self, steps):
+        loss_ratios = numpy.asarray(self.loss_ratios, float)
+        if loss_ratios.min() > 0.0:
+            # prepend with a zero
+            loss_ratios = numpy.concatenate([[0.0], loss_ratios])
+        if loss_ratios.max() < 1.0:
+            # append a 1.0
+            loss_ratios = numpy.concatenate([loss_ratios, [1.0]])
+        loss_ratios = numpy.array(fine_graining(loss_ratios, steps))
+
+        # LREM has number of rows equal to the number of loss ratios
+        # and number of columns equal to the number of imls
+        exceeding = numpy.asarray(self.loss_ratios)[None, :] > \
+            loss_ratios[:, None]
+        lrem = numpy.dot(exceeding, self.probs)
+        return _readonly(loss_ratios), _readonly(lrem)
+
+    def mean_imls(self):
+        """
+        Compute the mean IMLs (Intensity Measure Level), in the same
+        way as :meth:`VulnerabilityFunction.mean_imls`.
+        """
+        return VF_CACHE.get(
+            ('mean_imls',) + _content_key(self.imls), _mean_imls, self.imls)
 
     def __repr__(self):
         return '<VulnerabilityFunctionWithPMF(%s, %s)>' % (self.id, self.imt)
@@ -500,15 +660,26 @@ class FragilityFunctionDiscrete(object):
     def __call__(self, iml):
         """
         Compute the Probability of Exceedance (PoE) for the given
-        Intensity Measure Level (IML).
+        Intensity Measure Level (IML). `iml` can be a scalar or an array
+        of any shape; in the latter case an array of the same shape is
+        returned.
         """
         highest_iml = self.imls[-1]
-
-        if self.no_damage_limit is not None and iml < self.no_damage_limit:
-            return 0.
-        # when the intensity measure level is above
-        # the range, we use the highest one
-        return self.interp(highest_iml if iml > highest_iml else iml)
+        no_damage_limit = self.no_damage_limit
+        if numpy.isscalar(iml):
+            if no_damage_limit is not None and iml < no_damage_limit:
+                return 0.
+            # when the intensity measure level is above
+            # the range, we use the highest one
+            return self.interp(highest_iml if iml > highest_iml else iml)
+        imls = numpy.minimum(numpy.asarray(iml, float), highest_iml)
+        poes = numpy.zeros_like(imls)
+        if no_damage_limit is None:
+            ok = numpy.ones(imls.shape, bool)
+        else:
+            ok = imls >= no_damage_limit
+        poes[ok] = self.interp(imls[ok])
+        return poes
 
     # so that the curve is pickeable
     def __getstate__(self):
@@ -535,6 +706,34 @@ class FragilityFunctionList(list):
         list.__init__(self, elements)
         vars(self).update(attrs)
 
+    def poes_matrix(self, gmvs):
+        """
+        :param gmvs: an array of ground motion values of shape S
+        :returns: an array of PoEs of shape S x L, L being the number
+                  of limit states
+        """
+        gmvs = numpy.asarray(gmvs, float)
+        poes = numpy.zeros(gmvs.shape + (len(self),))
+        for i, ff in enumerate(self):
+            poes[..., i] = ff(gmvs)
+        return poes
+
+    def damage_fractions(self, gmvs):
+        """
+        Vectorized version of :func:`scenario_damage`.
+
+        :param gmvs: an array of ground motion values of shape S, for
+                     instance N x R
+        :returns: an array of damage fractions of shape S x D, D being
+                  the number of damage states, i.e. the number of
+                  limit states plus one
+        """
+        poes = self.poes_matrix(gmvs)
+        ones = numpy.ones(poes.shape[:-1] + (1,))
+        zeros = numpy.zeros(poes.shape[:-1] + (1,))
+        return -numpy.diff(
+            numpy.concatenate([ones, poes, zeros], axis=-1), axis=-1)
+
     def __repr__(self):
         kvs = ['%s=%s' % item for item in vars(self).iteritems()]
         return '<FragilityFunctionList %s>' % ', '.join(kvs)
@@ -574,6 +773,26 @@ class Distribution(object):
         """
         raise NotImplementedError
 
+    def can_sample_all(self, gmvs):
+        """
+        :param gmvs: a matrix of ground motion values of shape N x R
+        :returns: True if `.sample_all` can be used for the given matrix
+        """
+        return False
+
+    def sample_all(self, means, covs, stddevs, mask):
+        """
+        Vectorized version of `.sample`, sampling the losses of all the
+        assets at once; it must give the same results of calling `.sample`
+        once per asset.
+
+        :param means: an array of mean losses
+        :param covs: an array of covariances
+        :param stddevs: an array of stddevs
+        :param mask: a boolean matrix N x R, true for the sampled values
+        """
+        raise NotImplementedError
+
 
 class DegenerateDistribution(Distribution):
     """
@@ -583,16 +802,22 @@ class DegenerateDistribution(Distribution):
     def sample(self, means, _covs, _stddev):
         return means
 
+    def can_sample_all(self, gmvs):
+        return True
+
+    def sample_all(self, means, _covs, _stddevs, _mask):
+        return means
+
     def survival(self, loss_ratio, mean, _stddev):
-        return numpy.piecewise(
-            loss_ratio, [loss_ratio > mean or not mean], [0, 1])
+        return numpy.where((loss_ratio > mean) | (not mean), 0., 1.)
 
 
 class EpsilonProvider(object):
     """
     A provider of epsilons. If the correlation coefficient is nonzero,
-    it builds at instantiation time an NxN correlation matrix for the N
-    assets. The `.sample` method returns an array of NxS elements,
+    the epsilons are equicorrelated, i.e. generated with
+    :func:`equicorrelated_epsilons` without building any NxN covariance
+    matrix. The `.sample` method returns an array of NxS elements,
     where S is the number of seeds passed.
 
     Here is an example without correlation:
@@ -608,9 +833,9 @@ class EpsilonProvider(object):
 
     >>> ep = EpsilonProvider(num_assets=3, correlation=1)
     >>> ep.sample(seeds=[42, 43])
-    array([[-0.49671415, -0.25739993],
-           [-0.49671415, -0.25739993],
-           [-0.49671415, -0.25739993]])
+    array([[ 1.52302986, -0.5349156 ],
+           [ 1.52302986, -0.5349156 ],
+           [ 1.52302986, -0.5349156 ]])
     """
     def __init__(self, num_assets, correlation):
         """
@@ -621,22 +846,14 @@ class EpsilonProvider(object):
         assert 0 <= correlation <= 1, correlation
         self.num_assets = num_assets
         self.correlation = correlation
-        if self.correlation:
-            self.means_vector = numpy.zeros(num_assets)
-            self.covariance_matrix = (
-                numpy.ones((num_assets, num_assets)) * correlation +
-                numpy.diag(numpy.ones(num_assets)) * (1 - correlation))
 
     def sample_one(self, seed):
         """
         :param int seed: the random seed used to generate the epsilons
         :returns: an array with `num_assets` epsilons
         """
-        numpy.random.seed(seed)
-        if not self.correlation:
-            return numpy.random.normal(size=self.num_assets)
-        return numpy.random.multivariate_normal(
-            self.means_vector, self.covariance_matrix, 1).reshape(-1)
+        return equicorrelated_epsilons(
+            self.num_assets, 1, seed, self.correlation).reshape(-1)
 
     def sample(self, seeds):
         """
@@ -651,7 +868,8 @@ def make_epsilons(matrix, seed, correlation):
     Given a matrix N * R returns a matrix of the same shape N * R
     obtained by applying the multivariate_normal distribution to
     N points and R samples, by starting from the given seed and
-    correlation.
+    correlation. Since it builds a dense N * N covariance matrix,
+    use :func:`equicorrelated_epsilons` for large numbers of assets.
     """
     if seed is not None:
         numpy.random.seed(seed)
@@ -667,6 +885,35 @@ def make_epsilons(matrix, seed, correlation):
         means_vector, covariance_matrix, samples).transpose()
 
 
+def equicorrelated_epsilons(num_assets, num_samples, seed, correlation):
+    """
+    Generate a matrix N * R of standard normal epsilons such that any
+    two assets have the same correlation coefficient rho, by using the
+    one-factor decomposition
+
+        eps_i = sqrt(rho) * Z_common + sqrt(1 - rho) * Z_i
+
+    The cost is O(N * R) in time and memory, whereas sampling a
+    multivariate normal requires a N * N covariance matrix. Without
+    correlation the result is the same as the one of
+    :func:`make_epsilons`.
+
+    :param num_assets: the number of assets N
+    :param num_samples: the number of samples R
+    :param seed: a random seed (or None)
+    :param correlation: coefficient in the range [0, 1]
+    :returns: an array of shape (N, R)
+    """
+    if seed is not None:
+        numpy.random.seed(seed)
+    eps = numpy.random.normal(size=(num_samples, num_assets)).transpose()
+    if correlation:
+        common = numpy.random.normal(size=num_samples)
+        eps = (numpy.sqrt(1. - correlation) * eps +
+               numpy.sqrt(correlation) * common)
+    return eps
+
+
 @DISTRIBUTIONS.add('LN')
 class LogNormalDistribution(Distribution):
     """
@@ -695,14 +942,33 @@ class LogNormalDistribution(Distribution):
         probs = means / numpy.sqrt(1 + covs ** 2) * numpy.exp(epsilons * sigma)
         return probs
 
+    def can_sample_all(self, gmvs):
+        return (self.epsilons is not None and
+                numpy.ndim(self.epsilons) == 2 and
+                len(self.epsilons) == len(gmvs))
+
+    def sample_all(self, means, covs, _stddevs, mask):
+        if self.epsilons is None:
+            raise ValueError("A LogNormalDistribution must be initialized "
+                             "before you can use it")
+        epsilons = numpy.asarray(self.epsilons)
+        # `.sample` takes the first K epsilons of each asset, where K is
+        # the number of sampled values for the asset; here the j-th
+        # sampled value of the i-th asset gets the epsilon [i, j]
+        rows = numpy.arange(len(mask)).reshape(-1, 1)
+        cols = numpy.cumsum(mask, axis=1) - 1
+        epsilons = epsilons[rows, cols][mask]
+        sigma = numpy.sqrt(numpy.log(covs ** 2.0 + 1.0))
+        probs = means / numpy.sqrt(1 + covs ** 2) * numpy.exp(epsilons * sigma)
+        return probs
+
     def survival(self, loss_ratio, mean, stddev):
         # scipy does not handle correctly the limit case stddev = 0.
         # In that case, when `mean` > 0 the survival function
         # approaches to a step function, otherwise (`mean` == 0) we
-        # returns 0
+        # returns 0; `loss_ratio` can be a scalar or an array
         if stddev == 0:
-            return numpy.piecewise(
-                loss_ratio, [loss_ratio > mean or not mean], [0, 1])
+            return numpy.where((loss_ratio > mean) | (not mean), 0., 1.)
 
         variance = stddev ** 2.0
 
@@ -718,6 +984,14 @@ class BetaDistribution(Distribution):
         beta = self._beta(means, stddevs)
         return numpy.random.beta(alpha, beta, size=None)
 
+    def can_sample_all(self, gmvs):
+        return True
+
+    def sample_all(self, means, covs, stddevs, _mask):
+        # the values are drawn from the global random state in row order,
+        # exactly as when calling .sample once per asset
+        return self.sample(means, covs, stddevs)
+
     def survival(self, loss_ratio, mean, stddev):
         return stats.beta.sf(loss_ratio,
                              self._alpha(mean, stddev),
@@ -732,25 +1006,55 @@ class BetaDistribution(Distribution):
         return ((1 - mean) / stddev ** 2 - 1 / mean) * (mean - mean ** 2)
 
 
+def sample_pmf(values, cumprobs, uniforms):
+    """
+    Sample K values from K discrete distributions with the inverse-CDF
+    method: the k-th sample is the first value whose cumulative
+    probability is not smaller than the k-th uniform number. The
+    cumulative probabilities are compared with the uniform numbers one
+    value at the time, so that the memory occupation is O(K).
+
+    :param values: an array of M values
+    :param cumprobs:
+        an iterable over M arrays of K cumulative probabilities, like a
+        matrix of shape M x K; the last array is not read, since it
+        contains ones
+    :param uniforms: an array of K numbers in the range [0, 1]
+    :returns: an array of K values
+
+    >>> cumprobs = numpy.array([[.2, .5], [.7, 1.], [1., 1.]])
+    >>> sample_pmf(numpy.array([0., .5, 1.]), cumprobs, [.1, .9])
+    array([ 0. ,  0.5])
+    """
+    values = numpy.asarray(values)
+    uniforms = numpy.asarray(uniforms)
+    idxs = numpy.zeros(len(uniforms), int)
+    for cumprob in itertools.islice(cumprobs, len(values) - 1):
+        idxs += cumprob < uniforms
+    return values[idxs]
+
+
 @DISTRIBUTIONS.add('PM')
 class DiscreteDistribution(Distribution):
     def sample(self, loss_ratios, probs):
-        ret = []
-        for i in range(probs.shape[1]):
-            pmf = stats.rv_discrete(name='pmf', values=(range(len(loss_ratios)), probs[:,i]))
-            ret.append(loss_ratios[pmf.rvs()])
-        return ret
+        """
+        :param loss_ratios: an array of M loss ratios
+        :param probs: an array of probabilities of shape M x K
+        :returns: K loss ratios sampled with the inverse-CDF method
+        """
+        return sample_pmf(loss_ratios, numpy.cumsum(probs, axis=0),
+                          numpy.random.random_sample(probs.shape[1]))
 
-    def survival(self, loss_ratios, probs):
-        """Required for the Classical Risk and BCR Calculators.
-        Currently left unimplemented as the PMF format is used only for the
-        Scenario and Event Based Risk Calculators
-        :param int steps:
-            Number of steps between loss ratios.
+    def survival(self, loss_ratio, loss_ratios, probs):
+        """
+        :param loss_ratio: a loss ratio
+        :param loss_ratios: an array of M loss ratios
+        :param probs: an array of M probabilities
+        :returns: the probability of exceeding `loss_ratio`
         """
-        # TODO: to be implemented if the classical risk calculator
-        # needs to support the pmf vulnerability format
-        return
+        return numpy.asarray(probs)[
+            numpy.asarray(loss_ratios) > loss_ratio].sum(axis=0)
+
 
 #
 # Event Based
@@ -771,17 +1075,35 @@ class CurveBuilder(object):
         self.loss_curve_dt = numpy.dtype([
             ('losses', (float, R)), ('poes', (float, R)), ('avg', float)])
 
-    def build_counts(self, loss_matrix):
+    def build_counts(self, loss_matrix, counts=None):
         """
         :param loss_matrix:
             a matrix of loss ratios of size N x R, N = #assets, R = #ruptures
+        :param counts:
+            if given, an array of counts of shape N x C which is updated
+            in place; since the counts are additive in the ruptures, this
+            can be used to accumulate them one block of ruptures at the time
+            without keeping the full loss matrix in memory
+        :returns:
+            an array of counts of shape N x C, C = curve resolution
         """
+        loss_matrix = numpy.asarray(loss_matrix, float)
         N = len(loss_matrix)
-        counts = numpy.zeros((N, self.curve_resolution), numpy.uint32)
-        for i, loss_ratios in enumerate(loss_matrix):
-            # build the counts for each asset
-            counts[i, :] = numpy.array([(loss_ratios > ratio).sum()
-                                        for ratio in self.ratios])
+        C = self.curve_resolution
+        if counts is None:
+            counts = numpy.zeros((N, C), numpy.uint32)
+        if N == 0 or loss_matrix.size == 0:
+            return counts
+        loss_matrix = loss_matrix.reshape(N, -1)
+        # for each loss ratio, find the number of ratios strictly below it,
+        # i.e. the bin in the range 0 .. C; NaNs do not exceed anything
+        bins = numpy.searchsorted(self.ratios, loss_matrix, side='left')
+        bins[numpy.isnan(loss_matrix)] = 0
+        # histogram per asset, obtained with a single bincount
+        offsets = numpy.arange(N).reshape(-1, 1) * (C + 1)
+        hist = numpy.bincount((bins + offsets).ravel(),
+                              minlength=N * (C + 1)).reshape(N, C + 1)
+        counts += _exceedances(hist).astype(numpy.uint32)
         return counts
 
     def build_poes(self, counts, tses, time_span):
@@ -810,6 +1132,96 @@ class CurveBuilder(object):
         return lcs
 
 
+def _exceedances(hist):
+    # given an histogram N x (C + 1), where hist[i, k] is the number of
+    # losses of the i-th asset exceeding exactly k reference values,
+    # returns the N x C matrix of the losses exceeding the j-th reference
+    # value, i.e. the number of losses falling in the bins > j
+    return hist[:, ::-1].cumsum(axis=1)[:, -2::-1]
+
+
+class LossTableCurveBuilder(object):
+    """
+    Build event based loss curves for N assets from a table of losses
+    which is read in blocks, without keeping all the losses in memory.
+    Two passes on the table are needed, the first one to find the
+    maximum loss of each asset and the second one to count the exceedances
+    of the reference losses. The usage is something like this:
+
+      builder = LossTableCurveBuilder(num_assets, curve_resolution)
+      for indices, losses in blocks:
+          builder.update_max(indices, losses)
+      for indices, losses in blocks:
+          builder.update_counts(indices, losses)
+      losses, poes, avgs = builder.build_curves(tses, time_span)
+
+    The curves are the same as the ones obtained by calling
+    :func:`event_based` on the losses of each asset.
+    """
+    def __init__(self, num_assets, curve_resolution):
+        self.num_assets = num_assets
+        self.curve_resolution = curve_resolution
+        self.max_losses = numpy.zeros(num_assets)
+        self.hist = numpy.zeros((num_assets, curve_resolution + 1), int)
+        self._references = None
+        self._flat_ratios = None
+
+    @property
+    def references(self):
+        """
+        The reference losses, a matrix N x C built as
+        numpy.linspace(0, max_loss, C) for each asset
+        """
+        if self._references is None:
+            C = self.curve_resolution
+            self._references = numpy.outer(
+                self.max_losses / (C - 1), numpy.arange(C))
+            self._references[:, -1] = self.max_losses
+        return self._references
+
+    def update_max(self, indices, losses):
+        """
+        :param indices: an array of K asset indices
+        :param losses: an array of K losses
+        """
+        numpy.maximum.at(self.max_losses, indices, losses)
+
+    def update_counts(self, indices, losses):
+        """
+        :param indices: an array of K asset indices
+        :param losses: an array of K losses
+        """
+        C = self.curve_resolution
+        if self._flat_ratios is None:
+            # the reference loss ratios of asset i are shifted by 2 * i,
+            # so that the flattened array is sorted and a single
+            # searchsorted finds the references strictly below each loss
+            self._scale = numpy.where(
+                self.max_losses > 0, self.max_losses, 1.)
+            offsets = 2. * numpy.arange(self.num_assets)
+            self._flat_ratios = (self.references / self._scale[:, None] +
+                                 offsets[:, None]).ravel()
+        ratios = losses / self._scale[indices] + 2. * indices
+        lo = numpy.searchsorted(self._flat_ratios, ratios) - indices * C
+        self.hist += numpy.bincount(
+            indices * (C + 1) + lo,
+            minlength=self.num_assets * (C + 1)).reshape(-1, C + 1)
+
+    def build_curves(self, tses, time_span):
+        """
+        :param tses: Time representative of the stochastic event set
+        :param time_span: Investigation Time spanned by the hazard input
+        :returns: arrays with the losses (N x C), poes (N x C) and
+                  average losses (N) of the loss curves
+        """
+        losses = self.references
+        rates_of_exceedance = _exceedances(self.hist) / float(tses)
+        poes = 1. - numpy.exp(-rates_of_exceedance * time_span)
+        avgs = (numpy.diff(losses, axis=1) *
+                (poes[:, :-1] + poes[:, 1:]) / 2.).sum(axis=1)
+        return losses, poes, avgs
+
+
 def event_based(loss_values, tses, time_span, curve_resolution):
     """
     Compute a loss (or loss ratio) curve.
@@ -826,10 +1238,12 @@ def event_based(loss_values, tses, time_span, curve_resolution):
     """
     reference_losses = numpy.linspace(
         0, numpy.max(loss_values), curve_resolution)
-    # counts how many loss_values are bigger than the reference loss
-    times = [(loss_values > loss).sum() for loss in reference_losses]
-    # NB: (loss_values > loss).sum() is MUCH more efficient than
-    # sum(loss_values > loss). Incredibly more efficient in memory.
+    # counts how many loss_values are bigger than the reference loss,
+    # with a single sort and a binary search instead of a pass over
+    # the losses for each reference loss
+    sorted_losses = numpy.sort(numpy.asarray(loss_values, float), axis=None)
+    times = len(sorted_losses) - numpy.searchsorted(
+        sorted_losses, reference_losses, side='right')
 
     rates_of_exceedance = numpy.array(times) / float(tses)
 
@@ -872,35 +1286,39 @@ def classical_damage(
     :param hazard_imls:
         Intensity Measure Levels
     :param hazard_poes:
-        hazard curve
+        hazard curve, or an array of N hazard curves
     :param investigation_time:
         hazard investigation time
     :param risk_investigation_time:
         risk investigation time
     :returns:
         an array of M probabilities of occurrence where M is the numbers
-        of damage states.
+        of damage states; an array N x M if N hazard curves were passed.
     """
     imls = numpy.array(fragility_functions.imls)
+    hazard_poes = numpy.array(hazard_poes, float)
     if fragility_functions.steps_per_interval:  # interpolate
         min_val, max_val = hazard_imls[0], hazard_imls[-1]
         numpy.putmask(imls, imls < min_val, min_val)
         numpy.putmask(imls, imls > max_val, max_val)
         poes = interpolate.interp1d(hazard_imls, hazard_poes)(imls)
     else:
-        poes = numpy.array(hazard_poes)
+        poes = hazard_poes
     afe = annual_frequency_of_exceedence(poes, investigation_time)
-    annual_frequency_of_occurrence = pairwise_diff(
-        pairwise_mean([afe[0]] + list(afe) + [afe[-1]]))
-    poes_per_damage_state = []
-    for ff in fragility_functions:
-        frequency_of_exceedence_per_damage_state = numpy.dot(
-            annual_frequency_of_occurrence, map(ff, imls))
-        poe_per_damage_state = 1. - numpy.exp(
-            - frequency_of_exceedence_per_damage_state
-            * risk_investigation_time)
-        poes_per_damage_state.append(poe_per_damage_state)
-    poos = pairwise_diff([1] + poes_per_damage_state + [0])
+    # pad with the first and last values, then take the pairwise means
+    # and the pairwise differences along the last axis
+    afe = numpy.concatenate([afe[..., :1], afe, afe[..., -1:]], axis=-1)
+    annual_frequency_of_occurrence = -numpy.diff(
+        (afe[..., 1:] + afe[..., :-1]) / 2., axis=-1)
+    # frequencies of exceedence per damage state, shape (..., L)
+    frequency_of_exceedence_per_damage_state = numpy.dot(
+        annual_frequency_of_occurrence, fragility_functions.poes_matrix(imls))
+    poes_per_damage_state = 1. - numpy.exp(
+        - frequency_of_exceedence_per_damage_state * risk_investigation_time)
+    shape = poes_per_damage_state.shape[:-1] + (1,)
+    poos = -numpy.diff(numpy.concatenate(
+        [numpy.ones(shape), poes_per_damage_state, numpy.zeros(shape)],
+        axis=-1), axis=-1)
     return poos
 
 #
@@ -922,13 +1340,10 @@ def classical(vulnerability_function, hazard_imls, hazard_poes, steps=10):
         Number of steps between loss ratios.
     """
     vf = vulnerability_function.strictly_increasing()
-    imls = vf.mean_imls()
     loss_ratios, lrem = vf.loss_ratio_exceedance_matrix(steps)
 
     # saturate imls to hazard imls
-    min_val, max_val = hazard_imls[0], hazard_imls[-1]
-    numpy.putmask(imls, imls < min_val, min_val)
-    numpy.putmask(imls, imls > max_val, max_val)
+    imls = numpy.clip(vf.mean_imls(), hazard_imls[0], hazard_imls[-1])
 
     # interpolate the hazard curve
     poes = interpolate.interp1d(hazard_imls, hazard_poes)(imls)
@@ -942,6 +1357,40 @@ def classical(vulnerability_function, hazard_imls, hazard_poes, steps=10):
     return numpy.array([loss_ratios, lrem_po.sum(axis=1)])
 
 
+def classical_curves(vulnerability_function, hazard_imls, hazard_curves,
+                     steps=10):
+    """
+    Vectorized version of :func:`classical`, computing the loss ratio
+    curves of N assets with the same vulnerability function at once.
+    The hazard curves are interpolated in a single call and the LREM
+    is applied with a single (N x L) x (L x C) matrix product.
+
+    :param vulnerability_function:
+        an instance of
+        :py:class:`openquake.risklib.scientific.VulnerabilityFunction`
+    :param hazard_imls:
+        the hazard intensity measure levels (I)
+    :param hazard_curves:
+        an array of shape (N, I) with the hazard curves
+    :param int steps:
+        Number of steps between loss ratios.
+    :returns:
+        an array of shape (N, 2, C) with N pairs (loss_ratios, poes)
+    """
+    vf = vulnerability_function.strictly_increasing()
+    # saturate imls to hazard imls
+    imls = numpy.clip(vf.mean_imls(), hazard_imls[0], hazard_imls[-1])
+    loss_ratios, lrem = vf.loss_ratio_exceedance_matrix(steps)
+    hazard_curves = numpy.asarray(hazard_curves, float)
+    # interpolate the hazard curves and compute the poos, shape (N, L)
+    poes = interpolate.interp1d(hazard_imls, hazard_curves)(imls)
+    pos = -numpy.diff(poes, axis=1)
+    curves = numpy.zeros((len(hazard_curves), 2, len(loss_ratios)))
+    curves[:, 0] = loss_ratios
+    curves[:, 1] = numpy.dot(pos, lrem.T)
+    return curves
+
+
 def conditional_loss_ratio(loss_ratios, poes, probability):
     """
     Return the loss ratio corresponding to the given PoE (Probability
@@ -992,6 +1441,55 @@ def conditional_loss_ratio(loss_ratios, poes, probability):
         return (y2 - y1) / (x2 - x1) * (probability - x1) + y1
 
 
+def conditional_loss_ratios(curves, probabilities):
+    """
+    Vectorized version of :func:`conditional_loss_ratio`, working on
+    N curves with the same number of points and P probabilities at once,
+    with the same semantics in the four cases.
+
+    :param curves:
+        an array of shape (N, 2, C) with N pairs (loss_ratios, poes)
+    :param probabilities:
+        a sequence of P probabilities
+    :returns:
+        an array of shape (P, N)
+
+    >>> curves = [[[0.21, 0.24, 0.27, 0.30], [0.131, 0.108, 0.089, 0.066]]]
+    >>> conditional_loss_ratios(curves, [0.2, 0.1, 0.089, 0.01])
+    array([[ 0.        ],
+           [ 0.25263158],
+           [ 0.27      ],
+           [ 0.3       ]])
+    """
+    curves = numpy.asarray(curves, float)
+    num_curves, _, num_points = curves.shape
+    loss_ratios, poes = curves[:, 0], curves[:, 1]
+    rows = numpy.arange(num_curves)
+    all_nan = numpy.isnan(poes).all(axis=1)
+    out = numpy.zeros((len(probabilities), num_curves))
+    # NaN poes and degenerate intervals are managed below
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        for p, probability in enumerate(probabilities):
+            # the same index as bisect_right on the reversed poes
+            interval_index = (poes <= probability).sum(axis=1)
+            hi = numpy.clip(num_points - interval_index,
+                            min(1, num_points - 1), num_points - 1)
+            x1, x2 = poes[rows, hi - 1], poes[rows, hi]
+            y1, y2 = loss_ratios[rows, hi - 1], loss_ratios[rows, hi]
+            ratios = (y2 - y1) / (x2 - x1) * (probability - x1) + y1
+            # the conditions are applied in reverse order of priority
+            ratios[all_nan] = numpy.nan
+            exact = poes == probability
+            found = exact.any(axis=1)
+            ratios[found] = numpy.where(
+                exact[found], loss_ratios[found], -numpy.inf).max(axis=1)
+            below = probability < poes[:, -1]  # min PoE
+            ratios[below] = loss_ratios[below, -1]
+            ratios[probability > poes[:, 0]] = 0.  # max PoE
+            out[p] = ratios
+    return out
+
+
 #
 # Insured Losses
 #
@@ -1027,6 +1525,50 @@ def insured_loss_curve(curve, deductible, insured_limit):
         numpy.piecewise(poes, [poes > limit_poe], [limit_poe, lambda x: x])])
 
 
+def insured_loss_curves(curves, deductibles, insured_limits):
+    """
+    Vectorized version of :func:`insured_loss_curve`. The PoEs at the
+    deductibles are computed for all the curves at once, with the same
+    linear interpolation used by `interp1d`; repeated losses are fine.
+
+    :param curves: an array of shape (N, 2, C)
+    :param deductibles: N deductible limits in fraction form
+    :param insured_limits: N insured limits in fraction form
+    :returns:
+        an array of N insured loss curves; since each curve is cut at
+        its insured limit, the curves can have different lengths
+    """
+    curves = numpy.asarray(curves, float)
+    losses, poes = curves[:, 0], curves[:, 1]
+    deductibles = numpy.asarray(deductibles, float)
+    num_points = losses.shape[1]
+    rows = numpy.arange(len(curves))
+    # as in `interp1d`, when the deductible is equal to repeated losses
+    # the PoE of the last of them is taken
+    hi = numpy.clip((losses <= deductibles[:, None]).sum(axis=1),
+                    1, num_points - 1)
+    x_lo, x_hi = losses[rows, hi - 1], losses[rows, hi]
+    y_lo, y_hi = poes[rows, hi - 1], poes[rows, hi]
+    width = x_hi - x_lo
+    zero = width == 0  # possible only at the ends of the curve
+    limit_poes = numpy.where(
+        zero, y_hi, (y_hi - y_lo) / numpy.where(zero, 1, width) *
+        (deductibles - x_lo) + y_lo)
+    # out of bounds, as fill_value=1 in insured_loss_curve
+    limit_poes[(deductibles < losses[:, 0]) |
+               (deductibles > losses[:, -1])] = 1
+    insured_poes = numpy.where(
+        poes > limit_poes[:, None], limit_poes[:, None], poes)
+    ok = losses <= numpy.asarray(insured_limits, float)[:, None]
+    if (ok == ok[:1]).all():  # same length for all curves
+        return numpy.array([numpy.array([ls[mask], ps[mask]]) for ls, ps, mask
+                            in zip(losses, insured_poes, ok)])
+    insured_curves = numpy.zeros(len(curves), object)
+    for i, (ls, ps, mask) in enumerate(zip(losses, insured_poes, ok)):
+        insured_curves[i] = numpy.array([ls[mask], ps[mask]])
+    return insured_curves
+
+
 #
 # Benefit Cost Ratio Analysis
 #
@@ -1089,14 +1631,13 @@ def mean_std(fractions):
 
 def loss_map_matrix(poes, curves):
     """
-    Wrapper around :func:`openquake.risklib.scientific.conditional_loss_ratio`.
-    Return a matrix of shape (num-poes, num-curves). The curves are lists of
-    pairs (loss_ratios, poes).
+    Wrapper around :func:`conditional_loss_ratios`, accepting also an empty
+    list of curves. Return a matrix of shape (num-poes, num-curves).
+    The curves are lists of pairs (loss_ratios, poes).
     """
-    return numpy.array(
-        [[conditional_loss_ratio(curve[0], curve[1], poe)
-          for curve in curves] for poe in poes]
-    ).reshape((len(poes), len(curves)))
+    if len(curves) == 0:
+        return numpy.zeros((len(poes), 0))
+    return conditional_loss_ratios(curves, poes)
 
 
 def mean_curve(values, weights=None):
@@ -1148,31 +1689,53 @@ def quantile_curve(curves, quantile, weights=None):
     assert len(weights) == len(curves)
     weights = numpy.array(weights, dtype=numpy.float64)
 
-    result_curve = []
+    # sort all the columns at once and interpolate the quantile on the
+    # cumulative weights, as numpy.interp would do column by column
     np_curves = numpy.array(curves).reshape(len(curves), -1)
-    np_weights = numpy.array(weights)
-    for poes in np_curves.transpose():
-        sorted_poe_idxs = numpy.argsort(poes)
-        sorted_weights = np_weights[sorted_poe_idxs]
-        sorted_poes = poes[sorted_poe_idxs]
-        cum_weights = numpy.cumsum(sorted_weights)
-        result_curve.append(numpy.interp(quantile, cum_weights, sorted_poes))
-    return numpy.array(result_curve)
+    num_curves, num_columns = np_curves.shape
+    columns = numpy.arange(num_columns)
+    sorted_poe_idxs = numpy.argsort(np_curves, axis=0)
+    sorted_poes = np_curves[sorted_poe_idxs, columns]
+    cum_weights = numpy.cumsum(weights[sorted_poe_idxs], axis=0)
+    idx = (cum_weights <= quantile).sum(axis=0) - 1  # left point
+    left = numpy.clip(idx, 0, max(num_curves - 2, 0))
+    right = numpy.minimum(left + 1, num_curves - 1)
+    x0 = cum_weights[left, columns]
+    y0 = sorted_poes[left, columns]
+    y1 = sorted_poes[right, columns]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        slope = (y1 - y0) / (cum_weights[right, columns] - x0)
+        result_curve = slope * (quantile - x0) + y0
+    result_curve = numpy.where(idx < 0, sorted_poes[0], result_curve)
+    return numpy.where(idx >= num_curves - 1, sorted_poes[-1], result_curve)
+
+
+def average_losses(curves):
+    """
+    Vectorized version of :func:`average_loss`.
+
+    :param curves: an array of shape (N, 2, C) with N pairs (losses, poes)
+    :returns: an array with N average losses
+    """
+    curves = numpy.asarray(curves, float)
+    losses, poes = curves[:, 0], curves[:, 1]
+    return ((losses[:, 1:] - losses[:, :-1]) *
+            (poes[:, 1:] + poes[:, :-1]) / 2.).sum(axis=1)
 
 
-def exposure_statistics(
-        loss_curves, map_poes, weights, quantiles):
+def exposure_statistics(loss_curves, map_poes, weights, quantiles):
     """
     Compute exposure statistics for N assets and R realizations.
 
     :param loss_curves:
-        a list with N loss curves data. Each item holds a 2-tuple with
-        1) the loss ratios on which the curves have been defined on
-        2) the poes of the R curves
+        a pair of normalized loss curves data, as returned by
+        :func:`normalize_curves`: 1) an array of shape (N, C) with the loss
+        ratios on which the curves have been defined on 2) an array of
+        shape (R, N, C) with the poes of the R curves
     :param map_poes:
         a numpy array with P poes used to compute loss maps
     :param weights:
-        a list of N weights used to compute mean/quantile weighted statistics
+        a list of R weights used to compute mean/quantile weighted statistics
     :param quantiles:
         the quantile levels used to compute quantile results
 
@@ -1183,112 +1746,97 @@ def exposure_statistics(
             3. a numpy array with P x N mean map values
             4. a numpy array with Q x N quantile loss curves
             5. a numpy array with Q x N quantile average loss values
-            6. a numpy array with Q x P quantile map values
-    """
-    curve_resolution = len(loss_curves[0][0])
-    map_nr = len(map_poes)
-
-    # Collect per-asset statistic along the last dimension of the
-    # following arrays
-    mean_curves = numpy.zeros((0, 2, curve_resolution))
-    mean_average_losses = numpy.array([])
-    mean_maps = numpy.zeros((map_nr, 0))
-    quantile_curves = numpy.zeros((len(quantiles), 0, 2, curve_resolution))
-    quantile_average_losses = numpy.zeros((len(quantiles), 0,))
-    quantile_maps = numpy.zeros((len(quantiles), map_nr, 0))
-
-    for loss_ratios, curves_poes in loss_curves:
-        _mean_curve, _mean_maps, _quantile_curves, _quantile_maps = (
-            asset_statistics(
-                loss_ratios, curves_poes, quantiles, weights, map_poes))
-
-        mean_curves = numpy.vstack(
-            (mean_curves, _mean_curve[numpy.newaxis, :]))
-        mean_average_losses = numpy.append(
-            mean_average_losses, average_loss(_mean_curve))
-
-        mean_maps = numpy.hstack((mean_maps, _mean_maps[:, numpy.newaxis]))
-        quantile_curves = numpy.hstack(
-            (quantile_curves, _quantile_curves[:, numpy.newaxis]))
-
-        _quantile_average_losses = utils.numpy_map(
-            average_loss, _quantile_curves)
-        quantile_average_losses = numpy.hstack(
-            (quantile_average_losses,
-             _quantile_average_losses[:, numpy.newaxis]))
-        quantile_maps = numpy.dstack(
-            (quantile_maps, _quantile_maps[:, :, numpy.newaxis]))
-
-    return (mean_curves, mean_average_losses, mean_maps,
-            quantile_curves, quantile_average_losses, quantile_maps)
-
-
-def asset_statistics(
-        losses, curves_poes, quantiles, weights, poes):
+            6. a numpy array with Q x P x N quantile map values
     """
-    Compute output statistics (mean/quantile loss curves and maps)
-    for a single asset
-
-    :param losses:
-       the losses on which the loss curves are defined
-    :param curves_poes:
-       a numpy matrix with the poes of the different curves
-    :param list quantiles:
-       an iterable over the quantile levels to be considered for
-       quantile outputs
-    :param list poes:
-       the poe taken into account for computing loss maps
-    :returns:
-       a tuple with
-       1) mean loss curve
-       2) a list of quantile curves
-       3) mean loss map
-       4) a list of quantile loss maps
-    """
-    mean_curve_ = numpy.array([losses, mean_curve(curves_poes, weights)])
-    mean_map = loss_map_matrix(poes, [mean_curve_]).reshape(len(poes))
-    quantile_curves = numpy.array(
-        [[losses, quantile_curve(curves_poes, quantile, weights)]
-         for quantile in quantiles]).reshape((len(quantiles), 2, len(losses)))
-    quantile_maps = loss_map_matrix(poes, quantile_curves).transpose()
-    return (mean_curve_, mean_map, quantile_curves, quantile_maps)
+    loss_ratios, curves_poes = loss_curves
+    num_assets, curve_resolution = loss_ratios.shape
+    mean_curves = numpy.zeros((num_assets, 2, curve_resolution))
+    mean_curves[:, 0] = loss_ratios
+    mean_curves[:, 1] = mean_curve(curves_poes, weights)
+    quantile_curves = numpy.zeros(
+        (len(quantiles), num_assets, 2, curve_resolution))
+    quantile_maps = numpy.zeros((len(quantiles), len(map_poes), num_assets))
+    for i, quantile in enumerate(quantiles):
+        quantile_curves[i, :, 0] = loss_ratios
+        quantile_curves[i, :, 1] = quantile_curve(
+            curves_poes, quantile, weights).reshape(
+            (num_assets, curve_resolution))
+        quantile_maps[i] = loss_map_matrix(map_poes, quantile_curves[i])
+    quantile_average_losses = numpy.array(
+        [average_losses(curves) for curves in quantile_curves]).reshape(
+        (len(quantiles), num_assets))
+    return (mean_curves, average_losses(mean_curves),
+            loss_map_matrix(map_poes, mean_curves),
+            quantile_curves, quantile_average_losses, quantile_maps)
 
 
 def normalize_curves(curves):
     """
-    :param curves: a list of pairs (losses, poes)
+    :param curves:
+        an array of shape (R, ..., 2, C) with pairs (losses, poes)
     :returns: first losses, all_poes
     """
-    return curves[0][0], [poes for _losses, poes in curves]
+    curves = numpy.asarray(curves)
+    return curves[0, ..., 0, :], curves[..., 1, :]
 
 
 def normalize_curves_eb(curves):
     """
     A more sophisticated version of normalize_curves, used in the event
-    based calculator.
+    based calculator. For each asset, the poes of the R curves are
+    interpolated on the losses of the curve with the maximum loss, as
+    `scipy.interpolate.interp1d` (with fill_value=0) would do curve by
+    curve; all the assets are managed at once.
 
-    :param curves: a list of pairs (losses, poes)
+    :param curves:
+        an array of shape (R, ..., 2, C) with pairs (losses, poes)
     :returns: first losses, all_poes
     """
+    curves = numpy.asarray(curves, float)
+    shape = curves.shape
+    num_rlzs, num_points = shape[0], shape[-1]
+    curves = curves.reshape((num_rlzs, -1, 2, num_points))
+    all_losses, all_poes = curves[:, :, 0], curves[:, :, 1]  # (R, N, C)
     # we assume non-decreasing losses, so losses[-1] is the maximum loss
-    non_zero_curves = [(losses, poes)
-                       for losses, poes in curves if losses[-1] > 0]
-    if not non_zero_curves:  # no damage. all zero curves
-        return curves[0][0], [poes for _losses, poes in curves]
-    else:  # standard case
-        max_losses = [losses[-1] for losses, _poes in non_zero_curves]
-        reference_curve = non_zero_curves[numpy.argmax(max_losses)]
-        loss_ratios = reference_curve[0]
-        curves_poes = [interpolate.interp1d(
-            losses, poes, bounds_error=False, fill_value=0)(loss_ratios)
-            for losses, poes in curves]
-    return loss_ratios, curves_poes
+    max_losses = all_losses[:, :, -1]  # shape (R, N)
+    if not (max_losses > 0).any():  # no damage. all zero curves
+        return (all_losses[0].reshape(shape[1:-2] + (num_points,)),
+                all_poes.reshape(shape[:-2] + (num_points,)))
+    # the reference curve of each asset is the one with the maximum loss
+    num_assets = all_losses.shape[1]
+    loss_ratios = all_losses[numpy.argmax(max_losses, axis=0),
+                             numpy.arange(num_assets)]  # shape (N, C)
+    # index of the first loss >= each loss ratio, as in numpy.searchsorted
+    idx = numpy.zeros(all_losses.shape, int)
+    for k in range(num_points):
+        idx[:, :, k] = (all_losses < loss_ratios[:, k, None]).sum(axis=2)
+    hi = numpy.clip(idx, 1, num_points - 1)
+    rlzs = numpy.arange(num_rlzs)[:, None, None]
+    assets = numpy.arange(num_assets)[:, None]
+    x_lo = all_losses[rlzs, assets, hi - 1]
+    x_hi = all_losses[rlzs, assets, hi]
+    y_lo = all_poes[rlzs, assets, hi - 1]
+    y_hi = all_poes[rlzs, assets, hi]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        slope = (y_hi - y_lo) / (x_hi - x_lo)
+        curves_poes = slope * (loss_ratios - x_lo) + y_lo
+    out_of_bounds = ((loss_ratios < all_losses[:, :, :1]) |
+                     (loss_ratios > all_losses[:, :, -1:]))
+    curves_poes[out_of_bounds] = 0
+    # the assets with all zero curves keep their poes
+    no_damage = (max_losses <= 0).all(axis=0)
+    curves_poes[:, no_damage] = all_poes[:, no_damage]
+    return (loss_ratios.reshape(shape[1:-2] + (num_points,)),
+            curves_poes.reshape(shape[:-2] + (num_points,)))
 
 
 class StatsBuilder(object):
     """
-    A class to build risk statistics
+    A class to build risk statistics. The statistics are computed on
+    blocks of `assets_per_block` assets, to keep the memory bounded.
     """
+    assets_per_block = 10000
+
     def __init__(self, quantiles,
                  conditional_loss_poes, poes_disagg,
                  normalize_curves=normalize_curves):
@@ -1301,8 +1849,42 @@ class StatsBuilder(object):
         """
         Normalize the loss curves by using the provided normalization function
         """
-        return map(self.normalize_curves,
-                   numpy.array(loss_curves).transpose(1, 0, 2, 3))
+        return self.normalize_curves(numpy.array(loss_curves))
+
+    def exposure_statistics(self, loss_curves, map_poes, weights):
+        """
+        Compute the exposure statistics on blocks of assets, filling
+        preallocated arrays.
+
+        :param loss_curves: a list of R arrays of shape (N, 2, C)
+        :param map_poes: a list of P poes used to compute loss maps
+        :param weights: a list of R weights
+        :returns: the same tuple returned by :func:`exposure_statistics`
+        """
+        loss_curves = numpy.array(loss_curves)  # shape (R, N, 2, C)
+        num_assets, curve_resolution = (
+            loss_curves.shape[1], loss_curves.shape[-1])
+        Q, P = len(self.quantiles), len(map_poes)
+        stats = (numpy.zeros((num_assets, 2, curve_resolution)),
+                 numpy.zeros(num_assets),
+                 numpy.zeros((P, num_assets)),
+                 numpy.zeros((Q, num_assets, 2, curve_resolution)),
+                 numpy.zeros((Q, num_assets)),
+                 numpy.zeros((Q, P, num_assets)))
+        for start in range(0, num_assets, self.assets_per_block):
+            stop = min(start + self.assets_per_block, num_assets)
+            block = exposure_statistics(
+                self.normalize(loss_curves[:, start:stop]),
+                map_poes, weights, self.quantiles)
+            # the asset axis is the first one for the means and the
+            # second one for the quantiles
+            stats[0][start:stop] = block[0]
+            stats[1][start:stop] = block[1]
+            stats[2][:, start:stop] = block[2]
+            stats[3][:, start:stop] = block[3]
+            stats[4][:, start:stop] = block[4]
+            stats[5][:, :, start:stop] = block[5]
+        return stats
 
     def build(self, all_outputs):
         """
@@ -1344,17 +1926,15 @@ class StatsBuilder(object):
             loss_curves.append(out.loss_curves)
         (mean_curves, mean_average_losses, mean_maps,
          quantile_curves, quantile_average_losses, quantile_maps) = (
-             exposure_statistics(
-                 self.normalize(loss_curves),
-                 self.conditional_loss_poes + self.poes_disagg,
-                 weights, self.quantiles))
+             self.exposure_statistics(
+                 loss_curves, self.conditional_loss_poes + self.poes_disagg,
+                 weights))
 
         if outputs[0].insured_curves is not None:
             loss_curves = [out.insured_curves for out in outputs]
             (mean_insured_curves, mean_average_insured_losses, _,
              quantile_insured_curves, quantile_average_insured_losses, _) = (
-                 exposure_statistics(
-                     self.normalize(loss_curves), [], weights, self.quantiles))
+                 self.exposure_statistics(loss_curves, [], weights))
         else:
             mean_insured_curves = None
             mean_average_insured_losses = None
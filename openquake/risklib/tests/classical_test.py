@@ -109,6 +109,19 @@ class ClassicalTestCase(unittest.TestCase):
             0.25263157,
             scientific.conditional_loss_ratio(loss_ratios, poes, 0.1))
 
+    def test_conditional_loss_ratios(self):
+        # the batched version gives the same results as the scalar one,
+        # including the duplicated and the NaN cases
+        curves = numpy.array([
+            [(0.21, 0.24, 0.27, 0.30), (0.131, 0.108, 0.089, 0.066)],
+            [(0.20, 0.21, 0.24, 0.30), (0.131, 0.131, 0.108, 0.066)],
+            [(0.20, 0.21, 0.24, 0.30), (numpy.nan,) * 4]])
+        probs = [0.2, 0.131, 0.13, 0.1, 0.089, 0.067, 0.066, 0.01]
+        expected = [[scientific.conditional_loss_ratio(lrs, poes, prob)
+                     for lrs, poes in curves] for prob in probs]
+        numpy.testing.assert_allclose(
+            scientific.conditional_loss_ratios(curves, probs), expected)
+
     def test_compute_lrem_using_beta_distribution(self):
         expected_lrem = [
             [1.0000000, 1.0000000, 1.0000000, 1.0000000, 1.0000000],
@@ -190,3 +203,42 @@ class ClassicalTestCase(unittest.TestCase):
         for loss, poe in expected_curve:
             numpy.testing.assert_allclose(
                 poe, actual_poes_interp(loss), atol=0.005)
+
+    def test_classical_curves(self):
+        # the batched kernel gives the same curves of `classical`,
+        # also for the insured losses
+        hazard_imls = [0.01, 0.08, 0.17, 0.26, 0.36, 0.55, 0.7]
+        hazard_curves = numpy.array(
+            [[0.99, 0.96, 0.89, 0.82, 0.7, 0.4, 0.01],
+             [0.9, 0.8, 0.6, 0.4, 0.2, 0.1, 0.01]])
+        vulnerability_function = scientific.VulnerabilityFunction(
+            'VF', 'PGA', [0.1, 0.2, 0.4, 0.6], [0.05, 0.08, 0.2, 0.4],
+            [0.5, 0.3, 0.2, 0.1], "LN")
+        curves = scientific.classical_curves(
+            vulnerability_function, hazard_imls, hazard_curves, 2)
+        self.assertEqual(curves.shape, (2, 2, 11))
+        for curve, hazard_curve in zip(curves, hazard_curves):
+            numpy.testing.assert_allclose(curve, scientific.classical(
+                vulnerability_function, hazard_imls, hazard_curve, 2))
+
+        deductibles, limits = [0.02, 0.1], [0.5, 0.9]
+        insured_curves = scientific.insured_loss_curves(
+            curves, deductibles, limits)
+        for i, insured_curve in enumerate(insured_curves):
+            numpy.testing.assert_allclose(
+                insured_curve, scientific.insured_loss_curve(
+                    curves[i], deductibles[i], limits[i]))
+
+    def test_insured_loss_curves_repeated_losses(self):
+        # the deductible is equal to repeated losses, at the beginning,
+        # in the middle and at the end of the curves
+        curves = numpy.array(
+            [[[0., 0., 0.1, 0.2], [1., 0.8, 0.5, 0.1]],
+             [[0., 0.1, 0.1, 0.2], [1., 0.8, 0.5, 0.1]],
+             [[0., 0.1, 0.2, 0.2], [1., 0.8, 0.5, 0.1]]])
+        deductibles, limits = [0., 0.1, 0.2], [0.2, 0.2, 0.2]
+        insured_curves = scientific.insured_loss_curves(
+            curves, deductibles, limits)
+        self.assertFalse(numpy.isnan(insured_curves).any())
+        numpy.testing.assert_allclose(
+            insured_curves[:, 1, 0], [0.8, 0.5, 0.1])
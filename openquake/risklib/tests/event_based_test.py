@@ -334,3 +334,43 @@ class ProbabilisticEventBasedTestCase(unittest.TestCase):
 
         numpy.testing.assert_allclose([0.] * 11, losses)
         numpy.testing.assert_allclose([0.] * 11, poes, atol=1E-10)
+
+
+class CurveBuilderTestCase(unittest.TestCase):
+    def test_build_counts(self):
+        numpy.random.seed(3)
+        loss_matrix = numpy.random.random((10, 30)) * 1.2
+        loss_matrix[0, :5] = 0
+        builder = scientific.CurveBuilder(curve_resolution=11)
+        expected = numpy.array([[(loss_ratios > ratio).sum()
+                                 for ratio in builder.ratios]
+                                for loss_ratios in loss_matrix])
+        counts = builder.build_counts(loss_matrix)
+        numpy.testing.assert_array_equal(counts, expected)
+
+        # the counts can be accumulated one block of ruptures at the time
+        counts = builder.build_counts(loss_matrix[:, :12])
+        builder.build_counts(loss_matrix[:, 12:], counts)
+        numpy.testing.assert_array_equal(counts, expected)
+
+
+class LossTableCurveBuilderTestCase(unittest.TestCase):
+    def test_same_as_event_based(self):
+        numpy.random.seed(7)
+        indices = numpy.random.randint(0, 4, 200)  # asset 4 has no losses
+        losses = numpy.random.random(200) * 100
+        losses[:20] = numpy.round(losses[:20])  # some ties
+        builder = scientific.LossTableCurveBuilder(5, 11)
+        for block in (slice(0, 70), slice(70, 200)):
+            builder.update_max(indices[block], losses[block])
+        for block in (slice(0, 130), slice(130, 200)):
+            builder.update_counts(indices[block], losses[block])
+        all_losses, all_poes, avgs = builder.build_curves(50, 50)
+        for i in range(4):
+            curve = scientific.event_based(losses[indices == i], 50, 50, 11)
+            numpy.testing.assert_allclose(all_losses[i], curve[0])
+            numpy.testing.assert_allclose(all_poes[i], curve[1])
+            self.assertAlmostEqual(avgs[i], scientific.average_loss(curve))
+        numpy.testing.assert_array_equal(all_losses[4], numpy.zeros(11))
+        numpy.testing.assert_array_equal(all_poes[4], numpy.zeros(11))
+        self.assertEqual(avgs[4], 0)
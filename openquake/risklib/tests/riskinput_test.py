@@ -46,6 +46,35 @@ a4,3,500000,1000,3000
         numpy.testing.assert_equal(
             assetcol, readers.read_composite_array(expected))
 
+    def test_asset_collection(self):
+        assetcol = riskinput.AssetCollection(self.assets_by_site)
+        self.assertEqual(len(assetcol), 5)
+        numpy.testing.assert_equal(
+            assetcol.array,
+            riskinput.build_asset_collection(self.assets_by_site))
+        assets = riskinput.sorted_assets(self.assets_by_site)
+        for asset, record in zip(assets, assetcol):
+            self.assertEqual(record.id, asset.id)
+            self.assertEqual(record.taxonomy, asset.taxonomy)
+            self.assertEqual(record.location, asset.location)
+            self.assertEqual(record.value('structural'),
+                             asset.value('structural'))
+            self.assertEqual(record.deductible('structural'),
+                             asset.deductible('structural'))
+        numpy.testing.assert_equal(
+            map(len, assetcol.assets_by_site()),
+            map(len, self.assets_by_site))
+
+        # extracting the RM assets
+        rm = assetcol.taxonomies.index('RM')
+        subset = assetcol[assetcol.taxonomy == rm]
+        self.assertEqual(subset.get_taxonomies(), ['RM'])
+        self.assertEqual([a.id for a in subset], ['a0', 'a3', 'a4'])
+        numpy.testing.assert_equal(
+            subset.get_values('structural'), [3000, 5000, 500000])
+        numpy.testing.assert_equal(
+            subset.get_insurance_limits('structural'), [100, 3000, 3000])
+
     def test_get_all(self):
         self.assertEqual(
             list(self.riskmodel.get_imt_taxonomies()),
@@ -100,3 +129,13 @@ a4,3,500000,1000,3000
         self.assertEqual(set(a.taxonomy for a in assets),
                          set(['RM', 'RC', 'W']))
         self.assertEqual(map(len, epsilons), [20] * 5)
+
+    def test_epsilon_getter(self):
+        # the lazy epsilons do not depend on the blocks
+        getter = riskinput.EpsilonGetter(42, 0.5, 10)
+        eps_dict = getter.get_eps_dict(self.assets_by_site)
+        self.assertEqual(sorted(eps_dict), ['a0', 'a1', 'a2', 'a3', 'a4'])
+        for indices in ([0, 1, 2], [3, 4, 5, 6, 7, 8, 9]):
+            edic = getter.restrict(indices).get_eps_dict(self.assets_by_site)
+            for asset_id, eps in edic.iteritems():
+                numpy.testing.assert_equal(eps, eps_dict[asset_id][indices])
@@ -16,11 +16,13 @@
 # License along with OpenQuake Risklib. If not, see
 # <http://www.gnu.org/licenses/>.
 
+import copy
 import unittest
 import mock
 import pickle
 
 import numpy
+from scipy import stats
 from openquake.risklib import (
     DegenerateDistribution, utils, scientific)
 
@@ -65,6 +67,40 @@ class TestMemoize(unittest.TestCase):
         self.assertEqual(1, m.call_count)
 
 
+class LRUCacheTestCase(unittest.TestCase):
+    def test_hits_misses_eviction(self):
+        m = mock.Mock(side_effect=lambda x: x * 2)
+        cache = utils.LRUCache(maxsize=2)
+        self.assertEqual(2, cache.get('a', m, 1))
+        self.assertEqual(4, cache.get('b', m, 2))
+        self.assertEqual(2, cache.get('a', m, 1))  # hit, 'b' is now older
+        self.assertEqual(6, cache.get('c', m, 3))  # 'b' is evicted
+        self.assertEqual(4, cache.get('b', m, 2))
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+        self.assertEqual(4, m.call_count)
+        self.assertEqual(list(cache.data), ['c', 'b'])
+
+    def test_vf_copies_share_the_lrem(self):
+        vf = scientific.VulnerabilityFunction(
+            'VF', 'PGA', [0.1, 0.2, 0.3], [0.05, 0.1, 0.3], [0.3, 0.2, 0.1])
+        lrs, lrem = vf.loss_ratio_exceedance_matrix(3)
+        hits = scientific.VF_CACHE.hits
+        vf2 = pickle.loads(pickle.dumps(vf))
+        lrs2, lrem2 = vf2.loss_ratio_exceedance_matrix(3)
+        self.assertIs(lrem, lrem2)
+        self.assertIs(vf._mlr_i1d, vf2._mlr_i1d)
+        # 3 hits: the two interpolators and the LREM
+        self.assertEqual(scientific.VF_CACHE.hits - hits, 3)
+        self.assertFalse(lrem.flags.writeable)
+
+        # the LREM is the same computed cell by cell
+        for row, lr in enumerate(lrs):
+            for col, (mean, stddev) in enumerate(zip(vf.mean_loss_ratios,
+                                                     vf.stddevs)):
+                self.assertEqual(lrem[row, col],
+                                 vf.distribution.survival(lr, mean, stddev))
+
+
 class VulnerabilityFunctionTestCase(unittest.TestCase):
     """
     Test for
@@ -305,6 +341,43 @@ class MeanLossTestCase(unittest.TestCase):
         aaae(mean3, mean)
 
 
+class ApplyToTestCase(unittest.TestCase):
+    IMLS = [0.1, 0.2, 0.3, 0.5, 0.7]
+    MLRS = [0.0035, 0.07, 0.14, 0.28, 0.56]
+
+    def setUp(self):
+        numpy.random.seed(1)
+        self.gmvs = numpy.random.lognormal(-1.5, 0.8, (20, 15))
+        self.epsilons = numpy.random.normal(size=(20, 15))
+
+    def check_same_as_row_by_row(self, vf):
+        # the vectorized path must give exactly the same results
+        # of applying the function to each asset separately
+        numpy.random.seed(42)
+        loss_matrix = vf.apply_to(self.gmvs, self.epsilons)
+        vfcopy = copy.copy(vf)
+        vfcopy.set_distribution(self.epsilons)
+        numpy.random.seed(42)
+        expected = utils.numpy_map(vfcopy._apply, self.gmvs)
+        numpy.testing.assert_array_equal(loss_matrix, expected)
+
+    def test_lognormal(self):
+        vf = scientific.VulnerabilityFunction(
+            'VF1', 'PGA', self.IMLS, self.MLRS, [0.1, 0.2, 0.3, 0.4, 0.5])
+        self.check_same_as_row_by_row(vf)
+
+    def test_beta(self):
+        vf = scientific.VulnerabilityFunction(
+            'VF1', 'PGA', self.IMLS, self.MLRS, [0.1, 0.2, 0.3, 0.4, 0.5],
+            'BT')
+        self.check_same_as_row_by_row(vf)
+
+    def test_degenerate(self):
+        vf = scientific.VulnerabilityFunction(
+            'VF1', 'PGA', self.IMLS, self.MLRS)
+        self.check_same_as_row_by_row(vf)
+
+
 class LogNormalDistributionTestCase(unittest.TestCase):
 
     def test_init(self):
@@ -343,6 +416,84 @@ class LogNormalDistributionTestCase(unittest.TestCase):
         numpy.testing.assert_allclose([0., 0., 0.1, 0.10228396], samples)
 
 
+class EquicorrelatedEpsilonsTestCase(unittest.TestCase):
+
+    def test_correlation(self):
+        correlation = 0.37
+        epsilons = scientific.equicorrelated_epsilons(
+            100, 1000, seed=17, correlation=correlation)
+        self.assertEqual(epsilons.shape, (100, 1000))
+        coeffs = numpy.corrcoef(epsilons)
+        offdiag = coeffs[~numpy.eye(100, dtype=bool)]
+        numpy.testing.assert_allclose(
+            correlation, offdiag, rtol=0, atol=0.1)
+        numpy.testing.assert_allclose(1, epsilons.std(axis=1), atol=0.1)
+
+    def test_no_correlation(self):
+        # the same numbers as make_epsilons
+        zeros = numpy.zeros((10, 20))
+        numpy.testing.assert_equal(
+            scientific.equicorrelated_epsilons(10, 20, 42, 0),
+            scientific.make_epsilons(zeros, 42, 0))
+
+    def test_full_correlation(self):
+        epsilons = scientific.equicorrelated_epsilons(10, 20, 42, 1)
+        numpy.testing.assert_allclose(epsilons, epsilons[[0] * 10])
+
+
+class VulnerabilityFunctionWithPMFTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loss_ratios = numpy.array([0, 0.1, 0.3, 0.6, 1.])
+        self.probs = numpy.array([[.8, .6, .3, .1],
+                                  [.1, .2, .2, .1],
+                                  [.05, .1, .2, .3],
+                                  [.05, .05, .2, .3],
+                                  [0, .05, .1, .2]])
+        self.vf = scientific.VulnerabilityFunctionWithPMF(
+            'VF', 'PGA', [0.1, 0.2, 0.4, 0.6], self.loss_ratios, self.probs)
+
+    def test_apply_to(self):
+        gmvs = numpy.random.RandomState(3).uniform(0, .8, (20, 50))
+        loss_ratios = self.vf.apply_to(gmvs, seed=42)
+        self.assertEqual(loss_ratios.shape, (20, 50))
+        # the sampling is reproducible
+        numpy.testing.assert_equal(
+            loss_ratios, self.vf.apply_to(gmvs, seed=42))
+        # no loss below the minimum IML
+        self.assertTrue((loss_ratios[gmvs < 0.1] == 0).all())
+
+    def test_sampled_frequencies(self):
+        gmvs = numpy.zeros((1, 100000)) + 0.4
+        samples = self.vf.apply_to(gmvs, seed=1)[0]
+        freqs = [(samples == lr).mean() for lr in self.loss_ratios]
+        numpy.testing.assert_allclose(freqs, self.probs[:, 2], atol=0.01)
+
+    def test_same_as_rv_discrete(self):
+        # without a seed the global generator is used and the losses are
+        # the same as the ones drawn one at the time with scipy
+        gmvs = numpy.random.RandomState(3).uniform(0, .8, (20, 50))
+        numpy.random.seed(7)
+        expected = numpy.zeros(gmvs.shape)
+        for row, iml_row in zip(expected, gmvs):
+            idxs, = numpy.where(iml_row >= 0.1)
+            probs = self.vf._probs_i1d(numpy.minimum(iml_row[idxs], 0.6))
+            for i, idx in enumerate(idxs):
+                pmf = stats.rv_discrete(name='pmf', values=(
+                    range(len(self.loss_ratios)), probs[:, i]))
+                row[idx] = self.loss_ratios[pmf.rvs()]
+        numpy.random.seed(7)
+        aaae(self.vf.apply_to(gmvs), expected)
+
+    def test_lrem(self):
+        loss_ratios, lrem = self.vf.loss_ratio_exceedance_matrix(1)
+        aaae(loss_ratios, self.loss_ratios)
+        aaae(lrem, [[0.2, 0.4, 0.7, 0.9],
+                    [0.1, 0.2, 0.5, 0.8],
+                    [0.05, 0.1, 0.3, 0.5],
+                    [0., 0.05, 0.1, 0.2],
+                    [0., 0., 0., 0.]])
+
+
 class VulnerabilityLossRatioStepsTestCase(unittest.TestCase):
     IMT = 'PGA'
 
@@ -487,6 +638,23 @@ class FragilityFunctionTestCase(unittest.TestCase):
         self._close_to([0.975, 0.025, 0.],
                        scientific.scenario_damage(ffs, 0.075))
 
+    def test_damage_fractions(self):
+        # the vectorized version must give the same results as the
+        # scalar scenario_damage, including the corner cases
+        ffs = scientific.FragilityFunctionList([
+            scientific.FragilityFunctionDiscrete(
+                'LS1', [0.05, 0.1, 0.3, 0.5, 0.7],
+                [0, 0.05, 0.20, 0.50, 1.00], 0.05),
+            scientific.FragilityFunctionDiscrete(
+                'LS2', [0.05, 0.1, 0.3, 0.5, 0.7],
+                [0, 0.00, 0.05, 0.20, 0.50], 0.05)])
+        gmfs = numpy.array([[0.02, 0.075, 0.4], [0.7, 0.8, 0.05]])
+        fractions = ffs.damage_fractions(gmfs)
+        self.assertEqual(fractions.shape, (2, 3, 3))
+        for gmvs, fracs in zip(gmfs, fractions):
+            for gmv, frac in zip(gmvs, fracs):
+                aaae(frac, scientific.scenario_damage(ffs, gmv))
+
     def _close_to(self, expected, actual):
         numpy.testing.assert_allclose(actual, expected, atol=0.0, rtol=0.05)
 
@@ -616,6 +784,16 @@ class ClassicalDamageTestCase(unittest.TestCase):
         aaae(poos, [1.0415184E-09, 1.4577245E-06, 1.9585762E-03, 6.9677521E-02,
                     9.2836244E-01])
 
+        # the same computation on two curves at once
+        poos2 = scientific.classical_damage(
+            fragility_functions, hazard_imls,
+            numpy.array([hazard_poes, hazard_poes / 2]),
+            investigation_time, risk_investigation_time)
+        aaae(poos2[0], poos)
+        aaae(poos2[1], scientific.classical_damage(
+            fragility_functions, hazard_imls, hazard_poes / 2,
+            investigation_time, risk_investigation_time))
+
     def test_continuous(self):
         hazard_imls = numpy.array(
             [0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5, 0.55, 0.6,
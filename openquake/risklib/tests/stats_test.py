@@ -172,6 +172,18 @@ class NormalizeTestCase(unittest.TestCase):
         numpy.testing.assert_allclose(poes1, [numpy.nan, 0., 0., 0., 0., 0.])
         numpy.testing.assert_allclose(poes2, curve[1])
 
+    def test_normalize_many_assets(self):
+        # the assets are normalized independently
+        trivial = [numpy.zeros(6), numpy.linspace(1, 0, 6)]
+        curve = [numpy.linspace(0., 1., 6), numpy.linspace(1., 0., 6)]
+        curve2 = [numpy.linspace(0., 2., 6), numpy.linspace(1., 0., 6)]
+        curves = numpy.array([[curve, trivial], [curve2, trivial]])  # R, N
+        exp_losses, poes = scientific.normalize_curves_eb(curves)
+        numpy.testing.assert_allclose(exp_losses, [curve2[0], trivial[0]])
+        numpy.testing.assert_allclose(
+            poes[:, 0], [[1., 0.6, 0.2, 0., 0., 0.], curve2[1]])
+        numpy.testing.assert_allclose(poes[:, 1], [trivial[1], trivial[1]])
+
 
 def asset(ref, value, deductibles=None,
           insurance_limits=None,
@@ -195,12 +207,13 @@ def loss_curves(assets, baselosses, seed):
 class StatsTestCase(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        assets = [asset('a1', 101), asset('a2', 151), asset('a3', 91),
-                  asset('a4', 81)]
+        cls.assets = assets = [asset('a1', 101), asset('a2', 151),
+                               asset('a3', 91), asset('a4', 81)]
         asset_refs = [a.id for a in assets]
         outputs = []
         weights = [0.3, 0.7]
-        baselosses = numpy.array([.10, .14, .17, .20, .21])
+        cls.baselosses = baselosses = numpy.array(
+            [.10, .14, .17, .20, .21])
         for i, w in enumerate(weights):
             lc = loss_curves(assets, baselosses, i)
             out = scientific.Output(asset_refs, 'structural', weight=w,
@@ -230,3 +243,22 @@ class StatsTestCase(unittest.TestCase):
 
         # remove only if the test pass
         shutil.rmtree(tempdir)
+
+    def test_assets_per_block(self):
+        # the statistics do not depend on the size of the blocks of assets
+        stats = scientific.StatsBuilder(
+            quantiles=[0.1, 0.9],
+            conditional_loss_poes=[0.35, 0.24, 0.13],
+            poes_disagg=[])
+        stats.assets_per_block = 3
+        outputs = []
+        for i, w in enumerate([0.3, 0.7]):
+            lc = loss_curves(self.assets, self.baselosses, i)
+            outputs.append(scientific.Output(
+                [a.id for a in self.assets], 'structural', weight=w,
+                loss_curves=lc, insured_curves=None))
+        blocked = stats.build(outputs)
+        for attr in ('mean_curves', 'mean_average_losses', 'mean_maps',
+                     'quantile_curves', 'quantile_average_losses',
+                     'quantile_maps'):
+            aaae(getattr(blocked, attr), getattr(self.stats, attr))
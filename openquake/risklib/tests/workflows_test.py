@@ -73,11 +73,24 @@ class ScenarioTestCase(unittest.TestCase):
         self.assertIsNone(out.insured_losses)
 
 
+class GetSeedTestCase(unittest.TestCase):
+    def test_get_seed(self):
+        seed = workflows.get_seed(42, 'RC', 'structural', 'a1', 0)
+        self.assertEqual(
+            seed, workflows.get_seed(42, 'RC', 'structural', 'a1', 0))
+        # different blocks have different seeds
+        self.assertNotEqual(
+            seed, workflows.get_seed(42, 'RC', 'structural', 'a2', 0))
+        self.assertNotEqual(
+            seed, workflows.get_seed(42, 'RC', 'structural', 'a1', 10))
+        self.assertIsNone(workflows.get_seed(None, 'RC', 'structural'))
+
+
 class DamageTest(unittest.TestCase):
     def test_generator(self):
-        with mock.patch('openquake.risklib.scientific.scenario_damage') as m:
-            fragility_functions = mock.Mock()
-            calc = workflows.Damage(
-                'PGA', 'TAXO', dict(damage=fragility_functions))
-            calc('damage', 'assets', 'hazard', None)
-            self.assertEqual(m.call_count, 6)  # called 3 x 2 times
+        fragility_functions = mock.Mock()
+        calc = workflows.Damage(
+            'PGA', 'TAXO', dict(damage=fragility_functions))
+        calc('damage', 'assets', numpy.zeros((3, 2)), None)
+        # the N x R fractions are computed with a single vectorized call
+        self.assertEqual(fragility_functions.damage_fractions.call_count, 1)
@@ -18,6 +18,7 @@
 
 import functools
 import itertools
+import collections
 import numpy
 
 
@@ -54,6 +55,53 @@ class memoized(object):
         return functools.partial(self.__call__, obj)
 
 
+class LRUCache(object):
+    """
+    A bounded cache with least-recently-used eviction. The keys are
+    meant to be built from the content of the cached objects, so that
+    equal objects (for instance copies unpickled in different tasks)
+    share the same entries. The number of hits and misses is recorded.
+
+    :param maxsize: the maximum number of cached values
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, func, *args):
+        """
+        Return the value associated to the key; if missing, compute it
+        as func(*args) and store it, evicting the least recently used
+        value if the cache is full.
+        """
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            value = func(*args)
+            if len(self.data) >= self.maxsize:
+                self.data.popitem(last=False)
+        else:
+            self.hits += 1
+        self.data[key] = value
+        return value
+
+    def clear(self):
+        """Remove all the values and reset the counters"""
+        self.data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return '<%s size=%d, hits=%d, misses=%d>' % (
+            self.__class__.__name__, len(self), self.hits, self.misses)
+
+
 def _composed(f, g, *args, **kwargs):
     return f(g(*args, **kwargs))
 
@@ -16,6 +16,7 @@
 # License along with OpenQuake Risklib. If not, see
 # <http://www.gnu.org/licenses/>.
 
+import zlib
 import inspect
 import functools
 import collections
@@ -126,6 +127,8 @@ def get_values(loss_type, assets, time_event=None):
         a numpy array with the values for the given assets, depending on the
         loss_type.
     """
+    if hasattr(assets, 'get_values'):  # an AssetCollection
+        return assets.get_values(loss_type, time_event)
     if hasattr(assets[0], 'values'):  # special case for oq-lite
         values = numpy.array([a.value(loss_type, time_event)
                               for a in assets])
@@ -134,6 +137,59 @@ def get_values(loss_type, assets, time_event=None):
     return values
 
 
+def get_deductibles(loss_type, assets):
+    """
+    :returns:
+        a numpy array with the deductibles for the given assets and loss_type
+    """
+    if hasattr(assets, 'get_deductibles'):  # an AssetCollection
+        return assets.get_deductibles(loss_type)
+    return numpy.array([a.deductible(loss_type) for a in assets])
+
+
+def get_insurance_limits(loss_type, assets):
+    """
+    :returns:
+        a numpy array with the insurance limits for the given assets and
+        loss_type
+    """
+    if hasattr(assets, 'get_insurance_limits'):  # an AssetCollection
+        return assets.get_insurance_limits(loss_type)
+    return numpy.array([a.insurance_limit(loss_type) for a in assets])
+
+
+def get_numbers(assets):
+    """
+    :returns:
+        a numpy array with the number of units of the given assets
+    """
+    if hasattr(assets, 'get_values'):  # an AssetCollection
+        return assets.number
+    return numpy.array([a.number for a in assets], float)
+
+
+def get_seed(master_seed, *keys):
+    """
+    Derive the seed of a sampling from the master seed and from the keys
+    identifying it (taxonomy, loss type, first asset and first event of
+    the block), so that different blocks use independent random streams.
+
+    :param master_seed: the master random seed (or None)
+    :param keys: strings or integers
+    :returns: an integer in the range [0, 2 ** 32) or None
+
+    >>> get_seed(42, 'RC', 'structural', 'a1', 0) == get_seed(
+    ...     42, 'RC', 'structural', 'a1', 0)
+    True
+    >>> get_seed(42, 'RC', 'structural', 'a1', 0) == get_seed(
+    ...     42, 'RC', 'nonstructural', 'a1', 0)
+    False
+    """
+    if master_seed is None:
+        return
+    return (master_seed + zlib.crc32(repr(keys))) % 2 ** 32
+
+
 class List(list):
     """List subclass to which you can add attribute"""
     # this is ugly, but we already did that, and there is no other easy way
@@ -189,6 +245,7 @@ class Workflow(object):
         """
         for loss_type in self.loss_types:
             assets_ = assets
+            hazards_ = hazards
             epsilons_ = epsilons
             values = get_values(loss_type, assets, self.time_event)
             ok = ~numpy.isnan(values)
@@ -199,10 +256,10 @@ class Workflow(object):
             missing_value = not ok.all()
             if missing_value:
                 assets_ = assets[ok]
-                hazards = hazards[ok]
+                hazards_ = hazards[ok]
                 epsilons_ = epsilons[ok]
             yield out_by_rlz(
-                self, assets_, hazards, epsilons_, tags, loss_type)
+                self, assets_, hazards_, epsilons_, tags, loss_type)
 
     def __repr__(self):
         return '<%s%s>' % (self.__class__.__name__, self.risk_functions.keys())
@@ -295,7 +352,7 @@ class Classical(Workflow):
         imls = hazard_imtls[self.imt]
         self.curves = dict(
             (loss_type,
-             functools.partial(scientific.classical, vf, imls,
+             functools.partial(scientific.classical_curves, vf, imls,
                                steps=lrem_steps_per_interval))
             for loss_type, vf in vulnerability_functions.items())
         self.conditional_loss_poes = conditional_loss_poes
@@ -317,17 +374,19 @@ class Classical(Workflow):
         :returns:
             a :class:`openquake.risklib.scientific.Classical.Output` instance.
         """
-        curves = utils.numpy_map(self.curves[loss_type], hazard_curves)
+        curves = self.curves[loss_type](list(hazard_curves))
         average_losses = utils.numpy_map(scientific.average_loss, curves)
-        maps = scientific.loss_map_matrix(self.conditional_loss_poes, curves)
-        fractions = scientific.loss_map_matrix(self.poes_disagg, curves)
+        maps = scientific.conditional_loss_ratios(
+            curves, self.conditional_loss_poes)
+        fractions = scientific.conditional_loss_ratios(
+            curves, self.poes_disagg)
 
         if self.insured_losses and loss_type != 'fatalities':
-            deductibles = [a.deductible(loss_type) for a in assets]
-            limits = [a.insurance_limit(loss_type) for a in assets]
+            deductibles = get_deductibles(loss_type, assets)
+            limits = get_insurance_limits(loss_type, assets)
 
-            insured_curves = utils.numpy_map(
-                scientific.insured_loss_curve, curves, deductibles, limits)
+            insured_curves = scientific.insured_loss_curves(
+                curves, deductibles, limits)
             average_insured_losses = utils.numpy_map(
                 scientific.average_loss, insured_curves)
         else:
@@ -426,10 +485,11 @@ class ProbabilisticEventBased(Workflow):
             ses_per_logic_tree_path,
             loss_curve_resolution,
             conditional_loss_poes,
-            insured_losses=False):
+            insured_losses=False, master_seed=None):
         """
         See :func:`openquake.risklib.scientific.event_based` for a description
-        of the input parameters.
+        of the input parameters. The `master_seed` is used to sample the
+        vulnerability functions with PMF, see :func:`get_seed`.
         """
         time_span = risk_investigation_time or investigation_time
         tses = (time_span * ses_per_logic_tree_path * (
@@ -443,6 +503,7 @@ class ProbabilisticEventBased(Workflow):
             time_span=time_span, tses=tses)
         self.conditional_loss_poes = conditional_loss_poes
         self.insured_losses = insured_losses
+        self.master_seed = master_seed
         self.return_loss_matrix = True
 
     def event_loss(self, loss_matrix, event_ids):
@@ -485,12 +546,14 @@ class ProbabilisticEventBased(Workflow):
             instance.
         """
         loss_matrix = self.risk_functions[loss_type].apply_to(
-            ground_motion_values, epsilons)
+            ground_motion_values, epsilons, get_seed(
+                self.master_seed, self.taxonomy, loss_type, assets[0].id,
+                list(event_ids[:1])))
         values = get_values(loss_type, assets)
         ela = loss_matrix.T * values  # matrix with T x N elements
         if self.insured_losses and loss_type != 'fatalities':
-            deductibles = [a.deductible(loss_type) for a in assets]
-            limits = [a.insurance_limit(loss_type) for a in assets]
+            deductibles = get_deductibles(loss_type, assets)
+            limits = get_insurance_limits(loss_type, assets)
             ila = utils.numpy_map(
                 scientific.insured_losses, loss_matrix, deductibles, limits)
         else:  # build a zero matrix of size T x N
@@ -509,7 +572,8 @@ class ProbabilisticEventBased(Workflow):
         curves = utils.numpy_map(self.curves, loss_matrix)
         average_losses = utils.numpy_map(scientific.average_loss, curves)
         stddev_losses = numpy.std(loss_matrix, axis=1)
-        maps = scientific.loss_map_matrix(self.conditional_loss_poes, curves)
+        maps = scientific.conditional_loss_ratios(
+            curves, self.conditional_loss_poes)
         elt = self.event_loss(ela, event_ids)
 
         if self.insured_losses and loss_type != 'fatalities':
@@ -583,22 +647,20 @@ class ClassicalBCR(Workflow):
         imls = hazard_imtls[self.imt]
         self.curves_orig = dict(
             (loss_type,
-             functools.partial(scientific.classical, vf, imls,
+             functools.partial(scientific.classical_curves, vf, imls,
                                steps=lrem_steps_per_interval))
             for loss_type, vf in vulnerability_functions_orig.items())
         self.curves_retro = dict(
             (loss_type,
-             functools.partial(scientific.classical, vf, imls,
+             functools.partial(scientific.classical_curves, vf, imls,
                                steps=lrem_steps_per_interval))
             for loss_type, vf in vulnerability_functions_retro.items())
 
     def __call__(self, loss_type, assets, hazard):
         self.assets = assets
 
-        original_loss_curves = utils.numpy_map(
-            self.curves_orig[loss_type], hazard)
-        retrofitted_loss_curves = utils.numpy_map(
-            self.curves_retro[loss_type], hazard)
+        original_loss_curves = self.curves_orig[loss_type](list(hazard))
+        retrofitted_loss_curves = self.curves_retro[loss_type](list(hazard))
 
         eal_original = utils.numpy_map(
             scientific.average_loss, original_loss_curves)
@@ -630,13 +692,14 @@ class ProbabilisticEventBasedBCR(Workflow):
                  number_of_logic_tree_samples,
                  ses_per_logic_tree_path,
                  loss_curve_resolution,
-                 interest_rate, asset_life_expectancy):
+                 interest_rate, asset_life_expectancy, master_seed=None):
         self.imt = imt
         self.taxonomy = taxonomy
         self.risk_functions = vulnerability_functions_orig
         self.assets = None  # set a __call__ time
         self.interest_rate = interest_rate
         self.asset_life_expectancy = asset_life_expectancy
+        self.master_seed = master_seed
         self.vf_orig = vulnerability_functions_orig
         self.vf_retro = vulnerability_functions_retro
         time_span = risk_investigation_time or investigation_time
@@ -647,11 +710,15 @@ class ProbabilisticEventBasedBCR(Workflow):
 
     def __call__(self, loss_type, assets, gmfs, epsilons, event_ids):
         self.assets = assets
+        seed = get_seed(self.master_seed, self.taxonomy, loss_type,
+                        assets[0].id, list(event_ids[:1]))
 
         original_loss_curves = utils.numpy_map(
-            self.curves, self.vf_orig[loss_type].apply_to(gmfs, epsilons))
+            self.curves, self.vf_orig[loss_type].apply_to(
+                gmfs, epsilons, seed))
         retrofitted_loss_curves = utils.numpy_map(
-            self.curves, self.vf_retro[loss_type].apply_to(gmfs, epsilons))
+            self.curves, self.vf_retro[loss_type].apply_to(
+                gmfs, epsilons, seed))
 
         eal_original = utils.numpy_map(
             scientific.average_loss, original_loss_curves)
@@ -689,7 +756,8 @@ class Scenario(Workflow):
                  _tags=None):
         values = get_values(loss_type, assets, self.time_event)
 
-        # a matrix of N x R elements
+        # a matrix of N x R elements; the functions with PMF are sampled
+        # from the global generator, seeded when building the epsilons
         loss_ratio_matrix = self.risk_functions[loss_type].apply_to(
             ground_motion_values, epsilons)
         # another matrix of N x R elements
@@ -698,8 +766,8 @@ class Scenario(Workflow):
         aggregate_losses = loss_matrix.sum(axis=0)
 
         if self.insured_losses and loss_type != "fatalities":
-            deductibles = [a.deductible(loss_type) for a in assets]
-            limits = [a.insurance_limit(loss_type) for a in assets]
+            deductibles = get_deductibles(loss_type, assets)
+            limits = get_insurance_limits(loss_type, assets)
             insured_loss_ratio_matrix = utils.numpy_map(
                 scientific.insured_losses,
                 loss_ratio_matrix, deductibles, limits)
@@ -739,9 +807,9 @@ class Damage(Workflow):
         and D the number of damage states.
         """
         ffs = self.risk_functions['damage']
-        damages = numpy.array(
-            [[scientific.scenario_damage(ffs, gmv) for gmv in gmvs]
-             for gmvs in gmfs])
+        if not hasattr(ffs, 'damage_fractions'):  # a plain list
+            ffs = scientific.FragilityFunctionList(ffs)
+        damages = ffs.damage_fractions(numpy.array(list(gmfs), float))
         return scientific.Output(assets, 'damage', damages=damages)
 
     def gen_out_by_rlz(self, assets, hazards, epsilons, tags):
@@ -783,9 +851,8 @@ class ClassicalDamage(Damage):
 
         where N is the number of points and D the number of damage states.
         """
-        fractions = utils.numpy_map(self.curves, hazard_curves)
-        damages = [asset.number * fraction
-                   for asset, fraction in zip(assets, fractions)]
+        fractions = self.curves(numpy.array(list(hazard_curves), float))
+        damages = get_numbers(assets)[:, None] * fractions
         return scientific.Output(assets, 'damage', damages=damages)
 
     compute_all_outputs = Classical.compute_all_outputs.im_func